@@ -0,0 +1,74 @@
+"""
+Compare the paginated list response of /api/all_posts with the ndjson export of /api/all_posts/stream
+
+Every mode runs in its own process so the peak RSS of one mode does not hide the other.
+Needs REUNION_DB pointing at a database seeded with posts, for example:
+
+    REUNION_DB=mongodb://localhost:27017 SECRET_KEY=bench python benchmarks/bench_all_posts_stream.py
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODES = {
+    # the list path as a client sees it when it asks for every post in one page
+    'list': '/api/all_posts?limit=1000000',
+    'stream': '/api/all_posts/stream',
+}
+
+
+def run(mode):
+    """
+    Request the given mode once and print a json line with peak RSS, time to first byte and total time
+    :param mode: key of MODES
+    """
+    sys.path.insert(0, ROOT)
+    from project.app import app
+    from project import views
+
+    # lift the page size cap so the list path really builds the whole collection like before pagination
+    views.MAX_PAGE_SIZE = sys.maxsize
+    client = app.test_client()
+
+    start = time.perf_counter()
+    response = client.get(MODES[mode], buffered=False)
+    chunks = iter(response.response)
+    first = next(chunks, b'')
+    ttfb = time.perf_counter() - start
+    size = len(first) + sum(len(chunk) for chunk in chunks)
+    total = time.perf_counter() - start
+    response.close()
+
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({'mode': mode, 'status': response.status_code, 'bytes': size, 'ttfb_ms': ttfb * 1000,
+                      'total_ms': total * 1000, 'peak_rss_mb': peak_rss}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=MODES, help='run a single mode in this process (used internally)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per mode')
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode)
+        return
+
+    print(f'{"mode":<8}{"status":>8}{"bytes":>14}{"ttfb ms":>12}{"total ms":>12}{"peak rss MB":>14}')
+    for mode in MODES:
+        for _ in range(args.repeat):
+            out = subprocess.run([sys.executable, __file__, '--mode', mode], capture_output=True, text=True,
+                                 check=True).stdout
+            r = json.loads(out.strip().splitlines()[-1])
+            print(f'{r["mode"]:<8}{r["status"]:>8}{r["bytes"]:>14}{r["ttfb_ms"]:>12.1f}{r["total_ms"]:>12.1f}'
+                  f'{r["peak_rss_mb"]:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
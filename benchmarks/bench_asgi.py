@@ -0,0 +1,112 @@
+"""
+Compare the flask app (project.app) with its async edition (project.aio) under concurrent load at equal CPU
+
+Both apps are served by uvicorn, the flask app through its wsgi interface, each with --workers processes pinned to the
+same --cpus. A pool of --concurrency client threads then sends GET requests to the given paths for --duration
+seconds and the requests per second and p50 / p99 latencies are reported. Needs REUNION_DB, for example:
+
+    REUNION_DB=mongodb://localhost:27017 SECRET_KEY=bench python benchmarks/bench_asgi.py --cpus 0 --concurrency 64
+"""
+import argparse
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+APPS = {
+    'wsgi': ['project.app:app', '--interface', 'wsgi'],
+    'asgi': ['project.aio:app', '--interface', 'asgi3'],
+}
+
+
+def serve(kind, port, cpus, workers):
+    """
+    Start uvicorn serving one of the apps on the given cpus
+    :return: the server process
+    """
+    command = [sys.executable, '-m', 'uvicorn', *APPS[kind], '--port', str(port), '--workers', str(workers),
+               '--no-access-log', '--log-level', 'warning']
+    return subprocess.Popen(command, cwd=ROOT, preexec_fn=lambda: os.sched_setaffinity(0, cpus))
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/api/posts/1')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def load(port, paths, concurrency, duration):
+    """
+    Send requests from concurrency threads, each over its own keep-alive connection, until duration runs out
+    :return: tuple (number of requests, list of latencies in milliseconds, number of non 2xx responses)
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(offset):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        local, failed, i = [], 0, offset
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            connection.request('GET', paths[i % len(paths)])
+            response = connection.getresponse()
+            response.read()
+            local.append((time.perf_counter() - start) * 1000)
+            failed += response.status >= 300
+            i += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    return len(latencies), latencies, errors[0]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--paths', nargs='+', default=['/api/posts/1', '/api/all_posts', '/api/posts/1/comments',
+                                                       '/api/users/1/followers'],
+                        help='paths requested in turn by every client thread')
+    parser.add_argument('--cpus', type=int, nargs='+', default=[0], help='cpus both servers are pinned to')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes per server')
+    parser.add_argument('--concurrency', type=int, default=64, help='client threads')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per server')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f'{"app":>6}{"requests":>10}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"errors":>8}')
+    for kind in APPS:
+        server = serve(kind, args.port, set(args.cpus), args.workers)
+        try:
+            wait_until_up(args.port)
+            count, latencies, errors = load(args.port, args.paths, args.concurrency, args.duration)
+        finally:
+            server.terminate()
+            server.wait()
+        print(f'{kind:>6}{count:>10}{count / args.duration:>10.0f}{statistics.median(latencies):>10.2f}'
+              f'{percentile(latencies, 99):>10.2f}{errors:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Bytes on the wire and CPU cost of every content encoding for the /api/all_posts responses
+
+Builds a page of /api/all_posts holding --posts posts encoded as the app encodes it, and the ndjson export of the same
+posts, no database is needed. For each encoding and level it reports the size of the compressed page, the median
+time to compress and to decompress it, then the size and compression time of the export streamed line by line with
+a flush every STREAM_FLUSH_BYTES, as the app sends it:
+
+    REUNION_DB=mongodb://localhost:27017/bench SECRET_KEY=bench python benchmarks/bench_compression.py --posts 10000
+
+The levels of project.compression.COMPRESSION_LEVELS are marked with a *. Encodings whose package is missing are
+skipped.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bench_encoding import all_posts_body  # noqa: E402
+from project import app  # noqa: E402
+from project.compression import (COMPRESSION_LEVELS, ENCODINGS, StreamCompressor, available_encodings,  # noqa: E402
+                                 compress_stream, zstandard, brotli)
+
+LEVELS = {'zstd': (1, 3, 6, 9, 19), 'br': (1, 4, 5, 6, 9, 11), 'gzip': (1, 6, 9)}
+
+
+def decompressor(encoding):
+    """
+    :return: function decompressing a whole body compressed in encoding
+    """
+    if encoding == 'zstd':
+        return lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if encoding == 'br':
+        return brotli.decompress
+    return lambda data: zlib.decompress(data, 31)
+
+
+def timed(function, repeat):
+    """
+    :return: tuple (result of the last call, median duration of a call in milliseconds)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append((time.perf_counter() - start) * 1000)
+    return result, statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=10000, help='posts in the page and in the export')
+    parser.add_argument('--repeat', type=int, default=10, help='runs per measure')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    body = all_posts_body(args.posts, random.Random(args.seed))
+    with app.app_context():
+        page = app.json.encode(body, separators=(',', ':'))
+        lines = [app.json.dumps(post) + '\n' for post in body['posts']]
+    export_size = sum(len(line.encode()) for line in lines)
+    print(f'page {len(page)} bytes, export {export_size} bytes\n')
+
+    print(f'{"encoding":>9}{"level":>7}{"page bytes":>12}{"ratio":>8}{"compress ms":>13}{"MB/s":>8}'
+          f'{"decompress ms":>15}{"export bytes":>14}{"export ms":>11}')
+    for encoding in available_encodings(ENCODINGS):
+        decompress = decompressor(encoding)
+        for level in LEVELS[encoding]:
+            compressed, compress_ms = timed(lambda: StreamCompressor(encoding, level).compress_body(page), args.repeat)
+            assert decompress(compressed) == page
+            _, decompress_ms = timed(lambda: decompress(compressed), args.repeat)
+            export, export_ms = timed(lambda: b''.join(compress_stream(lines, StreamCompressor(encoding, level))),
+                                      args.repeat)
+            marks = {route for route, levels in COMPRESSION_LEVELS.items() if levels[encoding] == level}
+            label = f'{level}{"*" if marks else " "}'
+            print(f'{encoding:>9}{label:>7}{len(compressed):>12}{len(page) / len(compressed):>8.1f}'
+                  f'{compress_ms:>13.2f}{len(page) / compress_ms / 1000:>8.0f}{decompress_ms:>15.2f}'
+                  f'{len(export):>14}{export_ms:>11.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+Load benchmark of every route of the API with a regression gate
+
+Seeds the database with a synthetic dataset (see `flask seed`), then sends --requests requests to each route from
+--concurrency threads through the flask test client and records for every route the throughput, the p50 / p95 / p99
+latencies and the database commands per request. The report is written as json and compared with a stored baseline,
+the run fails if a route got slower or issues more commands than in the baseline:
+
+    REUNION_DB=mongodb://localhost:27017/bench SECRET_KEY=bench python benchmarks/bench_endpoints.py --save-baseline
+    REUNION_DB=mongodb://localhost:27017/bench SECRET_KEY=bench python benchmarks/bench_endpoints.py
+
+Seeding writes thousands of documents, so only a local database is accepted unless --allow-remote is passed.
+Latencies only compare between runs on the same machine, record the baseline where the gate runs.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from project.app import app  # noqa: E402
+from project.monitoring import command_counter  # noqa: E402
+from project.seed import seed, SEED_PASSWORD  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1', 'mongo', 'mongodb')
+
+
+class Context:
+    """
+    Seeded ids and tokens shared by the request builders, every call picks at random with the thread's own generator
+    """
+
+    def __init__(self, client, summary, users):
+        self.user_ids = summary['user_ids']
+        self.post_ids = summary['post_ids']
+        self.tokens = {}
+        for id in random.Random(0).sample(self.user_ids, min(users, len(self.user_ids))):
+            response = client.post('/api/authenticate', json={'email': f'user{id}@example.com',
+                                                              'password': SEED_PASSWORD})
+            self.tokens[id] = response.json['token']
+        self.created = []  # posts created by the create_post route, deleted by the delete_post route
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def rng(self):
+        if not hasattr(self.local, 'rng'):
+            self.local.rng = random.Random(threading.get_ident())
+        return self.local.rng
+
+    def user(self):
+        return self.rng.choice(self.user_ids)
+
+    def post(self):
+        return self.rng.choice(self.post_ids)
+
+    def headers(self, id=None):
+        """
+        :return: authorization headers of a seeded user, and the id of that user
+        """
+        id = id or self.rng.choice(list(self.tokens))
+        return {'Authorization': self.tokens[id]}, id
+
+
+def create_post(ctx, client):
+    headers, id = ctx.headers()
+    response = client.post('/api/posts', headers=headers, json={'title': 'Bench post', 'description': 'Bench post'})
+    if response.status_code == 200:
+        with ctx.lock:
+            ctx.created.append((response.json['id'], id))  # deleted by its author in delete_post
+    return response
+
+
+def delete_post(ctx, client):
+    with ctx.lock:
+        post = ctx.created.pop() if ctx.created else None
+    if post is None:
+        return client.delete(f'/api/posts/{ctx.post()}', headers=ctx.headers()[0])
+    return client.delete(f'/api/posts/{post[0]}', headers=ctx.headers(post[1])[0])
+
+
+def follow_pair(action):
+    def request(ctx, client):
+        headers, id = ctx.headers()
+        return client.post(f'/api/{action}/{ctx.user()}', headers=headers)
+    return request
+
+
+def batch(ctx, client):
+    operations = [{'op': ctx.rng.choice(['like', 'unlike']), 'id': ctx.post()} for _ in range(10)] + \
+                 [{'op': 'comment', 'id': ctx.post(), 'comment': 'Bench comment'} for _ in range(5)] + \
+                 [{'op': ctx.rng.choice(['follow', 'unfollow']), 'id': ctx.user()} for _ in range(5)]
+    return client.post('/api/batch', headers=ctx.headers()[0], json={'operations': operations})
+
+
+# route -> function sending one request, every route of project/views.py is listed
+ROUTES = {
+    'authenticate': lambda ctx, client: client.post('/api/authenticate', json={
+        'email': f'user{ctx.headers()[1]}@example.com', 'password': SEED_PASSWORD}),
+    'get_user': lambda ctx, client: client.get('/api/user', headers=ctx.headers()[0]),
+    'follow': follow_pair('follow'),
+    'unfollow': follow_pair('unfollow'),
+    'get_followers': lambda ctx, client: client.get(f'/api/users/{ctx.user()}/followers'),
+    'get_following': lambda ctx, client: client.get(f'/api/users/{ctx.user()}/following'),
+    'get_all_posts': lambda ctx, client: client.get(f'/api/all_posts?after={ctx.post()}'),
+    'stream_all_posts': lambda ctx, client: client.get('/api/all_posts/stream'),
+    'create_post': create_post,
+    'get_post': lambda ctx, client: client.get(f'/api/posts/{ctx.post()}'),
+    'get_posts': lambda ctx, client: client.get('/api/posts?ids=' + ','.join(str(ctx.post()) for _ in range(20))),
+    'delete_post': delete_post,
+    'get_feed': lambda ctx, client: client.get('/api/feed', headers=ctx.headers()[0]),
+    'like_post': lambda ctx, client: client.post(f'/api/like/{ctx.post()}', headers=ctx.headers()[0]),
+    'unlike_post': lambda ctx, client: client.post(f'/api/unlike/{ctx.post()}', headers=ctx.headers()[0]),
+    'create_comment': lambda ctx, client: client.post(f'/api/comment/{ctx.post()}', headers=ctx.headers()[0],
+                                                      json={'comment': 'Bench comment'}),
+    'get_comments': lambda ctx, client: client.get(f'/api/posts/{ctx.post()}/comments'),
+    'batch': batch,
+    'cache_stats': lambda ctx, client: client.get('/api/cache/stats'),
+    'pool_stats': lambda ctx, client: client.get('/api/pool/stats'),
+}
+SLOW_ROUTES = {'stream_all_posts': 20}  # routes reading every post get fewer requests, at most this many
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(route, ctx, requests, concurrency):
+    """
+    Send requests requests to a route from concurrency threads
+    :return: dict with the throughput, the latency percentiles in milliseconds, the commands per request and the
+             number of 5xx responses
+    """
+    send = ROUTES[route]
+    latencies, commands, errors = [], [], [0]
+    lock = threading.Lock()
+
+    def worker(count):
+        client = app.test_client()
+        local_latencies, local_commands, local_errors = [], [], 0
+        for _ in range(count):
+            before = command_counter.count
+            start = time.perf_counter()
+            response = send(ctx, client)
+            response.get_data()  # streamed bodies are consumed inside the measurement
+            local_latencies.append((time.perf_counter() - start) * 1000)
+            local_commands.append(command_counter.count - before)
+            local_errors += response.status_code >= 500
+        with lock:
+            latencies.extend(local_latencies)
+            commands.extend(local_commands)
+            errors[0] += local_errors
+
+    shares = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, [share for share in shares if share]))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'commands_per_request': round(sum(commands) / len(commands), 2),
+        'errors': errors[0],
+    }
+
+
+def compare(report, baseline, tolerance):
+    """
+    :param tolerance: allowed relative slowdown of the latencies and the throughput, e.g. 0.2 for 20%
+    :return: list of the regressions found, empty if the run is as good as the baseline
+    """
+    regressions = []
+    for route, result in report['routes'].items():
+        base = baseline.get('routes', {}).get(route)
+        if base is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f'{route}: {metric} {result[metric]} > {base[metric]} (+{tolerance:.0%})')
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f'{route}: rps {result["rps"]} < {base["rps"]} (-{tolerance:.0%})')
+        # commands do not depend on the machine, any increase is a regression
+        if result['commands_per_request'] > base['commands_per_request'] + 0.01:
+            regressions.append(f'{route}: commands per request {result["commands_per_request"]} > '
+                               f'{base["commands_per_request"]}')
+        if result['errors'] > base['errors']:
+            regressions.append(f'{route}: {result["errors"]} server errors')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--likes', type=int, default=50000)
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--random-seed', type=int, default=0)
+    parser.add_argument('--logins', type=int, default=50, help='seeded users sending the authenticated requests')
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per route')
+    parser.add_argument('--routes', nargs='+', choices=sorted(ROUTES), default=list(ROUTES))
+    parser.add_argument('--report', default='bench_report.json', help='where the json report is written')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before the gate fails')
+    parser.add_argument('--allow-remote', action='store_true', help='seed a database that is not local')
+    args = parser.parse_args()
+
+    host = urlparse(app.config['MONGODB_SETTINGS']['host'] or '').hostname
+    if host not in LOCAL_HOSTS and not args.allow_remote:
+        parser.error(f'refusing to seed the database on {host}, pass --allow-remote to do it anyway')
+
+    app.config['TESTING'] = True
+    app.config['ADMISSION_ENABLED'] = False  # capacity is measured here, shedding by bench_overload.py
+    summary = seed(args.users, args.posts, args.likes, args.comments, args.follows, args.random_seed)
+    ctx = Context(app.test_client(), summary, args.logins)
+
+    report = {
+        'dataset': {name: summary[name] for name in ('users', 'posts', 'likes', 'comments', 'follows')},
+        'concurrency': args.concurrency,
+        'routes': {},
+    }
+    print(f'{"route":<18}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"commands":>10}{"errors":>8}')
+    for route in args.routes:
+        result = measure(route, ctx, min(args.requests, SLOW_ROUTES.get(route, args.requests)), args.concurrency)
+        report['routes'][route] = result
+        print(f'{route:<18}{result["rps"]:>10}{result["p50_ms"]:>10}{result["p95_ms"]:>10}{result["p99_ms"]:>10}'
+              f'{result["commands_per_request"]:>10}{result["errors"]:>8}')
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'baseline saved to {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        print(f'no baseline at {args.baseline}, run with --save-baseline to store one')
+        return
+    with open(args.baseline) as f:
+        regressions = compare(report, json.load(f), args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
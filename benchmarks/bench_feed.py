@@ -0,0 +1,113 @@
+"""
+Compare fan-out on write with a pure $in query on read for the home feed
+
+For every size N the benchmark seeds, in an id range far above the real data:
+  * an author with N followers, to time writing one post into N timelines (fan-out on write)
+  * a reader following N authors with --posts posts each, to time one feed page read from the materialized
+    timeline against the same page read with Post.objects(author__in=<followees>) (fan-out on read)
+The seeded documents are removed at the end. Needs REUNION_DB, for example:
+
+    REUNION_DB=mongodb://localhost:27017 SECRET_KEY=bench python benchmarks/bench_feed.py --sizes 10 100 1000 10000
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from project.app import app  # noqa: E402
+from project.models import User, Post, Follow, TimelineEntry  # noqa: E402
+from project.views import fan_out_post  # noqa: E402
+
+BASE_ID = 10 ** 9  # seeded users and posts live above this id
+PAGE_SIZE = 20
+
+
+def timed(f, repeat):
+    """
+    :return: median duration of f() in milliseconds
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def cleanup():
+    User._get_collection().delete_many({'_id': {'$gte': BASE_ID}})
+    Post._get_collection().delete_many({'_id': {'$gte': BASE_ID}})
+    Follow._get_collection().delete_many({'follower': {'$gte': BASE_ID}})
+    TimelineEntry._get_collection().delete_many({'owner': {'$gte': BASE_ID}})
+
+
+def seed(size, posts_per_author):
+    """
+    :return: tuple (author id, reader id, ids of the authors followed by the reader)
+    """
+    author, reader = BASE_ID, BASE_ID + 1
+    followers = list(range(BASE_ID + 2, BASE_ID + 2 + size))
+    followees = followers  # the reader follows the same users that follow the author
+    User._get_collection().insert_many(
+        [{'_id': id, 'name': f'bench {id}', 'email': f'bench{id}@example.com', 'password': 'bench'}
+         for id in [author, reader] + followers])
+    Follow._get_collection().insert_many(
+        [{'follower': id, 'followee': author} for id in followers] +
+        [{'follower': reader, 'followee': id} for id in followees])
+
+    posts, timeline = [], []
+    post_id = BASE_ID
+    now = datetime.datetime.utcnow()
+    for i in range(posts_per_author):
+        for followee in followees:
+            created = now + datetime.timedelta(milliseconds=post_id - BASE_ID)
+            posts.append({'_id': post_id, 'title': 'bench', 'description': 'bench', 'author': followee,
+                          'created_time': created, 'like_count': 0, 'comment_count': 0})
+            timeline.append({'owner': reader, 'post': post_id, 'author': followee, 'created_time': created})
+            post_id += 1
+    Post._get_collection().insert_many(posts)
+    TimelineEntry._get_collection().insert_many(timeline)
+    return author, reader, followees
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='follower / following counts to measure')
+    parser.add_argument('--posts', type=int, default=5, help='posts per followed author')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the median is reported')
+    args = parser.parse_args()
+
+    for model in (User, Post, Follow, TimelineEntry):
+        model.ensure_indexes()
+
+    print(f'{"size":>8}{"fan-out write ms":>20}{"timeline read ms":>20}{"$in read ms":>16}')
+    with app.app_context():
+        for size in args.sizes:
+            cleanup()
+            author, reader, followees = seed(size, args.posts)
+            timelines = TimelineEntry._get_collection()
+
+            def write():
+                fan_out_post(BASE_ID - 1, datetime.datetime.utcnow(), author)
+                timelines.delete_many({'post': BASE_ID - 1})
+
+            def timeline_read():
+                list(TimelineEntry.objects(owner=reader).order_by('-created_time', '-post').only('created_time', 'post')
+                     .limit(PAGE_SIZE).as_pymongo())
+
+            def in_read():
+                list(Post.objects(author__in=followees).order_by('-created_time', '-id').only('created_time')
+                     .limit(PAGE_SIZE).as_pymongo())
+
+            print(f'{size:>8}{timed(write, args.repeat):>20.2f}{timed(timeline_read, args.repeat):>20.2f}'
+                  f'{timed(in_read, args.repeat):>16.2f}')
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Likes and unlikes concentrated on one post, with and without the write-behind buffer
+
+Seeds a local database (see `flask seed`), then for each concurrency of --concurrency runs --duration seconds of likes
+and unlikes of a single post by --logins distinct users from that many client threads, once with LIKE_WRITE_BEHIND off
+and once with it on. For every run it reports the requests per second, their p50 / p99 latency, the database commands
+sent by the requests and the flushes of the buffer, and checks that like_count still equals the number of likes of
+the post once the buffer is flushed:
+
+    REUNION_DB=mongodb://localhost:27017/bench SECRET_KEY=bench python benchmarks/bench_hot_post.py
+
+Without the buffer every like is an update of the same document and the writes queue on it, with it a request only
+takes a lock in process and the document is written once per flush whatever the number of likes.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bench_endpoints import Context, percentile, LOCAL_HOSTS  # noqa: E402
+from project.app import app  # noqa: E402
+from project.models import Post  # noqa: E402
+from project.monitoring import command_counter  # noqa: E402
+from project.seed import seed  # noqa: E402
+from project.views import like_buffer  # noqa: E402
+
+
+def run(ctx, post_id, concurrency, duration):
+    """
+    :return: tuple (latencies in milliseconds, database commands sent by the requests, elapsed seconds)
+    """
+    latencies, commands = [], []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(_):
+        client = app.test_client()
+        local_latencies, local_commands = [], 0
+        while time.perf_counter() < deadline:
+            headers, _ = ctx.headers()
+            action = ctx.rng.choice(('like', 'unlike'))
+            before = command_counter.count
+            start = time.perf_counter()
+            response = client.post(f'/api/{action}/{post_id}', headers=headers)
+            local_latencies.append((time.perf_counter() - start) * 1000)
+            local_commands += command_counter.count - before
+            assert response.status_code in (200, 202), response.json
+        with lock:
+            latencies.extend(local_latencies)
+            commands.append(local_commands)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    return latencies, sum(commands), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8, 64], help='client threads per run')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--logins', type=int, default=500, help='seeded users liking the post')
+    parser.add_argument('--allow-remote', action='store_true', help='seed a database that is not local')
+    args = parser.parse_args()
+
+    host = urlparse(app.config['MONGODB_SETTINGS']['host'] or '').hostname
+    if host not in LOCAL_HOSTS and not args.allow_remote:
+        parser.error(f'refusing to seed the database on {host}, pass --allow-remote to do it anyway')
+
+    app.config['TESTING'] = True
+    app.config['ADMISSION_ENABLED'] = False  # the rate limit of a user would reject the burst
+    summary = seed(args.users, args.posts, 0, 0, 0)
+    ctx = Context(app.test_client(), summary, args.logins)
+    post_id = summary['post_ids'][0]
+
+    print(f'{"threads":>8}{"buffer":>8}{"req/s":>10}{"p50 ms":>9}{"p99 ms":>9}{"commands":>10}{"flushes":>9}'
+          f'{"consistent":>12}')
+    for concurrency in args.concurrency:
+        for enabled in (False, True):
+            app.config['LIKE_WRITE_BEHIND'] = enabled
+            flushes = like_buffer.flushes
+            latencies, commands, elapsed = run(ctx, post_id, concurrency, args.duration)
+            like_buffer.flush()
+            post = Post._get_collection().find_one({'_id': post_id}, {'likes': 1, 'like_count': 1})
+            consistent = post.get('like_count', 0) == len(post.get('likes', []))
+            print(f'{concurrency:>8}{"on" if enabled else "off":>8}{len(latencies) / elapsed:>10.1f}'
+                  f'{percentile(latencies, 50):>9.2f}{percentile(latencies, 99):>9.2f}{commands:>10}'
+                  f'{like_buffer.flushes - flushes:>9}{"yes" if consistent else "NO":>12}')
+
+
+if __name__ == '__main__':
+    main()
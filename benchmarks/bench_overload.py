@@ -0,0 +1,101 @@
+"""
+Tail latency under overload with and without admission control
+
+Seeds a local database (see `flask seed`), then for each concurrency of --concurrency runs --duration seconds of a
+mix of post reads, likes and listings of every post from that many client threads, once with ADMISSION_ENABLED off and
+once with it on. The connection pool is kept small (MONGODB_MAX_POOL_SIZE, 10 unless set) so that the database, not
+the client, is the bottleneck. For every run it reports the successful requests per second, their p50 / p99 latency and
+the number and p99 latency of the requests rejected with a 503:
+
+    REUNION_DB=mongodb://localhost:27017/bench SECRET_KEY=bench python benchmarks/bench_overload.py
+
+Without admission control every request waits for a connection and the p99 grows with the concurrency, with it the
+p99 of the served requests stays close to the one at low concurrency and the excess is rejected in a few milliseconds.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+os.environ.setdefault('MONGODB_MAX_POOL_SIZE', '10')
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bench_endpoints import Context, percentile, LOCAL_HOSTS  # noqa: E402
+from project.app import app  # noqa: E402
+from project.seed import seed  # noqa: E402
+from project.views import admission  # noqa: E402
+
+MIX = [  # (share of the requests, function sending one)
+    (0.7, lambda ctx, client: client.get(f'/api/posts/{ctx.post()}')),
+    (0.2, lambda ctx, client: client.post(f'/api/like/{ctx.post()}', headers=ctx.headers()[0])),
+    (0.1, lambda ctx, client: client.get(f'/api/all_posts?after={ctx.post()}&limit=100')),
+]
+
+
+def run(ctx, concurrency, duration):
+    """
+    :return: dict with the latencies in milliseconds of the requests per status code and the elapsed seconds
+    """
+    latencies = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(_):
+        client = app.test_client()
+        local = {}
+        while time.perf_counter() < deadline:
+            pick, total = ctx.rng.random(), 0
+            for share, send in MIX:
+                total += share
+                if pick <= total:
+                    break
+            start = time.perf_counter()
+            response = send(ctx, client)
+            local.setdefault(response.status_code, []).append((time.perf_counter() - start) * 1000)
+        with lock:
+            for status, values in local.items():
+                latencies.setdefault(status, []).extend(values)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8, 64, 256], help='client threads per run')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--logins', type=int, default=50, help='seeded users sending the likes')
+    parser.add_argument('--allow-remote', action='store_true', help='seed a database that is not local')
+    args = parser.parse_args()
+
+    host = urlparse(app.config['MONGODB_SETTINGS']['host'] or '').hostname
+    if host not in LOCAL_HOSTS and not args.allow_remote:
+        parser.error(f'refusing to seed the database on {host}, pass --allow-remote to do it anyway')
+
+    app.config['TESTING'] = True
+    summary = seed(args.users, args.posts, args.posts * 2, args.posts, args.users * 10)
+    ctx = Context(app.test_client(), summary, args.logins)
+    admission.buckets.rate = 0  # a few tokens send every like, only the concurrency limits are measured
+
+    print(f'pool size {app.config["MONGODB_SETTINGS"]["maxPoolSize"]}')
+    print(f'{"threads":>8}{"admission":>11}{"ok/s":>10}{"ok p50 ms":>11}{"ok p99 ms":>11}{"503":>8}{"503 p99 ms":>12}')
+    for concurrency in args.concurrency:
+        for enabled in (False, True):
+            app.config['ADMISSION_ENABLED'] = enabled
+            latencies, elapsed = run(ctx, concurrency, args.duration)
+            ok = [value for status, values in latencies.items() if status < 400 for value in values]
+            shed = latencies.get(503, [])
+            print(f'{concurrency:>8}{"on" if enabled else "off":>11}{len(ok) / elapsed:>10.1f}'
+                  f'{percentile(ok, 50) if ok else 0:>11.2f}{percentile(ok, 99) if ok else 0:>11.2f}'
+                  f'{len(shed):>8}{percentile(shed, 99) if shed else 0:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Latency of /api/search on a large collection of posts
+
+Seeds --posts posts, in an id range far above the real data, whose titles and descriptions draw their words from a
+vocabulary with a zipf distribution, so the same run measures queries matching a large share of the posts (common
+words), a handful of them (rare words) and two words together. Every query is timed for the first page and for a page
+--depth pages further, the p50 / p95 of --repeat runs are reported. The seeded posts are removed at the end:
+
+    REUNION_DB=mongodb://localhost:27017 SECRET_KEY=bench python benchmarks/bench_search.py --posts 1000000
+
+Seeding a million posts into the text index takes a few minutes, pass --keep to reuse the posts in the next run.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from project.app import app  # noqa: E402
+from project.models import Post  # noqa: E402
+
+BASE_ID = 10 ** 9  # seeded posts live above this id
+BATCH_SIZE = 10000
+VOCABULARY_SIZE = 50000
+PAGE_SIZE = 20
+
+
+def word(rank):
+    return f'w{rank}x'  # stays one token and is not a stop word nor changed by stemming
+
+
+def words(rng, weights, count):
+    return ' '.join(word(rank) for rank in rng.choices(range(VOCABULARY_SIZE), cum_weights=weights, k=count))
+
+
+def seed(posts, rng):
+    weights, total = [], 0.0
+    for rank in range(VOCABULARY_SIZE):
+        total += 1 / (rank + 1)
+        weights.append(total)
+    collection = Post._get_collection()
+    for start in range(0, posts, BATCH_SIZE):
+        collection.insert_many([{'_id': BASE_ID + i, 'title': words(rng, weights, 4),
+                                 'description': words(rng, weights, 20), 'author': 1, 'like_count': 0,
+                                 'comment_count': 0} for i in range(start, min(posts, start + BATCH_SIZE))],
+                               ordered=False)
+
+
+def cleanup():
+    Post._get_collection().delete_many({'_id': {'$gte': BASE_ID}})
+
+
+def timed_pages(client, query, depth, repeat):
+    """
+    :return: tuple (first page durations, durations of the page depth pages further), in milliseconds
+    """
+    first, deep = [], []
+    for _ in range(repeat):
+        url = f'/api/search?q={query}&limit={PAGE_SIZE}'
+        for page in range(depth + 1):
+            start = time.perf_counter()
+            response = client.get(url)
+            elapsed = (time.perf_counter() - start) * 1000
+            if page == 0:
+                first.append(elapsed)
+            elif page == depth:
+                deep.append(elapsed)
+            if response.json['next'] is None:
+                break  # fewer matches than depth pages, no deep page to time
+            url = f'/api/search?q={query}&limit={PAGE_SIZE}&after={response.json["next"]}'
+    return first, deep
+
+
+def percentiles(durations):
+    if not durations:
+        return '-', '-'
+    durations = sorted(durations)
+    p95 = durations[min(len(durations) - 1, len(durations) * 95 // 100)]
+    return f'{statistics.median(durations):.2f}', f'{p95:.2f}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=1000000, help='posts seeded')
+    parser.add_argument('--depth', type=int, default=5, help='pages followed to time a deeper page')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per query')
+    parser.add_argument('--keep', action='store_true', help='do not remove the seeded posts at the end')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    Post.ensure_indexes()
+    if Post._get_collection().count_documents({'_id': {'$gte': BASE_ID}}) != args.posts:
+        cleanup()
+        start = time.perf_counter()
+        seed(args.posts, rng)
+        print(f'seeded {args.posts} posts in {time.perf_counter() - start:.1f} s')
+
+    queries = {
+        'common word': word(0),
+        'frequent word': word(10),
+        'rare word': word(VOCABULARY_SIZE - 1),
+        'two words': f'{word(5)} {word(500)}',
+        'no match': 'nosuchword',
+    }
+    app.config['TESTING'] = True
+    client = app.test_client()
+    print(f'{"query":<16}{"first p50 ms":>14}{"first p95 ms":>14}{"deep p50 ms":>14}{"deep p95 ms":>14}')
+    for name, query in queries.items():
+        first, deep = timed_pages(client, query, args.depth, args.repeat)
+        print(f'{name:<16}' + ''.join(f'{value:>14}' for value in percentiles(first) + percentiles(deep)))
+
+    if not args.keep:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Cost of maintaining the trending ranking
+
+Seeds --posts posts, in an id range far above the real data, with likes and comments spread over the last week, then
+reports the median over --repeat runs of:
+  * a like written without and with the $inc of trend_score, the extra cost every like, unlike and comment pays
+  * reloading the TRENDING_SIZE best posts from the trend_score index, what the background refresh costs
+  * computing the same ranking by scanning every post and decaying its counters, what the index avoids
+  * GET /api/trending answered from the ranking kept in memory
+The seeded posts are removed at the end. Needs REUNION_DB, for example:
+
+    REUNION_DB=mongodb://localhost:27017 SECRET_KEY=bench python benchmarks/bench_trending.py --posts 100000
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from project.app import app  # noqa: E402
+from project.models import Post  # noqa: E402
+from project.trending import trend_increment, LIKE_WEIGHT, COMMENT_WEIGHT  # noqa: E402
+from project.views import load_trending, trending  # noqa: E402
+
+BASE_ID = 10 ** 9  # seeded posts live above this id
+BATCH_SIZE = 10000
+WEEK = 7 * 24 * 3600
+
+
+def timed(f, repeat):
+    """
+    :return: median duration of f() in milliseconds
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def cleanup():
+    Post._get_collection().delete_many({'_id': {'$gte': BASE_ID}})
+
+
+def seed(posts, rng):
+    now = datetime.datetime.utcnow()
+    collection = Post._get_collection()
+    for start in range(BASE_ID, BASE_ID + posts, BATCH_SIZE):
+        batch = []
+        for id in range(start, min(BASE_ID + posts, start + BATCH_SIZE)):
+            active = now - datetime.timedelta(seconds=rng.uniform(0, WEEK))
+            likes, comments = int(rng.paretovariate(1.2)) - 1, int(rng.paretovariate(1.5)) - 1
+            batch.append({'_id': id, 'title': 'bench', 'description': 'bench', 'author': 1, 'created_time': active,
+                          'like_count': likes, 'comment_count': comments,
+                          'trend_score': trend_increment(LIKE_WEIGHT * likes + COMMENT_WEIGHT * comments, active)})
+        collection.insert_many(batch, ordered=False)
+
+
+def scan_ranking(size):
+    """
+    The ranking computed from the counters of every post, interactions dated by the creation of the post
+    """
+    half_life_ms = app.config['TRENDING_HALF_LIFE'] * 3600 * 1000
+    weight = {'$add': [{'$ifNull': ['$like_count', 0]},
+                       {'$multiply': [COMMENT_WEIGHT, {'$ifNull': ['$comment_count', 0]}]}]}
+    decay = {'$pow': [0.5, {'$divide': [{'$subtract': ['$$NOW', '$created_time']}, half_life_ms]}]}
+    return list(Post.objects.aggregate([
+        {'$project': {'score': {'$multiply': [weight, decay]}}},
+        {'$sort': {'score': -1}},
+        {'$limit': size},
+    ], allowDiskUse=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=100000, help='posts seeded')
+    parser.add_argument('--repeat', type=int, default=50, help='runs per measurement, the median is reported')
+    args = parser.parse_args()
+
+    Post.ensure_indexes()
+    cleanup()
+    seed(args.posts, random.Random(0))
+    collection = Post._get_collection()
+    size = app.config['TRENDING_SIZE']
+    ids = iter(range(BASE_ID, BASE_ID + args.posts))
+
+    def like(with_score):
+        update = {'$addToSet': {'likes': 1}, '$inc': {'like_count': 1}}
+        if with_score:
+            update['$inc']['trend_score'] = trend_increment(LIKE_WEIGHT)
+        collection.update_one({'_id': next(ids)}, update)
+
+    app.config['TESTING'] = True
+    client = app.test_client()
+    trending.refresh()
+    results = [
+        ('like without trend_score', timed(lambda: like(False), args.repeat)),
+        ('like with trend_score', timed(lambda: like(True), args.repeat)),
+        (f'reload top {size} (index)', timed(lambda: load_trending(size), args.repeat)),
+        (f'rank by scan of {args.posts} posts', timed(lambda: scan_ranking(size), min(args.repeat, 5))),
+        ('GET /api/trending', timed(lambda: client.get('/api/trending'), args.repeat)),
+    ]
+    for name, duration in results:
+        print(f'{name:<36}{duration:>12.3f} ms')
+    cleanup()
+
+
+if __name__ == '__main__':
+    main()
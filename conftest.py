@@ -0,0 +1,7 @@
+import os
+
+# the scale tests of project/tests/test_scale.py need neither the shared database nor its secret, SCALE_DB alone is
+# enough to run them
+if os.environ.get('SCALE_DB'):
+    os.environ.setdefault('REUNION_DB', 'mongodb://localhost/reunion')
+    os.environ.setdefault('SECRET_KEY', 'scale')
@@ -0,0 +1,31 @@
+# Production server settings, picked up by `gunicorn wsgi:app` run from the root directory
+# pre-fork workers serving requests from a pool of threads each, the app is imported once in the master and forked
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', (os.cpu_count() or 1) * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))  # keep MONGODB_MAX_POOL_SIZE at least as large
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = 5
+preload_app = True
+accesslog = '-'
+
+# the in-process response cache of a worker never sees the invalidations of the others, the workers share a redis one
+# or none, set before the app is imported
+if workers > 1 and not os.environ.get('RESPONSE_CACHE_URL'):
+    os.environ.setdefault('RESPONSE_CACHE_ENABLED', '0')
+
+
+def post_fork(server, worker):
+    # the client created while importing the app in the master must not be used across fork()
+    from project import reconnect_db
+    reconnect_db()
+    server.log.info('worker %s connected to MongoDB', worker.pid)
+
+
+def worker_exit(server, worker):
+    from project.monitoring import pool_monitor
+    server.log.info('worker %s pool stats %s', worker.pid, pool_monitor.stats())
+    from project.views import like_buffer
+    like_buffer.close()  # the likes still buffered are written before the worker goes
@@ -1,2 +1,7 @@
 # only for Vercel Deployment
-from wsgi import app
\ No newline at end of file
+import os
+
+# a cold instance registers its MongoDB connection on its first request rather than while importing the app
+os.environ.setdefault('LAZY_INIT', '1')
+
+from wsgi import app  # noqa: E402
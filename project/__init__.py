@@ -1,17 +1,133 @@
+import datetime
 import os
+import threading
 
 from flask import Flask
 from flask_mongoengine import MongoEngine
+from flask_mongoengine.connection import create_connections
+from mongoengine.connection import disconnect
+
+from .cache import ResponseCache, LocalBackend, RedisBackend
+from .monitoring import command_counter, pool_monitor, TimedJSONProvider
+from .rules import LazyBuilderRule
 
 app = Flask(__name__)
+app.url_rule_class = LazyBuilderRule
+app.json_provider_class = TimedJSONProvider
+app.json = TimedJSONProvider(app)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+# datetimes are written in json as HTTP dates like the default flask provider, as ISO 8601 with JSON_ISO_DATES
+app.config['JSON_ISO_DATES'] = os.environ.get('JSON_ISO_DATES', '0') == '1'
+# authors with at least this many followers are not fanned out to timelines, their posts are merged into feeds on read
+app.config['FEED_FANOUT_LIMIT'] = int(os.environ.get('FEED_FANOUT_LIMIT', 10000))
+
+# ids of new users and posts are reserved on their counter this many at a time by every process
+app.config['ID_BLOCK_SIZE'] = int(os.environ.get('ID_BLOCK_SIZE', 100))
+
+# trending posts: likes and comments lose half their weight every TRENDING_HALF_LIFE hours, the TRENDING_SIZE best
+# posts are kept in every process and reloaded once older than TRENDING_MAX_AGE seconds
+# scores are stored relative to TRENDING_EPOCH and double every half-life, they stay within Decimal128 range for
+# about 20000 half-lives after it, `flask rescale-trending` moves the epoch forward
+app.config['TRENDING_EPOCH'] = datetime.datetime.fromisoformat(os.environ.get('TRENDING_EPOCH', '2023-01-01'))
+app.config['TRENDING_HALF_LIFE'] = float(os.environ.get('TRENDING_HALF_LIFE', 24))  # hours
+app.config['TRENDING_SIZE'] = int(os.environ.get('TRENDING_SIZE', 100))
+app.config['TRENDING_MAX_AGE'] = float(os.environ.get('TRENDING_MAX_AGE', 30))  # seconds
+
+# write-behind of likes: with LIKE_WRITE_BEHIND, the likes and unlikes of a post liked at least LIKE_HOT_THRESHOLD times
+# a second by a process are answered at once and written in one update per post every LIKE_FLUSH_MS, or as soon as
+# LIKE_FLUSH_OPS of them wait; at most LIKE_BUFFER_MAX are held, which is what a crashed process can lose
+app.config['LIKE_WRITE_BEHIND'] = os.environ.get('LIKE_WRITE_BEHIND', '0') == '1'
+app.config['LIKE_HOT_THRESHOLD'] = int(os.environ.get('LIKE_HOT_THRESHOLD', 20))
+app.config['LIKE_FLUSH_MS'] = int(os.environ.get('LIKE_FLUSH_MS', 100))
+app.config['LIKE_FLUSH_OPS'] = int(os.environ.get('LIKE_FLUSH_OPS', 1000))
+app.config['LIKE_BUFFER_MAX'] = int(os.environ.get('LIKE_BUFFER_MAX', 10000))
+
+# admission control: requests over the concurrency limit of their route class are rejected with a 503, clients over
+# RATE_LIMIT_PER_SECOND requests per second per user (bursts of RATE_LIMIT_BURST) with a 429, 0 disables the rate limit
+app.config['ADMISSION_ENABLED'] = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+app.config['RATE_LIMIT_PER_SECOND'] = float(os.environ.get('RATE_LIMIT_PER_SECOND', 50))
+app.config['RATE_LIMIT_BURST'] = int(os.environ.get('RATE_LIMIT_BURST', 100))
+
+# compression of response bodies: the first encoding of COMPRESSION_ENCODINGS among those the client accepts with its
+# highest quality, at the level of the route class (see project.compression), for bodies of at least
+# COMPRESSION_MIN_BYTES, streamed bodies are always compressed; turn it off behind a proxy that compresses
+app.config['COMPRESSION_ENABLED'] = os.environ.get('COMPRESSION_ENABLED', '1') == '1'
+app.config['COMPRESSION_ENCODINGS'] = tuple(os.environ.get('COMPRESSION_ENCODINGS', 'zstd,br,gzip').split(','))
+app.config['COMPRESSION_MIN_BYTES'] = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+
+# database commands slower than this are logged with the shape of their filter
+app.config['SLOW_COMMAND_MS'] = int(os.environ.get('SLOW_COMMAND_MS', 100))
+command_counter.slow_ms = app.config['SLOW_COMMAND_MS']
+
+# Response cache of the public GET routes, kept in process unless RESPONSE_CACHE_URL points to a shared redis
+# the in-process cache only drops the entries invalidated by its own process: it is for a single worker, with more
+# the workers serve stale responses until the ttl runs out, gunicorn.conf.py turns it off for them without the redis
+app.config['RESPONSE_CACHE_URL'] = os.environ.get('RESPONSE_CACHE_URL')
+app.config['RESPONSE_CACHE_ENABLED'] = os.environ.get('RESPONSE_CACHE_ENABLED', '1') == '1'
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 60))  # seconds
+app.config['RESPONSE_CACHE_MAX_BYTES'] = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
 
 # MongoDB configuration
 app.config['MONGODB_SETTINGS'] = {
     'db': 'flask',
     'host': os.environ.get('REUNION_DB'),
+    'connect': False,  # no socket or monitor thread is opened before the first query, so the app can be forked
+    'event_listeners': [command_counter, pool_monitor],
+    # connection pool of every worker process, unset options keep the PyMongo defaults
+    'maxPoolSize': int(os.environ.get('MONGODB_MAX_POOL_SIZE', 100)),
+    'minPoolSize': int(os.environ.get('MONGODB_MIN_POOL_SIZE', 0)),
+    'waitQueueTimeoutMS': int(os.environ['MONGODB_WAIT_QUEUE_TIMEOUT_MS'])
+    if os.environ.get('MONGODB_WAIT_QUEUE_TIMEOUT_MS') else None,
+    'compressors': os.environ.get('MONGODB_COMPRESSORS'),  # e.g. zstd,zlib
 }
 
-db = MongoEngine(app)
+# reads of the public routes (posts, listings, comments, search and trending) follow MONGODB_READ_PREFERENCE, skipping
+# secondaries more than MONGODB_MAX_STALENESS seconds behind the primary (90 at least, -1 for no bound); every other
+# read and every write stays on the primary. A client that wrote a post or a comment reads the public routes from the
+# primary, in a causally consistent session, for READ_YOUR_WRITES_SECONDS after its write
+app.config['MONGODB_READ_PREFERENCE'] = os.environ.get('MONGODB_READ_PREFERENCE', 'secondaryPreferred')
+app.config['MONGODB_MAX_STALENESS'] = int(os.environ.get('MONGODB_MAX_STALENESS', 90))
+app.config['READ_YOUR_WRITES_SECONDS'] = int(os.environ.get('READ_YOUR_WRITES_SECONDS', 90))
+
+# serverless cold starts: with LAZY_INIT the MongoDB connection is registered by the first request or command that
+# needs it rather than at import, PyMongo parses the url when the client is built, which for a mongodb+srv url means
+# DNS queries even with connect=False
+app.config['LAZY_INIT'] = os.environ.get('LAZY_INIT', '0') == '1'
+
+db = MongoEngine()
+_db_lock = threading.Lock()
+
+
+def init_db(app):
+    """
+    Register the MongoDB connection of MONGODB_SETTINGS unless it is already, called at import and, with LAZY_INIT, by
+    every request and command, where it costs a dict lookup once done; no socket is opened before the first query
+    """
+    if db in app.extensions.get('mongoengine', {}):
+        return
+    with _db_lock:
+        if db not in app.extensions.get('mongoengine', {}):
+            db.init_app(app)
+
+
+if not app.config['LAZY_INIT']:
+    init_db(app)
+
+
+def reconnect_db():
+    """
+    Replace the MongoDB client with a new one built from MONGODB_SETTINGS, called in every worker right after the fork
+    so that a worker never shares a client, its pool or its monitor threads with the process it was forked from
+    """
+    if db.app is None:
+        return  # LAZY_INIT, the worker registers its own connection on its first request
+    disconnect()  # also detaches the collections cached by the documents
+    # db.app rather than app, the app global of this package is shadowed by the project.app module once imported
+    create_connections(db.app.config)
+    pool_monitor.reset()
 
 
+if app.config['RESPONSE_CACHE_URL']:
+    response_cache = ResponseCache(RedisBackend(app.config['RESPONSE_CACHE_URL']), app.config['RESPONSE_CACHE_TTL'])
+else:
+    response_cache = ResponseCache(LocalBackend(app.config['RESPONSE_CACHE_MAX_BYTES']), app.config['RESPONSE_CACHE_TTL'])
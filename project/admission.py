@@ -0,0 +1,155 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# route class -> (initial, minimum, maximum) requests admitted at once by a process and the latency target in
+# milliseconds above which the class is congested, None keeps the limit fixed
+ROUTE_CLASSES = {
+    'read': (32, 4, 256, 100),  # single document and page reads
+    'write': (16, 4, 128, 200),
+    'scan': (4, 1, 16, 2000),  # reads going through many documents, e.g. the listing of every post or a search
+    'export': (2, 2, 2, None),  # streamed exports, their duration grows with the data and says nothing of the load
+}
+DECREASE_FACTOR = 0.9  # applied to the limit at most once per latency target while requests are too slow
+SHED_RETRY_AFTER = 1  # seconds a shed client is asked to wait
+MAX_RATE_LIMIT_KEYS = 10000  # token buckets kept, the least recently used ones are dropped beyond
+
+
+class AdaptiveLimit:
+    """
+    Number of requests of a route class a process serves at once, adjusted from the latency of the admitted ones
+    (additive increase, multiplicative decrease): a request slower than the target, or ending while threads wait for a
+    database connection, shrinks the limit by DECREASE_FACTOR at most once per target interval, a faster one grows it
+    by 1 / limit while at least half of it is in use
+    requests over the limit are rejected at once instead of queueing behind the slow ones
+    """
+
+    def __init__(self, initial, minimum, maximum, target, clock=time.monotonic):
+        """
+        :param target: latency in seconds above which a request counts as congested, None for a fixed limit
+        :param clock: function returning the current time in seconds
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last_decrease = float('-inf')
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+
+    def try_acquire(self):
+        """
+        :return: True if the request is admitted, release must then be called once it ends
+        """
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self, latency, congested=False):
+        """
+        :param latency: seconds the admitted request took
+        :param congested: True if the database connection pool had waiting threads
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if self.target is None:
+                return
+            now = self._clock()
+            if congested or latency > self.target:
+                # one decrease per target interval, the requests admitted before it would all shrink it again
+                if now - self._last_decrease >= self.target:
+                    self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+                    self._last_decrease = now
+            elif self.in_flight + 1 >= self.limit / 2:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def stats(self):
+        return {'limit': int(self.limit), 'in_flight': self.in_flight, 'admitted': self.admitted, 'shed': self.shed}
+
+
+class TokenBuckets:
+    """
+    One token bucket per key, e.g. per authenticated user or client address, refilled at rate tokens per second up to
+    burst, the least recently used buckets are dropped beyond max_keys, a key seen again starts with a full bucket
+    """
+
+    def __init__(self, rate, burst, max_keys=MAX_RATE_LIMIT_KEYS, clock=time.monotonic):
+        """
+        :param rate: tokens added per second, 0 disables the rate limit
+        :param burst: tokens a bucket holds at most
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> (tokens, time of the last refill)
+
+    def take(self, key):
+        """
+        :return: 0 if a token was taken, otherwise the seconds until the bucket of key has one
+        """
+        with self._lock:
+            now = self._clock()
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class AdmissionController:
+    """
+    Decides before a handler runs whether the request is served: a client over its rate limit gets a 429 and a request
+    over the concurrency limit of its route class a 503, both with the seconds to wait before retrying
+    """
+
+    def __init__(self, rate, burst, congested=lambda: False, classes=None):
+        """
+        :param rate: requests per second allowed per rate limit key, 0 for no rate limit
+        :param burst: requests a key may send at once above its rate
+        :param congested: function returning True while the database is saturated
+        :param classes: route class table with the layout of ROUTE_CLASSES
+        """
+        classes = ROUTE_CLASSES if classes is None else classes
+        self.limits = {name: AdaptiveLimit(initial, minimum, maximum, target / 1000 if target is not None else None)
+                       for name, (initial, minimum, maximum, target) in classes.items()}
+        self.buckets = TokenBuckets(rate, burst)
+        self._congested = congested
+        self.rate_limited = 0
+
+    def admit(self, route_class, key=None):
+        """
+        :param route_class: key of ROUTE_CLASSES the route belongs to
+        :param key: rate limit key of the client, None for no rate limit
+        :return: tuple (status, retry after in seconds), status is None if the request is admitted and release must be
+                 called once it ends, 429 or 503 if it is rejected
+        """
+        if key is not None and self.buckets.rate:
+            wait = self.buckets.take(key)
+            if wait:
+                self.rate_limited += 1
+                return 429, math.ceil(wait)
+        if not self.limits[route_class].try_acquire():
+            return 503, SHED_RETRY_AFTER
+        return None, 0
+
+    def release(self, route_class, latency):
+        self.limits[route_class].release(latency, self._congested())
+
+    def stats(self):
+        """
+        :return: dict with the limit, in flight and shed counters of every route class and the rate limited count
+        """
+        return {'classes': {name: limit.stats() for name, limit in self.limits.items()},
+                'rate_limited': self.rate_limited}
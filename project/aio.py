@@ -0,0 +1,742 @@
+"""
+Async edition of the API for ASGI servers, e.g.
+
+    uvicorn project.aio:app
+
+It serves the same routes with the same responses as project.views, reads and writes the collections of
+project.models through Motor so a worker never blocks on the database, and shares the token format with the WSGI app.
+Responses are not cached here, the writes drop the entries they change from the response cache of the WSGI app,
+shared with its workers by the redis backend.
+"""
+import asyncio
+import datetime
+import time
+import uuid
+from contextlib import asynccontextmanager
+from functools import wraps
+
+from itsdangerous import BadSignature, SignatureExpired
+from mongoengine.connection import get_db
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.read_preferences import Primary
+from quart import Quart, request, jsonify, json, Response, stream_with_context, g, has_request_context
+from quart.json.provider import DefaultJSONProvider
+from quart.wrappers.response import DataBody, IterableBody
+
+from project import init_db, response_cache
+from project.app import app as wsgi_app
+from project.batch import (BatchPlan, parse_operations, upserted_from_error, comment_count_update, bucket_updates,
+                           duplicate_writes)
+from project.compression import (COMPRESSION_LEVELS, StreamCompressor, available_encodings, negotiate, compressible,
+                                 compress_stream_async)
+from project.encoding import FastJSONMixin
+from project.models import User, Post, Comment, Follow, TimelineEntry, CommentBucket, COMMENT_BUCKET_SIZE
+from project.monitoring import pool_monitor, request_metrics
+from project.routing import load_read_after, dump_read_after, READ_AFTER_COOKIE
+from project.trending import trend_increment, like_score_field, LIKE_WEIGHT
+from project.views import (token_serializer, read_after_serializer, user_ref, page_args, comment_cursor, post_summary,
+                           POST_SUMMARY_PROJECTION, STREAM_BATCH_SIZE, FANOUT_BATCH_SIZE, POST_DETAIL_FIELDS,
+                           post_detail, post_ids_arg, liked_posts_pipeline, search_args, search_pipeline, search_page,
+                           trending, trending_limit, trending_page, admission, route_class, rate_limit_key,
+                           rejection, EXEMPT_ENDPOINTS, buffer_like, unlike_update, to_id, public_read_preference,
+                           wants_ndjson, metrics_text, pool_summary, METRICS_MIMETYPE, created_cursor,
+                           next_created_cursor, created_keyset)
+
+
+class AsyncJSONProvider(FastJSONMixin, DefaultJSONProvider):
+    """
+    Same encoding and MessagePack negotiation as the JSON provider of the flask app
+    """
+
+    def accept_mimetypes(self):
+        return request.accept_mimetypes if has_request_context() else None
+
+
+app = Quart(__name__)
+app.config.from_mapping(wsgi_app.config)
+app.json_provider_class = AsyncJSONProvider
+app.json = AsyncJSONProvider(app)
+config = wsgi_app.config  # settings are read from the flask app so both editions follow the same configuration
+
+POOL_OPTIONS = ('maxPoolSize', 'minPoolSize', 'waitQueueTimeoutMS', 'compressors')  # shared with the flask client
+_client = None
+
+
+def database():
+    """
+    Motor handle on the database MongoEngine is connected to, the client is created on first use so it belongs to the
+    event loop and the process serving requests
+    :return: AsyncIOMotorDatabase
+    """
+    global _client
+    if _client is None:
+        settings = config['MONGODB_SETTINGS']
+        options = {name: settings[name] for name in POOL_OPTIONS if settings.get(name) is not None}
+        _client = AsyncIOMotorClient(settings['host'], event_listeners=[pool_monitor], **options)
+    return _client[get_db().name]
+
+
+def collection(model):
+    """
+    :param model: document class of project.models
+    :return: Motor collection the documents of the class are stored in
+    """
+    return database()[model._get_collection_name()]
+
+
+async def next_id(model):
+    """
+    Next id of a model, taken from the block of ids its BlockSequenceField reserved for the process
+    :param model: document class with a BlockSequenceField named id
+    :return: the new id
+    """
+    allocator = model._fields['id'].allocator
+    id = allocator.take(wait=False)
+    if id is None:  # the block is used up, reserving the next one is a blocking round trip
+        id = await asyncio.get_running_loop().run_in_executor(None, allocator.take)
+    return id
+
+
+@app.before_request
+async def connect_db():
+    init_db(wsgi_app)  # registers the MongoDB connection on the first request with LAZY_INIT
+
+
+# -------------------------------------------------- ADMISSION CONTROL --------------------------------------------
+@app.before_request
+async def admit_request():
+    # same controller as the flask app, it matters most here where nothing else caps the requests in flight
+    if not config['ADMISSION_ENABLED'] or request.endpoint in EXEMPT_ENDPOINTS:
+        return None
+    route = route_class(request.endpoint, request.method, request.accept_mimetypes)
+    key = rate_limit_key(request.headers.get('Authorization'), request.remote_addr)
+    status, retry_after = admission.admit(route, key)
+    if status:
+        body, status, headers = rejection(status, retry_after)
+        return jsonify(body), status, headers
+    g.admitted = (route, time.perf_counter())
+
+
+@app.teardown_request
+async def release_admission(exc):
+    admitted = g.pop('admitted', None)
+    if admitted:
+        admission.release(admitted[0], time.perf_counter() - admitted[1])
+
+
+# -------------------------------------------------- METRICS ------------------------------------------------------
+@app.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+async def record_request_metrics(response):
+    # latency only, the commands of the requests sharing the event loop cannot be told apart
+    if 'request_start' in g:
+        request_metrics.observe(request.endpoint or 'unmatched', request.method, response.status_code,
+                                time.perf_counter() - g.request_start)
+    return response
+
+
+# -------------------------------------------------- COMPRESSION --------------------------------------------------
+@app.after_request
+async def compress_response(response):
+    # same negotiation, threshold and levels as the flask app
+    if not config['COMPRESSION_ENABLED'] or not compressible(response, request.method):
+        return response
+    response.vary.add('Accept-Encoding')
+    streamed = not isinstance(response.response, DataBody)
+    if not streamed and response.content_length < config['COMPRESSION_MIN_BYTES']:
+        return response
+    encoding = negotiate(request.accept_encodings, available_encodings(config['COMPRESSION_ENCODINGS']))
+    if encoding is None:
+        return response
+    route = route_class(request.endpoint, request.method, request.accept_mimetypes)
+    compressor = StreamCompressor(encoding, COMPRESSION_LEVELS[route][encoding])
+
+    if streamed:
+        response.response = IterableBody(compress_stream_async(response.response, compressor))
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compressor.compress_body(await response.get_data()))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# ---------------------------------- AUTHENTICATION MIDDLEWARE ---------------------------------------------------------
+def auth_required(f):
+    """
+    Async twin of project.views.auth_required, passes the token data to the handler
+    """
+
+    @wraps(f)
+    async def auth_wrapper(*args, **kwargs):
+        token = request.headers.get('Authorization')
+        if token:
+            try:
+                data = token_serializer(config['SECRET_KEY']).loads(token, max_age=24 * 60 * 60)
+            except SignatureExpired:  # if token is expired
+                return jsonify({'error': 'Token has expired'}), 401
+            except BadSignature:  # if token is invalid
+                return jsonify({'error': 'Invalid token'}), 401
+            if 'id' not in data:
+                # tokens issued before the id claim only carry the email
+                user = await collection(User).find_one({'email': data['email']}, {'_id': 1})
+                if user is None:
+                    return jsonify({'error': 'Invalid token'}), 401
+                data = dict(data, id=user['_id'])
+            return await f(data, *args, **kwargs)
+        else:  # if token is missing in the request header
+            return jsonify({'error': 'Token is missing'}), 400
+
+    return auth_wrapper
+
+
+async def request_json():
+    """
+    :return: the json body of the request, None if there is none
+    """
+    return await request.get_json(silent=True)
+
+
+# ---------------------------------- READ ROUTING ---------------------------------------------------------------------
+# same routing as project.views: public reads follow MONGODB_READ_PREFERENCE, a client that just wrote a post or a
+# comment reads from the primary in a causally consistent session advanced to its write
+def read_after():
+    if 'read_after' not in g:
+        cookie = request.cookies.get(READ_AFTER_COOKIE)
+        g.read_after = None
+        if cookie:  # only a cookie needs the serializer, the other clients read without SECRET_KEY
+            serializer = read_after_serializer(config['SECRET_KEY'])
+            g.read_after = load_read_after(serializer, cookie, config['READ_YOUR_WRITES_SECONDS'])
+    return g.read_after
+
+
+def public_collection(model):
+    preference = Primary() if read_after() else public_read_preference()
+    return collection(model).with_options(read_preference=preference)
+
+
+async def read_session():
+    operation_time = read_after()
+    if operation_time is None:
+        return None
+    if 'read_session' not in g:
+        g.read_session = await database().client.start_session(causal_consistency=True)
+        g.read_session.advance_operation_time(operation_time)
+    return g.read_session
+
+
+@asynccontextmanager
+async def causal_write():
+    if isinstance(public_read_preference(), Primary):
+        yield None
+        return
+    async with await database().client.start_session(causal_consistency=True) as session:
+        yield session
+        g.written_at = session.operation_time
+
+
+@app.after_request
+async def send_read_after(response):
+    written_at = g.pop('written_at', None)
+    if written_at is not None:
+        response.set_cookie(READ_AFTER_COOKIE, dump_read_after(read_after_serializer(config['SECRET_KEY']), written_at),
+                            max_age=config['READ_YOUR_WRITES_SECONDS'], httponly=True, samesite='Lax')
+    return response
+
+
+@app.teardown_request
+async def end_read_session(exc):
+    session = g.pop('read_session', None)
+    if session is not None:
+        await session.end_session()
+
+
+# --------------------------------------------------------- USER Management --------------------------------------------
+@app.route('/api/authenticate', methods=['POST'])
+async def authenticate():
+    body = await request_json()
+    if not body or 'email' not in body or 'password' not in body:
+        return jsonify({'error': 'Email or Password Missing'}), 400
+
+    user = await collection(User).find_one({'email': body['email']}, {'email': 1, 'password': 1})
+    if user and user['password'] == body['password']:
+        token = token_serializer(config['SECRET_KEY']).dumps({'id': user['_id'], 'email': user['email']})
+        return jsonify({'token': token}), 200
+    else:
+        return jsonify({'error': 'Invalid credentials'}), 401
+
+
+@app.route('/api/user', methods=['GET'])
+@auth_required
+async def get_user(data):
+    user = await collection(User).find_one({'_id': data['id']}, {'name': 1, 'follower_count': 1,
+                                                                 'following_count': 1})
+    return jsonify({'username': user['name'], 'followers': user.get('follower_count', 0),
+                    'following': user.get('following_count', 0)}), 200
+
+
+async def update_follow_counters(follower_id, followee_id, delta):
+    await collection(User).bulk_write([
+        UpdateOne({'_id': follower_id}, {'$inc': {'following_count': delta}}),
+        UpdateOne({'_id': followee_id}, {'$inc': {'follower_count': delta}}),
+    ], ordered=False)
+
+
+@app.route('/api/follow/<id>', methods=['POST'])
+@auth_required
+async def follow(data, id):
+    user_to_follow = await collection(User).find_one({'_id': to_id(id)}, {'_id': 1})
+    if user_to_follow:
+        try:
+            result = await collection(Follow).update_one(
+                {'follower': data['id'], 'followee': user_to_follow['_id']},
+                {'$setOnInsert': {'created_at': datetime.datetime.utcnow()}}, upsert=True)
+        except DuplicateKeyError:
+            result = None
+        if result and result.upserted_id:
+            await update_follow_counters(data['id'], user_to_follow['_id'], 1)
+            return jsonify({'message': 'User followed successfully'}), 200
+        else:
+            return jsonify({'message': 'You already follow this user'}), 200
+    else:
+        return jsonify({'error': 'User with given ID not found'}), 404
+
+
+@app.route('/api/unfollow/<id>', methods=['POST'])
+@auth_required
+async def unfollow(data, id):
+    user_to_unfollow = await collection(User).find_one({'_id': to_id(id)}, {'name': 1})
+    if user_to_unfollow:
+        result = await collection(Follow).delete_one({'follower': data['id'], 'followee': user_to_unfollow['_id']})
+        if result.deleted_count:
+            await update_follow_counters(data['id'], user_to_unfollow['_id'], -1)
+            await collection(TimelineEntry).delete_many({'owner': data['id'], 'author': user_to_unfollow['_id']})
+            return jsonify(
+                {'message': f'Authenticated User  unfollowed {user_to_unfollow["name"]} with {id} successfully'}), 200
+        else:
+            return jsonify({'message': f'You are not following this user with id {id}'}), 200
+    else:
+        return jsonify({'error': f'User with given {id} not found'}), 404
+
+
+async def follow_page(id, user_field, other_field):
+    try:
+        after, limit = page_args(args=request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    query = {user_field: id}
+    if after is not None:
+        query[other_field] = {'$gt': after}
+    edges = collection(Follow).find(query, {other_field: 1}).sort(other_field, 1).limit(limit + 1)
+    ids = [edge[other_field] async for edge in edges]
+
+    if not ids and not await collection(User).find_one({'_id': id}, {'_id': 1}):
+        return jsonify({'error': f'User with given {id} not found'}), 404
+
+    next_cursor = None
+    if len(ids) > limit:
+        ids = ids[:limit]
+        next_cursor = str(ids[-1])
+
+    names = {user['_id']: user.get('name') async for user in collection(User).find({'_id': {'$in': ids}}, {'name': 1})}
+    users = [{'id': str(user_id), 'name': names.get(user_id)} for user_id in ids]
+    return jsonify({'users': users, 'next': next_cursor}), 200
+
+
+@app.route('/api/users/<int:id>/followers', methods=['GET'])
+async def get_followers(id):
+    return await follow_page(id, 'followee', 'follower')
+
+
+@app.route('/api/users/<int:id>/following', methods=['GET'])
+async def get_following(id):
+    return await follow_page(id, 'follower', 'followee')
+
+
+# ------------------------------------------------- GET, CREATE, DELETE POSTS -----------------------------------------
+@app.route('/api/all_posts', methods=['GET'])
+async def get_all_posts():
+    if wants_ndjson(request.accept_mimetypes):
+        return await stream_all_posts()
+
+    try:
+        after, limit = page_args(created_cursor, args=request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    pipeline = []
+    if after is not None:
+        pipeline.append({'$match': created_keyset(after)})
+    pipeline += [
+        {'$sort': {'created_time': 1, '_id': 1}},
+        {'$limit': limit + 1},
+        {'$project': POST_SUMMARY_PROJECTION},
+    ]
+    posts = await public_collection(Post).aggregate(pipeline, session=await read_session()).to_list(None)
+
+    if not posts and after is None:
+        return jsonify({'error': 'No posts found'}), 404
+
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = next_created_cursor(posts[-1]['created_time'], posts[-1]['_id'])
+
+    return jsonify({'posts': [post_summary(post) for post in posts], 'next': next_cursor}), 200
+
+
+@app.route('/api/all_posts/stream', methods=['GET'])
+async def stream_all_posts():
+    # no session, the request may be torn down before the export ends
+    cursor = public_collection(Post).aggregate([{'$sort': {'created_time': 1, '_id': 1}},
+                                                {'$project': POST_SUMMARY_PROJECTION}], batchSize=STREAM_BATCH_SIZE)
+
+    @stream_with_context
+    async def generate():
+        try:
+            async for post in cursor:
+                yield (json.dumps(post_summary(post)) + '\n').encode()
+        finally:
+            await cursor.close()
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/api/posts', methods=['POST'])
+@auth_required
+async def create_post(data):
+    body = await request_json()
+    if not body or 'title' not in body or 'description' not in body:
+        return jsonify({'error': 'Title or description  is missing'}), 400
+
+    author = await collection(User).find_one({'_id': data['id']}, {'follower_count': 1, 'fanout_skipped': 1})
+    if author is None:
+        # the token outlived its user
+        return jsonify({'error': 'Invalid token'}), 401
+    post = Post(title=body['title'], description=body['description'], author=user_ref(data),
+                id=await next_id(Post))
+    fan_out = author.get('follower_count', 0) < config['FEED_FANOUT_LIMIT']
+    if not fan_out and not author.get('fanout_skipped'):
+        await collection(User).update_one({'_id': data['id']}, {'$set': {'fanout_skipped': True}})
+    async with causal_write() as session:
+        await collection(Post).insert_one(post.to_mongo().to_dict(), session=session)
+    response_cache.invalidate('posts:tail')
+    if fan_out:
+        await fan_out_post(post.id, post.created_time, data['id'])
+
+    return jsonify({'id': str(post.id), 'Title': post.title, 'Description': post.description,
+                    'Created Time(UTC)': post.created_time}), 200
+
+
+@app.route('/api/posts/<id>', methods=['GET'])
+async def get_post(id):
+    post = await public_collection(Post).find_one({'_id': to_id(id)}, POST_DETAIL_FIELDS, session=await read_session())
+    if post:
+        return jsonify(post_detail(post)), 200
+    else:
+        return jsonify({'error': 'Post with given id not found'}), 404
+
+
+@app.route('/api/posts', methods=['GET'])
+async def get_posts():
+    try:
+        ids = post_ids_arg(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    posts = {post['_id']: post async for post in public_collection(Post).find({'_id': {'$in': ids}}, POST_DETAIL_FIELDS,
+                                                                              session=await read_session())}
+    return jsonify({'posts': [post_detail(posts[id]) for id in ids if id in posts],
+                    'missing': [str(id) for id in ids if id not in posts]}), 200
+
+
+@app.route('/api/posts/<id>', methods=['DELETE'])
+@auth_required
+async def delete_post(data, id):
+    post_id = to_id(id)
+    result = await collection(Post).delete_one({'_id': post_id, 'author': data['id']})
+    if result.deleted_count:
+        await collection(TimelineEntry).delete_many({'post': post_id})
+        await collection(CommentBucket).delete_many({'post': post_id})
+        response_cache.invalidate(f'post:{post_id}')
+        return jsonify({'message': 'Post deleted successfully'}), 200
+    elif await collection(Post).find_one({'_id': post_id}, {'_id': 1}):
+        return jsonify({'error': 'You are not authorized to delete this post'}), 401
+    else:
+        return jsonify({'message': 'Post with given id not found or Post already deleted'}), 404
+
+
+# -------------------------------------------------- SEARCH ------------------------------------------------------
+@app.route('/api/search', methods=['GET'])
+async def search_posts():
+    try:
+        query, after, limit = search_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    posts = await public_collection(Post).aggregate(search_pipeline(query, after, limit + 1),
+                                                    session=await read_session()).to_list(None)
+    return jsonify(search_page(posts, limit)), 200
+
+
+# -------------------------------------------------- FEED --------------------------------------------------------------
+async def fan_out_post(post_id, created_time, author_id):
+    timelines = collection(TimelineEntry)
+    batch = []
+    written = 0
+    async for edge in collection(Follow).find({'followee': author_id}, {'follower': 1}, batch_size=FANOUT_BATCH_SIZE):
+        batch.append({'owner': edge['follower'], 'post': post_id, 'author': author_id, 'created_time': created_time})
+        if len(batch) >= FANOUT_BATCH_SIZE:
+            written += len((await timelines.insert_many(batch, ordered=False)).inserted_ids)
+            batch = []
+    if batch:
+        written += len((await timelines.insert_many(batch, ordered=False)).inserted_ids)
+    return written
+
+
+async def feed_post_keys(user_id, before, limit):
+    query = {'owner': user_id}
+    if before is not None:
+        query.update(created_keyset(before, 'post', newest_first=True))
+    entries = collection(TimelineEntry).find(query, {'created_time': 1, 'post': 1}).sort(
+        [('created_time', -1), ('post', -1)]).limit(limit)
+    keys = {(entry['created_time'], entry['post']) async for entry in entries}
+
+    followees = [edge['followee'] async for edge in collection(Follow).find({'follower': user_id}, {'followee': 1})]
+    if followees:
+        popular = [user['_id'] async for user in collection(User).find(
+            {'_id': {'$in': followees},
+             '$or': [{'follower_count': {'$gte': config['FEED_FANOUT_LIMIT']}}, {'fanout_skipped': True}]}, {'_id': 1})]
+        if popular:
+            query = {'author': {'$in': popular}}
+            if before is not None:
+                query.update(created_keyset(before, newest_first=True))
+            posts = collection(Post).find(query, {'created_time': 1}).sort([('created_time', -1), ('_id', -1)])
+            keys.update([(post['created_time'], post['_id']) async for post in posts.limit(limit)])
+
+    return sorted(keys, reverse=True)[:limit]
+
+
+@app.route('/api/feed', methods=['GET'])
+@auth_required
+async def get_feed(data):
+    try:
+        after, limit = page_args(created_cursor, args=request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    keys = await feed_post_keys(data['id'], after, limit + 1)
+    next_cursor = None
+    if len(keys) > limit:
+        keys = keys[:limit]
+        next_cursor = next_created_cursor(*keys[-1])
+
+    ids = [post_id for _, post_id in keys]
+    posts = await collection(Post).aggregate([{'$match': {'_id': {'$in': ids}}},
+                                              {'$sort': {'created_time': -1, '_id': -1}},
+                                              {'$project': POST_SUMMARY_PROJECTION}]).to_list(None) if ids else []
+    return jsonify({'posts': [post_summary(post) for post in posts], 'next': next_cursor}), 200
+
+
+# -------------------------------------------------- TRENDING ----------------------------------------------------
+@app.route('/api/trending', methods=['GET'])
+async def get_trending():
+    try:
+        limit = trending_limit(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    posts = trending.top(limit, wait=False)  # shared with the flask app, reloaded by a background thread
+    if posts is None:  # first read of the process, loading the ranking is a blocking round trip
+        posts = await asyncio.get_running_loop().run_in_executor(None, trending.top, limit)
+    return jsonify(trending_page(posts)), 200
+
+
+# -------------------------------------------------- LIKE AND UNLIKE POSTS --------------------------------------------
+@app.route('/api/like/<id>', methods=['POST'])
+@auth_required
+async def like_post(data, id):
+    # likes of a hot post go through the write-behind buffer of project.views, shared by both editions
+    if buffer_like(id, data['id'], True):
+        return jsonify({'message': 'Like accepted'}), 202
+    post_id = to_id(id)
+    increment = trend_increment(LIKE_WEIGHT)
+    result = await collection(Post).update_one({'_id': post_id, 'likes': {'$ne': data['id']}},
+                                               {'$addToSet': {'likes': data['id']},
+                                                '$set': {like_score_field(data['id']): increment},
+                                                '$inc': {'like_count': 1, 'trend_score': increment}})
+    if result.modified_count:
+        response_cache.invalidate(f'post:{post_id}')
+        return jsonify({'message': 'Post liked successfully'}), 200
+    elif await collection(Post).find_one({'_id': post_id}, {'_id': 1}):
+        return jsonify({'message': 'You already liked this post'}), 200
+    else:
+        return jsonify({'error': 'Post with given id not found'}), 404
+
+
+@app.route('/api/unlike/<id>', methods=['POST'])
+@auth_required
+async def unlike_post(data, id):
+    # likes of a hot post go through the write-behind buffer of project.views, shared by both editions
+    if buffer_like(id, data['id'], False):
+        return jsonify({'message': 'Unlike accepted'}), 202
+    post_id = to_id(id)
+    result = await collection(Post).update_one({'_id': post_id, 'likes': data['id']}, unlike_update(data['id']))
+    if result.matched_count:
+        response_cache.invalidate(f'post:{post_id}')
+        return jsonify({'message': 'Post unliked successfully'}), 200
+    elif await collection(Post).find_one({'_id': post_id}, {'_id': 1}):
+        return jsonify({'message': 'You already unliked this post'}), 200
+    else:
+        return jsonify({'error': 'Post with given id not found'}), 404
+
+
+# -------------------------------------------------- COMMENTS -----------------------------------------------------
+@app.route('/api/comment/<id>', methods=['POST'])
+@auth_required
+async def create_comment(data, id):
+    body = await request_json()
+    if not body or 'comment' not in body:
+        return jsonify({'error': 'Comment is missing'}), 400
+
+    comment = Comment(id=str(uuid.uuid4()), user=user_ref(data), text=body['comment'])
+    if await store_comments(to_id(id), [comment.to_mongo().to_dict()]):
+        response_cache.invalidate(f'post:{to_id(id)}')
+        return jsonify({"Comment-ID": comment.id}), 200
+    else:
+        return jsonify({'error': 'Post with given id not found'}), 404
+
+
+async def store_comments(post_id, comments):
+    post = await collection(Post).find_one_and_update({'_id': post_id}, comment_count_update(len(comments)),
+                                                      {'comment_count': 1}, return_document=ReturnDocument.AFTER)
+    if post is None:
+        return False
+    async with causal_write() as session:
+        for query, update in bucket_updates(post_id, comments, post['comment_count']):
+            try:
+                await collection(CommentBucket).update_one(query, update, upsert=True, session=session)
+            except DuplicateKeyError:  # another request created the bucket first
+                await collection(CommentBucket).update_one(query, update, upsert=True, session=session)
+    return True
+
+
+@app.route('/api/posts/<int:id>/comments', methods=['GET'])
+async def get_comments(id):
+    try:
+        after, limit = page_args(comment_cursor, args=request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    query = {'post': id}
+    if after:
+        query['bucket_no'] = {'$lte': after[0]}
+    buckets = public_collection(CommentBucket).find(query, {'bucket_no': 1, 'comments': 1},
+                                                    batch_size=limit // COMMENT_BUCKET_SIZE + 2,
+                                                    session=await read_session())
+
+    comments = []
+    last = None
+    has_more = False
+    async for bucket in buckets.sort('bucket_no', -1):
+        stored = bucket.get('comments', [])
+        end = after[1] if after and bucket['bucket_no'] == after[0] else len(stored)
+        for i in reversed(range(end)):
+            if len(comments) == limit:
+                has_more = True
+                break
+            comments.append({'id': stored[i]['_id'], 'user': str(stored[i].get('user')), 'text': stored[i]['text']})
+            last = (bucket['bucket_no'], i)
+        if has_more:
+            break
+    await buckets.close()
+
+    if not comments and not await public_collection(Post).find_one({'_id': id}, {'_id': 1},
+                                                                   session=await read_session()):
+        return jsonify({'error': 'Post with given id not found'}), 404
+
+    next_cursor = f'{last[0]}:{last[1]}' if has_more else None
+    return jsonify({'comments': comments, 'next': next_cursor}), 200
+
+
+# -------------------------------------------------- BATCH ------------------------------------------------------
+@app.route('/api/batch', methods=['POST'])
+@auth_required
+async def batch(data):
+    try:
+        operations = parse_operations(await request_json())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    plan = BatchPlan(data['id'], user_ref(data), operations)
+    posts, like_scores = {}, {}
+    if plan.post_ids:
+        async for post in collection(Post).aggregate(liked_posts_pipeline(plan.post_ids, data['id'])):
+            posts[post['_id']] = post['liked']
+            if 'like_score' in post:
+                like_scores[post['_id']] = post['like_score']
+    users, followees = {}, set()
+    if plan.user_ids:
+        users = {user['_id']: user.get('name')
+                 async for user in collection(User).find({'_id': {'$in': plan.user_ids}}, {'name': 1})}
+        followees = {edge['followee'] async for edge in collection(Follow).find(
+            {'follower': data['id'], 'followee': {'$in': plan.user_ids}}, {'followee': 1})}
+    plan.run(posts, users, followees, like_scores)
+
+    if plan.post_writes:
+        await collection(Post).bulk_write(plan.post_writes, ordered=False)
+    bucket_writes = []
+    for id, comments in plan.comments.items():
+        post = await collection(Post).find_one_and_update({'_id': id}, comment_count_update(len(comments)),
+                                                          {'comment_count': 1}, return_document=ReturnDocument.AFTER)
+        if post is not None:  # not deleted since it was read
+            bucket_writes += [UpdateOne(query, update, upsert=True)
+                              for query, update in bucket_updates(id, comments, post['comment_count'])]
+    while bucket_writes:
+        try:
+            await collection(CommentBucket).bulk_write(bucket_writes, ordered=False)
+            bucket_writes = []
+        except BulkWriteError as e:
+            bucket_writes = [bucket_writes[i] for i in duplicate_writes(e)]
+    upserted = {}
+    if plan.follow_writes:
+        try:
+            upserted = (await collection(Follow).bulk_write([write for write, _ in plan.follow_writes],
+                                                            ordered=False)).upserted_ids
+        except BulkWriteError as e:
+            upserted = upserted_from_error(e)
+    deleted = [id for id in plan.unfollowed
+               if (await collection(Follow).delete_one({'follower': data['id'], 'followee': id})).deleted_count]
+    counters = plan.counter_writes(upserted, deleted)
+    if counters:
+        await collection(User).bulk_write(counters, ordered=False)
+    if plan.unfollowed:
+        await collection(TimelineEntry).delete_many({'owner': data['id'], 'author': {'$in': plan.unfollowed}})
+    response_cache.invalidate(*(f'post:{id}' for id in plan.touched_posts))
+
+    return jsonify({'results': plan.results}), 200
+
+
+# -------------------------------------------------- MONITORING ---------------------------------------------------
+@app.route('/api/cache/stats', methods=['GET'])
+async def cache_stats():
+    return jsonify(response_cache.stats()), 200
+
+
+@app.route('/api/pool/stats', methods=['GET'])
+async def pool_stats():
+    # the pool of the Motor client, pool_monitor listens to it as to the client of the flask app
+    return jsonify(pool_summary()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return Response(metrics_text(), mimetype=METRICS_MIMETYPE)
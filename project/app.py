@@ -1 +1 @@
-from . import app, views, models
\ No newline at end of file
+from . import app, views, models, commands
\ No newline at end of file
@@ -0,0 +1,217 @@
+import datetime
+import itertools
+import uuid
+from collections import defaultdict
+
+from pymongo import UpdateOne
+
+from project.models import Comment, COMMENT_BUCKET_SIZE
+from project.trending import trend_increment, trend_decrement, like_score_field, LIKE_WEIGHT, COMMENT_WEIGHT
+
+BATCH_MAX_OPERATIONS = 100  # operations accepted by one call of /api/batch
+POST_OPERATIONS = ('like', 'unlike', 'comment')
+USER_OPERATIONS = ('follow', 'unfollow')
+
+
+def parse_operations(body):
+    """
+    Validate the body of a batch request, {"operations": [{"op": "like", "id": 3}, ...]}
+    :param body: json body of the request
+    :return: list of operations, an operation that is not valid is kept with an 'error' and is not run
+    :raises ValueError: if the body is not a list of at most BATCH_MAX_OPERATIONS operations
+    """
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list) or not operations:
+        raise ValueError('operations must be a non empty list')
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        raise ValueError(f'at most {BATCH_MAX_OPERATIONS} operations are accepted per batch')
+
+    parsed = []
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('op') not in POST_OPERATIONS + USER_OPERATIONS:
+            parsed.append({'error': f'op must be one of {", ".join(POST_OPERATIONS + USER_OPERATIONS)}'})
+            continue
+        try:
+            id = int(operation.get('id'))
+        except (TypeError, ValueError):
+            parsed.append({'error': 'id must be an integer'})
+            continue
+        if operation['op'] == 'comment' and not operation.get('comment'):
+            parsed.append({'error': 'Comment is missing'})
+            continue
+        parsed.append({'op': operation['op'], 'id': id, 'comment': operation.get('comment')})
+    return parsed
+
+
+class BatchPlan:
+    """
+    Runs the operations of a batch in memory against the state read from the database and turns their net effect
+    into one list of writes per collection
+    the state needed is read up front: the posts and whether the user likes them (posts), the users to follow or
+    unfollow (users) and the ones already followed (followees), the writes are then sent with one bulk_write per
+    collection whatever the number of operations
+    """
+
+    def __init__(self, user_id, user, operations):
+        """
+        :param user_id: id of the authenticated user
+        :param user: value stored to reference the authenticated user
+        :param operations: operations returned by parse_operations
+        """
+        self.user_id = user_id
+        self.user = user
+        self.operations = operations
+        self.results = []
+        self.post_writes = []
+        self.comments = {}  # post id -> comments to store, counted by comment_count_update
+        self.follow_writes = []  # (upsert of the edge, followee id)
+        self.unfollowed = []  # users whose edge is deleted, their posts leave the timeline of the user
+        self.touched_posts = set()  # posts whose cached responses are stale after the batch
+
+    @property
+    def post_ids(self):
+        return sorted({op['id'] for op in self.operations if op.get('op') in POST_OPERATIONS})
+
+    @property
+    def user_ids(self):
+        return sorted({op['id'] for op in self.operations if op.get('op') in USER_OPERATIONS})
+
+    def run(self, posts, users, followees, like_scores=None):
+        """
+        :param posts: dict post id -> True if the user likes the post, for the posts of post_ids that exist
+        :param users: dict user id -> name, for the users of user_ids that exist
+        :param followees: set of the ids of user_ids the user already follows
+        :param like_scores: dict post id -> what the like of the user added to its trend_score, for the liked posts
+                            whose like recorded it (see project.trending.like_score)
+        """
+        liked = {id for id, likes in posts.items() if likes}
+        following = set(followees)
+        comments = defaultdict(list)
+
+        for op in self.operations:
+            if 'error' in op:
+                self.results.append({'status': 400, 'error': op['error']})
+            elif op['op'] in POST_OPERATIONS and op['id'] not in posts:
+                self.results.append({'status': 404, 'error': 'Post with given id not found'})
+            elif op['op'] in USER_OPERATIONS and op['id'] not in users:
+                self.results.append({'status': 404, 'error': 'User with given ID not found'})
+            elif op['op'] == 'like':
+                self.results.append({'status': 200, 'message': 'You already liked this post' if op['id'] in liked
+                                     else 'Post liked successfully'})
+                liked.add(op['id'])
+            elif op['op'] == 'unlike':
+                self.results.append({'status': 200, 'message': 'Post unliked successfully' if op['id'] in liked
+                                     else 'You already unliked this post'})
+                liked.discard(op['id'])
+            elif op['op'] == 'comment':
+                comment = Comment(id=str(uuid.uuid4()), user=self.user, text=op['comment'])
+                comments[op['id']].append(comment.to_mongo())
+                self.results.append({'status': 200, 'Comment-ID': comment.id})
+            elif op['op'] == 'follow':
+                self.results.append({'status': 200, 'message': 'You already follow this user'
+                                     if op['id'] in following else 'User followed successfully'})
+                following.add(op['id'])
+            elif op['id'] in following:
+                self.results.append({'status': 200, 'message': f'Authenticated User  unfollowed {users[op["id"]]} '
+                                                               f'with {op["id"]} successfully'})
+                following.discard(op['id'])
+            else:
+                self.results.append({'status': 200, 'message': f'You are not following this user with id {op["id"]}'})
+
+        # only the net change is written, a like followed by an unlike of the same post writes nothing
+        like, like_scores, field = trend_increment(LIKE_WEIGHT), like_scores or {}, like_score_field(self.user_id)
+        for id in sorted(posts):
+            if id in liked and not posts[id]:
+                self.post_writes.append(UpdateOne({'_id': id, 'likes': {'$ne': self.user_id}},
+                                                  {'$addToSet': {'likes': self.user_id}, '$set': {field: like},
+                                                   '$inc': {'like_count': 1, 'trend_score': like}}))
+            elif posts[id] and id not in liked:
+                # matches only while the like is the one read, what it added is taken back once
+                score = like_scores.get(id)
+                update = {'$pull': {'likes': self.user_id}, '$unset': {field: ''}, '$inc': {'like_count': -1}}
+                if score is not None:
+                    update['$inc']['trend_score'] = trend_decrement(score)
+                self.post_writes.append(UpdateOne({'_id': id, 'likes': self.user_id,
+                                                   field: score if score is not None else {'$exists': False}}, update))
+            else:
+                continue
+            self.touched_posts.add(id)
+        self.comments = dict(comments)
+        self.touched_posts.update(comments)
+
+        for id in sorted(users):
+            if id in following and id not in followees:
+                self.follow_writes.append((UpdateOne(
+                    {'follower': self.user_id, 'followee': id},
+                    {'$setOnInsert': {'created_at': datetime.datetime.utcnow()}}, upsert=True), id))
+            elif id in followees and id not in following:
+                self.unfollowed.append(id)
+
+    def counter_writes(self, upserted, deleted):
+        """
+        Follower and following counter updates once the follow edges are written
+        :param upserted: indexes in follow_writes of the edges actually inserted, an edge created concurrently by
+                         another request is not counted twice
+        :param deleted: ids of unfollowed whose edge was actually deleted, an edge deleted concurrently by another
+                        request is not uncounted twice
+        :return: list of UpdateOne for the user collection
+        """
+        deltas = defaultdict(int)
+        changed = [(followee, 1) for i, (_, followee) in enumerate(self.follow_writes) if i in upserted]
+        for followee, delta in changed + [(followee, -1) for followee in deleted]:
+            deltas[(self.user_id, 'following_count')] += delta
+            deltas[(followee, 'follower_count')] += delta
+        return [UpdateOne({'_id': id}, {'$inc': {counter: delta}}) for (id, counter), delta in deltas.items() if delta]
+
+
+def comment_count_update(count):
+    """
+    Update of a post counting count new comments, run with find_one_and_update: the comment_count it returns places
+    the comments in their buckets, see bucket_updates
+    """
+    return {'$inc': {'comment_count': count, 'trend_score': trend_increment(COMMENT_WEIGHT * count)}}
+
+
+def bucket_updates(post_id, comments, comment_count):
+    """
+    Updates storing comments in the buckets of a post
+    the comments take the last len(comments) positions counted by comment_count, position p goes to the bucket
+    p // COMMENT_BUCKET_SIZE, so requests commenting the same post at once never fill a bucket past its size
+    :param comments: comments counted by the comment_count_update that returned comment_count
+    :param comment_count: comment_count of the post once the comments are counted
+    :return: list of (filter, update) to upsert in order, on the unique (post, bucket_no) of the bucket: the upsert of
+             a request beaten by another one creating the same bucket fails with DuplicateKeyError, sent again it
+             appends to that bucket
+    """
+    positions = enumerate(comments, comment_count - len(comments))
+    updates = []
+    for bucket_no, stored in itertools.groupby(positions, key=lambda item: item[0] // COMMENT_BUCKET_SIZE):
+        stored = [comment for _, comment in stored]
+        updates.append(({'post': post_id, 'bucket_no': bucket_no},
+                        {'$push': {'comments': {'$each': stored}}, '$inc': {'count': len(stored)}}))
+    return updates
+
+
+def duplicate_writes(error):
+    """
+    Indexes of the writes of an unordered bulk_write of bucket_updates beaten by other requests creating the same
+    buckets, sent again they append to those buckets
+    :param error: BulkWriteError raised by the bulk_write
+    :return: list of the indexes of the writes to send again
+    :raises BulkWriteError: if a write failed for any other reason than the unique index
+    """
+    if any(write_error['code'] != 11000 for write_error in error.details['writeErrors']):
+        raise error
+    return [write_error['index'] for write_error in error.details['writeErrors']]
+
+
+def upserted_from_error(error):
+    """
+    Indexes of the follow edges inserted by a bulk_write that also hit edges created concurrently by other requests
+    :param error: BulkWriteError raised by the bulk_write of BatchPlan.follow_writes
+    :return: set of the indexes of the edges inserted
+    :raises BulkWriteError: if a write failed for any other reason than the unique index
+    """
+    if any(write_error['code'] != 11000 for write_error in error.details['writeErrors']):
+        raise error
+    return {upsert['index'] for upsert in error.details['upserted']}
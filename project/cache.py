@@ -0,0 +1,247 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from functools import wraps
+
+from flask import request, current_app
+
+from .encoding import wants_msgpack, unpack, MSGPACK_MIMETYPE
+
+try:
+    import redis
+except ImportError:  # the shared backend is optional
+    redis = None
+
+# invalidations are remembered this long, a response computed for longer is not cached as it could have missed one
+INVALIDATION_WINDOW = 60  # seconds
+
+
+class LocalBackend:
+    """
+    In-process LRU store, entries expire after their ttl and the least recently used ones are evicted once the cached
+    bodies take more than max_bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires at, size, entry, tags)
+        self._tags = defaultdict(set)  # tag -> keys
+        self._size = 0
+        self._sequence = 0  # number of invalidations so far
+        self._invalidated = OrderedDict()  # tag -> (sequence, time) of its last invalidation, oldest first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return item[2]
+
+    def sequence(self):
+        return self._sequence
+
+    def set(self, key, entry, ttl, tags, since=None):
+        """
+        :param since: sequence read before the response was computed, the entry is not stored if one of its tags was
+                      invalidated after it: the response may hold what the write behind that invalidation replaced
+        :return: whether the entry was stored
+        """
+        size = len(entry['body'])
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if since is not None and any(self._invalidated.get(tag, (0,))[0] > since for tag in tags):
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, size, entry, tags)
+            self._size += size
+            for tag in tags:
+                self._tags[tag].add(key)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))  # least recently used first
+                self.evictions += 1
+            return True
+
+    def invalidate(self, tags):
+        with self._lock:
+            self._sequence += 1
+            now = time.monotonic()
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+                self._invalidated.pop(tag, None)
+                self._invalidated[tag] = (self._sequence, now)
+            while self._invalidated and next(iter(self._invalidated.values()))[1] < now - INVALIDATION_WINDOW:
+                self._invalidated.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._size = 0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self._size, 'evictions': self.evictions}
+
+    def _remove(self, key):
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        self._size -= item[1]
+        for tag in item[3]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+# stores an entry unless one of its tags was invalidated after the read started, checked and written in one step
+# KEYS: entry, then the key set of every tag, then the last invalidation of every tag
+# ARGV: since or '', entry, ttl, key
+REDIS_SET_SCRIPT = '''
+local tags = (#KEYS - 1) / 2
+for i = 1, tags do
+    local invalidated = redis.call('GET', KEYS[1 + tags + i])
+    if ARGV[1] ~= '' and invalidated and tonumber(invalidated) > tonumber(ARGV[1]) then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+for i = 1, tags do
+    redis.call('SADD', KEYS[1 + i], ARGV[4])
+    redis.call('EXPIRE', KEYS[1 + i], ARGV[3])
+end
+return 1
+'''
+
+
+class RedisBackend:
+    """
+    Store shared by every worker, invalidations made by one worker are seen by all of them
+    Redis expires the entries and evicts them under its own maxmemory policy
+    """
+
+    def __init__(self, url, prefix='response-cache:'):
+        if redis is None:
+            raise RuntimeError('the redis package is required for RESPONSE_CACHE_URL')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._set_script = self.client.register_script(REDIS_SET_SCRIPT)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def sequence(self):
+        return int(self.client.get(f'{self.prefix}sequence') or 0)
+
+    def set(self, key, entry, ttl, tags, since=None):
+        keys = [self.prefix + key] + [f'{self.prefix}tag:{tag}' for tag in tags]
+        keys += [f'{self.prefix}invalidated:{tag}' for tag in tags]
+        since = '' if since is None else since
+        return bool(self._set_script(keys=keys, args=[since, json.dumps(entry), ttl, key]))
+
+    def invalidate(self, tags):
+        sequence = self.client.incr(f'{self.prefix}sequence')
+        for tag in tags:
+            self.client.set(f'{self.prefix}invalidated:{tag}', sequence, ex=INVALIDATION_WINDOW)
+            tag_key = f'{self.prefix}tag:{tag}'
+            keys = [self.prefix + key.decode() for key in self.client.smembers(tag_key)]
+            self.client.delete(tag_key, *keys)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        return {'evictions': self.client.info('stats').get('evicted_keys', 0)}
+
+
+def body_bytes(entry):
+    """
+    :return: body of a cache entry as the bytes of the cached response
+    """
+    return entry['body'].encode('latin-1' if entry['mimetype'] == MSGPACK_MIMETYPE else 'utf-8')
+
+
+class ResponseCache:
+    """
+    Caches whole responses of public GET routes, tags every entry with what it depends on so a write can drop
+    exactly the affected entries, and answers conditional requests with 304 from the ETag of the body
+    """
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # guards the counters
+
+    def cached(self, key, tags):
+        """
+        Decorator caching the 200 responses of a view
+        :param key: function of the view arguments returning the cache key, or None to bypass the cache
+        :param tags: function of the json body and the view arguments returning the tags of the entry
+        """
+
+        def decorator(f):
+            @wraps(f)
+            def cache_wrapper(*args, **kwargs):
+                cache_key = key(*args, **kwargs)
+                if cache_key is None or not current_app.config['RESPONSE_CACHE_ENABLED']:
+                    return f(*args, **kwargs)
+                if wants_msgpack(request.accept_mimetypes):
+                    cache_key += ':msgpack'  # the same response in its other representation
+
+                entry = self.backend.get(cache_key)
+                with self._lock:
+                    if entry is not None:
+                        self.hits += 1
+                    else:
+                        self.misses += 1
+                if entry is not None:
+                    response = current_app.response_class(body_bytes(entry), status=200, mimetype=entry['mimetype'])
+                    response.vary.add('Accept')
+                else:
+                    # a write landing while f runs invalidates before this read stores what it read before the write
+                    since, started = self.backend.sequence(), time.monotonic()
+                    response = current_app.make_response(f(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    data = response.get_data()
+                    # entries hold text so the redis backend can store them as json, latin-1 maps MessagePack bytes
+                    # one to one to characters
+                    entry = {'body': data.decode('latin-1' if response.mimetype == MSGPACK_MIMETYPE else 'utf-8'),
+                             'mimetype': response.mimetype, 'etag': hashlib.md5(data).hexdigest(),
+                             'last_modified': int(time.time())}
+                    body = unpack(data) if response.mimetype == MSGPACK_MIMETYPE else response.get_json()
+                    if time.monotonic() - started < INVALIDATION_WINDOW:
+                        self.backend.set(cache_key, entry, self.ttl, tags(body, *args, **kwargs), since)
+
+                response.set_etag(entry['etag'])
+                response.last_modified = entry['last_modified']
+                return response.make_conditional(request)
+
+            return cache_wrapper
+
+        return decorator
+
+    def invalidate(self, *tags):
+        self.backend.invalidate(tags)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return dict(self.backend.stats(), hits=self.hits, misses=self.misses)
@@ -0,0 +1,249 @@
+import datetime
+from decimal import Decimal, localcontext
+from functools import wraps
+
+import click
+from bson.decimal128 import Decimal128
+from mongoengine.connection import get_db
+from pymongo import UpdateOne, UpdateMany, DeleteMany
+from pymongo.errors import DuplicateKeyError
+
+from project.models import User, Post, Follow, TimelineEntry, CommentBucket, COMMENT_BUCKET_SIZE
+from project.seed import seed as seed_data, SCALE_TIERS
+from project.trending import decay_exponent, DECIMAL128_CONTEXT
+from . import app, init_db
+
+MIGRATION_BATCH_SIZE = 1000  # edges written per bulk_write by migrate-follows, posts by migrate-timelines
+INDEXED_MODELS = (User, Post, Follow, TimelineEntry, CommentBucket)
+# volumes of flask seed without --tier
+SEED_VOLUMES = {'users': 1000, 'posts': 10000, 'likes': 50000, 'comments': 20000, 'follows': 20000}
+
+
+def with_db(f):
+    """
+    Register the MongoDB connection before the command runs, it is not yet with LAZY_INIT
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        init_db(app)
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+def reconcile_follow_counters():
+    """
+    Recount follower_count and following_count of every user from the Follow edges
+    :return: number of users reset before the recount
+    """
+    users = User._get_collection()
+    result = users.update_many({}, {'$set': {'follower_count': 0, 'following_count': 0}})
+    for edge_field, counter in (('followee', 'follower_count'), ('follower', 'following_count')):
+        # counted and written back by the database, nothing is shipped to the client
+        Follow.objects.aggregate([
+            {'$group': {'_id': f'${edge_field}', 'count': {'$sum': 1}}},
+            {'$merge': {'into': users.name, 'on': '_id', 'whenNotMatched': 'discard',
+                        'whenMatched': [{'$set': {counter: '$$new.count'}}]}},
+        ])
+    return result.matched_count
+
+
+@app.cli.command('reconcile-counters')
+@with_db
+def reconcile_counters():
+    """
+    Rebuild the denormalized like, comment, follower and following counters from the data they count
+    Each counter is recomputed by the database with a pipeline update or an aggregation
+    """
+    posts = Post._get_collection()
+    if posts.find_one({'comments': {'$exists': True}}, {'_id': 1}):
+        # they would be left out of comment_count, which also numbers the buckets of the new comments
+        raise click.ClickException('posts still embed comments, run flask migrate-comments first')
+    result = posts.update_many({}, [{'$set': {
+        'like_count': {'$size': {'$ifNull': ['$likes', []]}},
+        'comment_count': 0,
+    }}])
+    # comments are counted over the buckets of each post
+    CommentBucket.objects.aggregate([
+        {'$group': {'_id': '$post', 'count': {'$sum': {'$size': {'$ifNull': ['$comments', []]}}}}},
+        {'$merge': {'into': posts.name, 'on': '_id', 'whenNotMatched': 'discard',
+                    'whenMatched': [{'$set': {'comment_count': '$$new.count'}}]}},
+    ])
+    click.echo(f'Posts: {result.matched_count} recounted')
+
+    click.echo(f'Users: {reconcile_follow_counters()} recounted')
+
+
+@app.cli.command('migrate-follows')
+@with_db
+def migrate_follows():
+    """
+    Convert the followers / following lists embedded in user documents into Follow edges
+    The following list of every user is the source of truth, the edges are upserted so the command can be re-run,
+    afterwards the lists are removed from the users and the counters are recounted from the edges
+    """
+    users = User._get_collection()
+    edges = Follow._get_collection()
+    now = datetime.datetime.utcnow()
+    batch = []
+    migrated = 0
+
+    for user in users.find({'following': {'$exists': True}}, {'following': 1}):
+        for followee in user['following']:
+            batch.append(UpdateOne({'follower': user['_id'], 'followee': followee},
+                                   {'$setOnInsert': {'created_at': now}}, upsert=True))
+        if len(batch) >= MIGRATION_BATCH_SIZE:
+            migrated += edges.bulk_write(batch, ordered=False).upserted_count
+            batch = []
+    if batch:
+        migrated += edges.bulk_write(batch, ordered=False).upserted_count
+    click.echo(f'Follow edges created: {migrated}')
+
+    result = users.update_many({'$or': [{'following': {'$exists': True}}, {'followers': {'$exists': True}}]},
+                               {'$unset': {'following': '', 'followers': ''}})
+    click.echo(f'Users migrated: {result.modified_count}')
+    click.echo(f'Users recounted: {reconcile_follow_counters()}')
+
+
+@app.cli.command('create-indexes')
+@with_db
+def create_indexes():
+    """
+    Create the indexes declared in the meta of every model
+    MongoEngine also creates them the first time a process touches a collection, running this command at deploy time
+    builds them before traffic arrives instead
+    """
+    for model in INDEXED_MODELS:
+        model.ensure_indexes()
+        click.echo(f'{model._get_collection_name()}: {", ".join(sorted(model._get_collection().index_information()))}')
+
+
+@app.cli.command('migrate-comments')
+@with_db
+def migrate_comments():
+    """
+    Move the comments embedded in post documents into CommentBucket documents of COMMENT_BUCKET_SIZE comments
+    Every post is migrated on its own, its buckets are written before its comments are removed so the command can be
+    re-run after an interruption; the comments are merged into the buckets the API may already have opened for the
+    post, they are older than the comments found there
+    Buckets written before they were numbered get their bucket_no first, in the order they were created, so the unique
+    index on it can be built
+    """
+    # not through the model, which would build the unique index before the buckets are numbered
+    unnumbered = get_db()[CommentBucket._get_collection_name()]
+    for post_id in unnumbered.distinct('post', {'bucket_no': {'$exists': False}}):
+        ids = [bucket['_id'] for bucket in unnumbered.find({'post': post_id}, {'_id': 1}).sort('_id', 1)]
+        unnumbered.bulk_write([UpdateOne({'_id': id}, {'$set': {'bucket_no': i}}) for i, id in enumerate(ids)])
+
+    posts = Post._get_collection()
+    buckets = CommentBucket._get_collection()
+    migrated = 0
+
+    for post in posts.find({'comments': {'$exists': True}}, {'comments': 1, 'comment_count': 1}):
+        comments = post['comments'] or []
+        embedded = {comment['_id'] for comment in comments}
+        stored = {comment['_id'] for bucket in buckets.find({'post': post['_id']}, {'comments._id': 1})
+                  for comment in bucket.get('comments', [])}
+        # the embedded comments are the oldest, they take positions 0 to len(comments) - 1 as long as comment_count
+        # counted them when comments were first written to buckets, the newer ones then come after them
+        counted = min(len(comments), max(0, post.get('comment_count', 0) - len(stored - embedded)))
+        for i in range(0, len(comments), COMMENT_BUCKET_SIZE):
+            chunk = comments[i:i + COMMENT_BUCKET_SIZE]
+            if chunk[0]['_id'] in stored:
+                continue  # written before an interruption, a chunk is pushed at once
+            query = {'post': post['_id'], 'bucket_no': i // COMMENT_BUCKET_SIZE}
+            # before the comments added to the bucket since, merged rather than replaced
+            update = {'$push': {'comments': {'$each': chunk, '$position': 0}}, '$inc': {'count': len(chunk)}}
+            try:
+                buckets.update_one(query, update, upsert=True)
+            except DuplicateKeyError:  # a new comment opened the bucket first
+                buckets.update_one(query, update, upsert=True)
+        # the counter keeps the comments added to buckets since, it only gains the embedded ones it missed
+        posts.update_one({'_id': post['_id']},
+                         {'$unset': {'comments': ''}, '$inc': {'comment_count': len(comments) - counted}})
+        migrated += 1
+
+    click.echo(f'Posts migrated: {migrated}')
+
+
+@app.cli.command('migrate-timelines')
+@with_db
+def migrate_timelines():
+    """
+    Copy the created_time of the posts into the timeline entries written before the feeds were ordered by it
+    Only the entries without a created_time are touched so the command can be re-run, the entries of posts that no
+    longer exist are removed
+    """
+    timelines = TimelineEntry._get_collection()
+    posts = Post._get_collection()
+    pending = timelines.aggregate([{'$match': {'created_time': {'$exists': False}}}, {'$group': {'_id': '$post'}}],
+                                  allowDiskUse=True)
+    migrated = 0
+
+    def write(post_ids):
+        created = {post['_id']: post['created_time']
+                   for post in posts.find({'_id': {'$in': post_ids}}, {'created_time': 1})}
+        timelines.bulk_write([UpdateMany({'post': id, 'created_time': {'$exists': False}},
+                                         {'$set': {'created_time': created[id]}}) if id in created
+                              else DeleteMany({'post': id}) for id in post_ids], ordered=False)
+        return len(post_ids)
+
+    batch = []
+    for group in pending:
+        batch.append(group['_id'])
+        if len(batch) >= MIGRATION_BATCH_SIZE:
+            migrated += write(batch)
+            batch = []
+    if batch:
+        migrated += write(batch)
+
+    click.echo(f'Posts migrated: {migrated}')
+
+
+@app.cli.command('seed')
+@click.option('--tier', type=click.Choice(list(SCALE_TIERS)), help='volumes of a scale tier, 1x is about production')
+@click.option('--users', type=int, help='number of users [default: 1000]')
+@click.option('--posts', type=int, help='number of posts [default: 10000]')
+@click.option('--likes', type=int, help='number of likes [default: 50000]')
+@click.option('--comments', type=int, help='number of comments [default: 20000]')
+@click.option('--follows', type=int, help='number of follow edges [default: 20000]')
+@click.option('--random-seed', default=0, help='the same seed writes the same documents')
+@click.option('--follow-skew', default=1.0, help='Zipf exponent of the follower counts, 0 spreads the follows evenly')
+@click.option('--post-skew', default=1.0, help='Zipf exponent of the likes and comments of posts, 0 spreads them')
+@with_db
+def seed(tier, random_seed, follow_skew, post_skew, **volumes):
+    """
+    Add a synthetic dataset to the database, for local benchmarks, never run it against production
+    The volumes given override those of --tier, or the defaults without it
+    Seeded users log in with user<id>@example.com and password123
+    """
+    defaults = SCALE_TIERS[tier] if tier else SEED_VOLUMES
+    volumes = {name: defaults[name] if count is None else count for name, count in volumes.items()}
+    summary = seed_data(**volumes, random_seed=random_seed, follow_skew=follow_skew, post_skew=post_skew)
+    for name in ('users', 'posts', 'likes', 'comments', 'follows', 'timeline_entries', 'comment_buckets'):
+        click.echo(f'{name}: {summary[name]}')
+    click.echo(f'most followed users: {", ".join(map(str, summary["most_followed_ids"]))}')
+    click.echo(f'hottest posts: {", ".join(map(str, summary["hot_post_ids"]))}')
+
+
+@app.cli.command('rescale-trending')
+@click.option('--epoch', required=True, type=click.DateTime(formats=['%Y-%m-%d']), help='new TRENDING_EPOCH')
+@with_db
+def rescale_trending(epoch):
+    """
+    Move TRENDING_EPOCH forward before the stored trend scores outgrow the float range
+    Every trend_score is divided by 2 ** (half-lives between the two epochs), restart the app with TRENDING_EPOCH set
+    to the new epoch right after, interactions written in between are weighed against the old epoch
+    """
+    shift = decay_exponent(epoch)
+    if shift <= 0:
+        raise click.BadParameter('the new epoch must be after the current one', param_hint='--epoch')
+    with localcontext(DECIMAL128_CONTEXT):
+        factor = Decimal128(Decimal(2) ** Decimal(-shift))
+    result = Post._get_collection().update_many({'trend_score': {'$nin': [0, None]}}, {'$mul': {'trend_score': factor}})
+    # what the likes added is taken back by their unlikes, it moves to the new scale with the scores
+    Post._get_collection().update_many({'like_scores': {'$exists': True}}, [{'$set': {'like_scores': {'$arrayToObject': {
+        '$map': {'input': {'$objectToArray': '$like_scores'},
+                 'in': {'k': '$$this.k', 'v': {'$multiply': ['$$this.v', factor]}}}}}}}])
+    click.echo(f'Posts: {result.modified_count} rescaled, set TRENDING_EPOCH={epoch.date().isoformat()}')
@@ -0,0 +1,144 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional, zstd is not offered without it
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # optional, br is not offered without it
+    brotli = None
+
+ENCODINGS = ('zstd', 'br', 'gzip')  # content encodings supported, preferred first
+
+# route class of project.views.route_class -> level of every encoding, see benchmarks/bench_compression.py
+# pages of listings and searches (100 posts at most) are small enough for the levels with the best ratio that still
+# take about a millisecond, write responses are rarely over the threshold and get the fastest levels, an export is
+# compressed while it is sent and must keep up with the cursor: the fastest levels but zstd 3, as fast as zstd 1
+COMPRESSION_LEVELS = {
+    'read': {'zstd': 3, 'br': 4, 'gzip': 6},
+    'write': {'zstd': 1, 'br': 1, 'gzip': 1},
+    'scan': {'zstd': 6, 'br': 5, 'gzip': 6},
+    'export': {'zstd': 3, 'br': 1, 'gzip': 1},
+}
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'application/msgpack'}  # and every text/*
+STREAM_FLUSH_BYTES = 16 * 1024  # a streamed body is compressed and flushed to the client by buffers of this size
+
+
+def available_encodings(encodings):
+    """
+    :param encodings: content encodings in order of preference, e.g. ('zstd', 'br', 'gzip')
+    :return: the encodings whose compressor is installed, in the same order
+    """
+    installed = {'zstd': zstandard is not None, 'br': brotli is not None, 'gzip': True}
+    return tuple(encoding for encoding in encodings if installed.get(encoding))
+
+
+def negotiate(accept_encodings, encodings):
+    """
+    :param accept_encodings: werkzeug Accept of the Accept-Encoding header of the request
+    :param encodings: encodings the server offers in order of preference, which breaks ties between equal qualities
+    :return: the encoding to compress with, None to send the body as it is
+    """
+    return accept_encodings.best_match(encodings)
+
+
+def compressible(response, method):
+    """
+    :return: True if the body of the response may be compressed: a successful response with a body of a text or
+             structured type, not compressed yet
+    """
+    if method == 'HEAD' or not 200 <= response.status_code < 300 or response.status_code == 204:
+        return False
+    if 'Content-Encoding' in response.headers:
+        return False
+    return response.mimetype in COMPRESSIBLE_MIMETYPES or response.mimetype.startswith('text/')
+
+
+class StreamCompressor:
+    """
+    Incremental compressor of one response body in one of the content encodings
+    """
+
+    def __init__(self, encoding, level):
+        """
+        :param encoding: zstd, br or gzip
+        :param level: level of the encoding, see COMPRESSION_LEVELS
+        """
+        self.encoding = encoding
+        if encoding == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        elif encoding == 'br':
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: with the gzip header and trailer
+
+    def compress(self, data, flush=False):
+        """
+        :param flush: also return what the compressor holds back, so the client can decode everything sent so far
+        :return: compressed bytes, possibly empty while the compressor fills a block
+        """
+        if self.encoding == 'br':
+            compressed = self._compressor.process(data)
+            return compressed + self._compressor.flush() if flush else compressed
+        compressed = self._compressor.compress(data)
+        if flush:
+            mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK if self.encoding == 'zstd' else zlib.Z_SYNC_FLUSH
+            compressed += self._compressor.flush(mode)
+        return compressed
+
+    def finish(self):
+        """
+        :return: the end of the compressed body, the compressor cannot be used afterwards
+        """
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+    def compress_body(self, data):
+        """
+        :return: data compressed as a whole body
+        """
+        return self.compress(data) + self.finish()
+
+
+def _encode(chunk):
+    return chunk.encode() if isinstance(chunk, str) else chunk
+
+
+def compress_stream(chunks, compressor, flush_bytes=STREAM_FLUSH_BYTES):
+    """
+    Compress a streamed body as it is sent, every flush_bytes of it are compressed and flushed to the client
+    :param chunks: iterable of the body, str or bytes, closed with the returned generator
+    :return: generator of the compressed body
+    """
+    try:
+        pending, size = [], 0
+        for chunk in chunks:
+            pending.append(_encode(chunk))
+            size += len(pending[-1])
+            if size >= flush_bytes:
+                # whole buffers rather than every chunk, a line of an export is too short to be compressed alone
+                yield compressor.compress(b''.join(pending), flush=True)
+                pending, size = [], 0
+        yield compressor.compress(b''.join(pending)) + compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()  # e.g. releases the database cursor of a client that went away
+
+
+async def compress_stream_async(body, compressor, flush_bytes=STREAM_FLUSH_BYTES):
+    """
+    compress_stream for the body of a Quart response
+    :param body: quart ResponseBody, entered and exited here
+    """
+    pending, size = [], 0
+    async with body as chunks:
+        async for chunk in chunks:
+            pending.append(_encode(chunk))
+            size += len(pending[-1])
+            if size >= flush_bytes:
+                yield compressor.compress(b''.join(pending), flush=True)
+                pending, size = [], 0
+    yield compressor.compress(b''.join(pending)) + compressor.finish()
@@ -0,0 +1,146 @@
+import datetime
+
+from flask import request, has_request_context
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library encoder is used without it
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional, clients asking for MessagePack get json without it
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+# representations a client may ask for with Accept, json first so that */* or no Accept header gets json
+REPRESENTATIONS = ('application/json', MSGPACK_MIMETYPE, 'application/x-msgpack')
+
+DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+EPOCH = datetime.datetime(1970, 1, 1)  # naive datetimes are UTC
+UTC_EPOCH = EPOCH.replace(tzinfo=datetime.timezone.utc)
+
+
+def http_date(value):
+    """
+    Same output as werkzeug.http.http_date for a datetime, e.g. Wed, 18 Oct 2023 09:30:00 GMT, without the detour
+    through email.utils, a naive datetime is taken as UTC
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return f'{DAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} {value.year:04d} ' \
+           f'{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT'
+
+
+def wants_msgpack(accept_mimetypes):
+    """
+    :param accept_mimetypes: werkzeug MIMEAccept of the request
+    :return: True if the client prefers MessagePack to json and msgpack is installed
+    """
+    return msgpack is not None and accept_mimetypes.best_match(REPRESENTATIONS) in REPRESENTATIONS[1:]
+
+
+def unpack(data):
+    """
+    :param data: MessagePack body of a response
+    :return: the object encoded in the body, timestamps as aware datetimes
+    """
+    return msgpack.unpackb(data, timestamp=3)
+
+
+class FastJSONMixin:
+    """
+    Encoding shared by the JSON providers of both editions of the API
+    * json goes through orjson when it is installed, with the content the default provider writes: sorted keys and
+      datetimes as HTTP dates, or as ISO 8601 written by orjson itself with JSON_ISO_DATES
+    * a client preferring application/msgpack in its Accept header gets the same object in MessagePack, datetimes as
+      MessagePack timestamps
+    """
+
+    def accept_mimetypes(self):
+        """
+        Overridden by each edition with the request object of its framework, a provider which does not see the request
+        always answers json
+        :return: MIMEAccept of the current request, None outside of a request
+        """
+        return None
+
+    def _orjson_option(self, kwargs):
+        """
+        :param kwargs: json.dumps keyword arguments
+        :return: orjson option writing the same json, None if orjson is missing or cannot honour kwargs
+        """
+        if orjson is None or not kwargs.keys() <= {'indent', 'separators'} or kwargs.get('indent') not in (None, 2):
+            return None
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        if self._app.config['JSON_ISO_DATES']:
+            option |= orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+        else:
+            option |= orjson.OPT_PASSTHROUGH_DATETIME  # datetimes reach _default and become HTTP dates
+        return option
+
+    def _default(self, value):
+        if isinstance(value, datetime.datetime):
+            return http_date(value)
+        return self.default(value)
+
+    def _msgpack_default(self, value):
+        if isinstance(value, datetime.datetime):
+            # exact to the microsecond and faster than Timestamp.from_datetime, which goes through a float
+            delta = value - (EPOCH if value.tzinfo is None else UTC_EPOCH)
+            return msgpack.Timestamp(delta.days * 86400 + delta.seconds, delta.microseconds * 1000)
+        return self.default(value)
+
+    def encode(self, obj, mimetype='application/json', **kwargs):
+        """
+        :param mimetype: application/json or MSGPACK_MIMETYPE
+        :param kwargs: json.dumps keyword arguments
+        :return: obj encoded as bytes
+        """
+        if mimetype == MSGPACK_MIMETYPE:
+            return msgpack.packb(obj, default=self._msgpack_default)
+        option = self._orjson_option(kwargs)
+        if option is not None:
+            try:
+                return orjson.dumps(obj, default=self._default, option=option)
+            except orjson.JSONEncodeError:
+                pass  # e.g. an integer over 64 bits, the standard library writes it or raises the usual error
+        return super().dumps(obj, **kwargs).encode()
+
+    def dumps(self, obj, **kwargs):
+        return self.encode(obj, **kwargs).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """
+        Response of jsonify, in the representation the client prefers, json by default
+        """
+        obj = self._prepare_response_obj(args, kwargs)
+        accept = self.accept_mimetypes()
+        if accept is not None and wants_msgpack(accept):
+            response = self._app.response_class(self.encode(obj, MSGPACK_MIMETYPE), mimetype=MSGPACK_MIMETYPE)
+        else:
+            indent = (self.compact is None and self._app.debug) or self.compact is False
+            response = self._app.response_class(self.encode(obj, **({'indent': 2} if indent else {})) + b'\n',
+                                                mimetype=self.mimetype)
+        response.vary.add('Accept')
+        return response
+
+
+class FastJSONProvider(FastJSONMixin, DefaultJSONProvider):
+    """
+    JSON provider of the flask app, see FastJSONMixin
+    """
+
+    def accept_mimetypes(self):
+        return request.accept_mimetypes if has_request_context() else None
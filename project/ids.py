@@ -0,0 +1,99 @@
+import os
+import threading
+
+from mongoengine.connection import get_db
+from mongoengine.fields import SequenceField
+from pymongo import ReturnDocument
+
+from . import db
+
+
+class IdBlockAllocator:
+    """
+    Hands out ids from blocks reserved on a counter (hi/lo), one round trip reserves block_size ids for the process
+    the next block is reserved by a background thread once less than a quarter of the current one is left, so takes
+    only wait on the database if ids are used faster than a block can be reserved
+    ids are increasing within a process, across processes they follow the order their blocks were reserved in
+    """
+
+    def __init__(self, reserve, block_size):
+        """
+        :param reserve: function reserving n ids on the counter, returns the last one
+        :param block_size: function returning the number of ids reserved at a time
+        """
+        self._reserve = reserve
+        self._block_size = block_size
+        self._reset()
+        # a forked process must not hand out the ids of its parent, nor wait on a lock or a thread of the parent
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._next, self._end = 1, 0  # ids left in the current block, none until the first take
+        self._refill = None  # (thread, result) reserving the next block
+
+    def _reserve_block(self):
+        size = self._block_size()
+        end = self._reserve(size)
+        return end - size + 1, end
+
+    def _start_refill(self):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self._reserve_block()), daemon=True)
+        thread.start()
+        self._refill = (thread, result)
+
+    def take(self, wait=True):
+        """
+        :param wait: if False, return None instead of waiting for a block to be reserved
+        :return: the next id
+        """
+        with self._lock:
+            if self._next > self._end:
+                if self._refill:
+                    thread, result = self._refill
+                    if not wait and thread.is_alive():
+                        return None
+                    thread.join()
+                    self._refill = None
+                    # a refill that failed is retried here so the error reaches the caller
+                    block = result[0] if result else self._reserve_block()
+                elif not wait:
+                    return None
+                else:
+                    block = self._reserve_block()
+                self._next, self._end = block
+
+            id = self._next
+            self._next += 1
+            if self._refill is None and self._end - self._next + 1 < self._block_size() // 4:
+                self._start_refill()
+            return id
+
+
+class BlockSequenceField(SequenceField):
+    """
+    SequenceField taking its values from blocks of ID_BLOCK_SIZE ids reserved on the same counter document, so that
+    creating a document does not cost a findAndModify on a counter shared by every process
+    values stay compatible with SequenceField, the counter always holds the last id handed out to a process
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.allocator = IdBlockAllocator(self.reserve, lambda: db.app.config['ID_BLOCK_SIZE'])
+
+    def reserve(self, size):
+        """
+        Move the counter forward by size
+        :return: last id of the reserved block
+        """
+        counter = get_db(alias=self.db_alias)[self.collection_name].find_one_and_update(
+            filter={'_id': f'{self.get_sequence_name()}.{self.name}'},
+            update={'$inc': {'next': size}},
+            return_document=ReturnDocument.AFTER,
+            upsert=True,
+        )
+        return counter['next']
+
+    def generate(self):
+        return self.value_decorator(self.allocator.take())
@@ -1,15 +1,47 @@
 import datetime
 
 from . import db
+from .ids import BlockSequenceField
+
+COMMENT_BUCKET_SIZE = 50  # comments stored per CommentBucket
 
 
 class User(db.Document):
-    id = db.SequenceField(primary_key=True)
+    id = BlockSequenceField(primary_key=True)  # taken from blocks of ID_BLOCK_SIZE ids reserved by the process
     name = db.StringField(required=True)
     email = db.StringField(required=True)
     password = db.StringField(required=True)
-    followers = db.ListField(db.ReferenceField('User'))
-    following = db.ListField(db.ReferenceField('User'))
+    # number of Follow edges pointing to / from the user, changed with $inc whenever an edge is added or removed
+    follower_count = db.IntField(default=0)
+    following_count = db.IntField(default=0)
+    # set once a post of the user skipped fan-out, their posts are merged into feeds on read from then on, even after
+    # their follower_count drops back below FEED_FANOUT_LIMIT
+    fanout_skipped = db.BooleanField(default=False)
+
+    meta = {
+        # every login and every authenticated request looks the user up by email
+        'indexes': [{'fields': ['email'], 'unique': True}],
+        # users that still carry the old embedded followers / following lists load until `flask migrate-follows` runs
+        'strict': False,
+    }
+
+
+class Follow(db.Document):
+    """
+    Edge of the follow graph, follower follows followee
+    """
+    follower = db.ReferenceField(User, required=True)
+    followee = db.ReferenceField(User, required=True)
+    created_at = db.DateTimeField(default=datetime.datetime.utcnow)
+
+    meta = {
+        'indexes': [
+            # one edge per pair, also serves the following list of a user ordered by followee
+            {'fields': ['follower', 'followee'], 'unique': True},
+            # followers list of a user ordered by follower
+            {'fields': ['followee', 'follower'], 'unique': True},
+        ]
+    }
 
 
 class Comment(db.EmbeddedDocument):
@@ -19,11 +51,75 @@ class Comment(db.EmbeddedDocument):
 
 
 class Post(db.Document):
-    id = db.SequenceField(primary_key=True)
+    # ids follow the blocks of the processes, not the creation order: listings are ordered by (created_time, id)
+    id = BlockSequenceField(primary_key=True)
     title = db.StringField(required=True)
     description = db.StringField(required=True)
     likes = db.ListField(db.ReferenceField(User))
-    created_time = db.DateTimeField(default = datetime.datetime.utcnow())
-    comments = db.ListField(db.EmbeddedDocumentField(Comment))
+    created_time = db.DateTimeField(default=datetime.datetime.utcnow)
     author = db.ReferenceField(User)
+    # denormalized len(likes), changed with $inc in the same update as the list
+    like_count = db.IntField(default=0)
+    # number of comments in the CommentBucket documents of the post
+    comment_count = db.IntField(default=0)
+    # time-decayed likes and comments, changed with $inc by the like, unlike and comment writes (see project.trending),
+    # absent until the first of them
+    trend_score = db.Decimal128Field()
+    # str(user id) -> what the like of the user added to trend_score, taken back by the unlike
+    like_scores = db.MapField(db.Decimal128Field())
+
+    meta = {
+        'indexes': [
+            # posts of an author newest first, also read at feed time in the order of the timelines they merge with
+            {'fields': ['author', '-created_time', '-id']},
+            # /api/all_posts and its export, in creation order
+            {'fields': ['created_time', 'id']},
+            # /api/search, words of the title weigh more than words of the description
+            {'fields': ['$title', '$description'], 'default_language': 'english',
+             'weights': {'title': 3, 'description': 1}},
+            # /api/trending, the highest scores are read from the start of the index
+            {'fields': ['-trend_score']},
+        ],
+        # posts that still embed their comments load until `flask migrate-comments` runs
+        'strict': False,
+    }
+
+
+class TimelineEntry(db.Document):
+    """
+    A post in the home feed of owner, written by create_post for every follower of the author
+    """
+    owner = db.ReferenceField(User, required=True)
+    post = db.ReferenceField(Post, required=True)
+    author = db.ReferenceField(User, required=True)
+    # created_time of the post, feeds are ordered by it as ids taken from blocks do not follow the creation order
+    created_time = db.DateTimeField()
+
+    meta = {
+        'indexes': [
+            # feed of a user, newest post first, a post once per feed as its created_time never changes
+            {'fields': ['owner', '-created_time', '-post'], 'unique': True},
+            # removing a deleted post from every feed
+            {'fields': ['post']},
+            # removing an unfollowed author from a feed
+            {'fields': ['owner', 'author']},
+        ]
+    }
+
+
+class CommentBucket(db.Document):
+    """
+    Up to COMMENT_BUCKET_SIZE comments of a post in the order they were written, a post has as many buckets as needed
+    """
+    post = db.ReferenceField(Post, required=True)
+    # the bucket holding the comments of position bucket_no * COMMENT_BUCKET_SIZE and up, numbered by comment_count
+    bucket_no = db.IntField(required=True)
+    count = db.IntField(default=0)
+    comments = db.ListField(db.EmbeddedDocumentField(Comment))
 
+    meta = {
+        'indexes': [
+            # buckets of a post, newest first, unique so that concurrent comments never open the same bucket twice
+            {'fields': ['post', '-bucket_no'], 'unique': True},
+        ]
+    }
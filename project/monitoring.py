@@ -0,0 +1,311 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from pymongo import monitoring
+
+from .encoding import FastJSONProvider
+
+logger = logging.getLogger(__name__)
+
+RUNNING_COMMAND_TIMEOUT = 600  # seconds a started command is waited for before the slow command log forgets it
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Counts the database commands started by each thread and the time they took
+    PyMongo calls the listener from the thread that runs the command, so a request served by one thread can read how many
+    round trips it made from `count` and how long it waited on them from `duration`
+    commands slower than slow_ms are logged with the shape of their filter, the values replaced by '?'
+    """
+
+    def __init__(self, slow_ms=None, clock=time.monotonic):
+        self._local = threading.local()
+        self.slow_ms = slow_ms
+        self.slow_commands = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        # request id -> (start time, command), oldest first, kept until it finishes to log it if it was slow
+        self._running = OrderedDict()
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    @property
+    def duration(self):
+        """
+        :return: seconds spent in the commands of the thread
+        """
+        return getattr(self._local, 'duration', 0.0)
+
+    @contextmanager
+    def recording(self):
+        """
+        Keep the commands started by the thread while the block runs, e.g. to explain the queries of a request
+        :return: list the CommandStartedEvent of every command is appended to
+        """
+        self._local.recorded = recorded = []
+        try:
+            yield recorded
+        finally:
+            self._local.recorded = None
+
+    def started(self, event):
+        self._local.count = self.count + 1
+        recorded = getattr(self._local, 'recorded', None)
+        if recorded is not None:
+            recorded.append(event)
+        if self.slow_ms is not None:
+            now = self._clock()
+            with self._lock:
+                self._running[event.request_id] = (now, event.command)
+                # a command whose reply was never reported, e.g. lost with its connection, is forgotten after a while
+                while now - next(iter(self._running.values()))[0] > RUNNING_COMMAND_TIMEOUT:
+                    self._running.popitem(last=False)
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        self._local.duration = self.duration + event.duration_micros / 1e6
+        with self._lock:
+            command = self._running.pop(event.request_id, (None, None))[1]
+        if command is not None and event.duration_micros >= self.slow_ms * 1000:
+            self.slow_commands += 1
+            logger.warning('slow %s on %s took %.1f ms: %s', event.command_name, command.get(event.command_name),
+                           event.duration_micros / 1000,
+                           json.dumps(command_shape(event.command_name, command), default=str))
+
+
+# field holding the filter of each command, the shape of what they look up is logged when they are slow
+SHAPE_FIELDS = {'find': 'filter', 'count': 'query', 'distinct': 'query', 'findAndModify': 'query',
+                'aggregate': 'pipeline', 'update': 'updates', 'delete': 'deletes'}
+
+
+def query_shape(value):
+    """
+    Replace the values of a filter by '?', keys and operators are kept and an array keeps the shape of its first item
+    """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [query_shape(item) for item in value[:1]]
+    return '?'
+
+
+def command_shape(name, command):
+    """
+    :param name: command name, e.g. find
+    :param command: command document sent to the server
+    :return: shape of the filter of the command, of every stage of an aggregation, None for other commands
+    """
+    field = SHAPE_FIELDS.get(name)
+    if field is None:
+        return None
+    value = command.get(field)
+    if name == 'aggregate':
+        return [{stage: query_shape(spec) for stage, spec in step.items()} for step in value or []]
+    if name in ('update', 'delete'):
+        return query_shape(value[0].get('q')) if value else None
+    return query_shape(value)
+
+
+command_counter = CommandCounter()
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Connection pool statistics of the worker process
+    the time a thread waits between asking the pool for a connection and getting one is measured per checkout,
+    a wait growing with load means maxPoolSize is too small for the number of threads of the worker
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Start counting from zero, a forked worker does not report the checkouts of its parent
+        """
+        with self._lock:
+            self.open = 0  # connections currently open
+            self.in_use = 0  # connections currently checked out
+            self.waiting = 0  # threads currently waiting for a connection
+            self.max_in_use = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.checkout_timeouts = 0
+            self.wait_total = 0.0  # seconds spent waiting for a connection by all checkouts
+            self.wait_max = 0.0
+
+    def stats(self):
+        """
+        :return: dict of the counters, waits in milliseconds
+        """
+        with self._lock:
+            return {
+                'open': self.open,
+                'in_use': self.in_use,
+                'waiting': self.waiting,
+                'max_in_use': self.max_in_use,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'checkout_timeouts': self.checkout_timeouts,
+                'wait_avg_ms': round(self.wait_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+            }
+
+    def connection_check_out_started(self, event):
+        # events are delivered in the thread asking for the connection
+        self._local.started = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+
+    def connection_checked_out(self, event):
+        wait = time.perf_counter() - getattr(self._local, 'started', time.perf_counter())
+        with self._lock:
+            self.waiting -= 1
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.waiting -= 1
+            self.checkout_failures += 1
+            if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+                self.checkout_timeouts += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+pool_monitor = PoolMonitor()
+
+
+class TimedJSONProvider(FastJSONProvider):
+    """
+    JSON provider adding the time spent encoding, json or MessagePack, to the request, reported next to the database
+    time
+    """
+
+    def encode(self, obj, mimetype='application/json', **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().encode(obj, mimetype, **kwargs)
+        finally:
+            if has_app_context():
+                g.json_time = g.get('json_time', 0.0) + time.perf_counter() - start
+
+
+# upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RequestMetrics:
+    """
+    Latency histograms per endpoint, method and status and database commands and time per endpoint of the worker
+    process, rendered in the Prometheus text format
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._latency = {}  # (endpoint, method, status) -> [count per bucket..., count, sum]
+        self._db_commands = defaultdict(int)  # endpoint -> commands
+        self._db_seconds = defaultdict(float)  # endpoint -> seconds
+
+    def observe(self, endpoint, method, status, seconds, commands=None, db_seconds=None):
+        """
+        :param commands: database commands of the request, None when they cannot be told apart from those of the
+                         requests served at the same time, as on the event loop of the async edition
+        """
+        with self._lock:
+            series = self._latency.get((endpoint, method, status))
+            if series is None:
+                series = self._latency[(endpoint, method, status)] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += seconds
+            if commands is not None:
+                self._db_commands[endpoint] += commands
+                self._db_seconds[endpoint] += db_seconds
+
+    def render(self, gauges=(), counters=()):
+        """
+        :param gauges: (name, help, value) of extra gauges to export, the name may carry labels, e.g. name{a="b"}
+        :param counters: (name, help, value) of extra counters, values that only grow, named with a _total suffix
+        :return: metrics in the Prometheus text exposition format
+        """
+        lines = ['# HELP http_request_duration_seconds Latency of the requests served by this worker',
+                 '# TYPE http_request_duration_seconds histogram']
+        with self._lock:
+            for (endpoint, method, status), series in sorted(self._latency.items()):
+                labels = f'endpoint="{label_value(endpoint)}",method="{method}",status="{status}"'
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {series[-2]}')
+                lines.append(f'http_request_duration_seconds_count{{{labels}}} {series[-2]}')
+                lines.append(f'http_request_duration_seconds_sum{{{labels}}} {series[-1]:.6f}')
+            lines += ['# HELP http_request_db_commands_total Database commands sent by the requests',
+                      '# TYPE http_request_db_commands_total counter']
+            lines += [f'http_request_db_commands_total{{endpoint="{label_value(endpoint)}"}} {count}'
+                      for endpoint, count in sorted(self._db_commands.items())]
+            lines += ['# HELP http_request_db_seconds_total Time the requests spent waiting on database commands',
+                      '# TYPE http_request_db_seconds_total counter']
+            lines += [f'http_request_db_seconds_total{{endpoint="{label_value(endpoint)}"}} {seconds:.6f}'
+                      for endpoint, seconds in sorted(self._db_seconds.items())]
+        described = set()
+        for kind, metrics in (('gauge', gauges), ('counter', counters)):
+            for name, help, value in metrics:
+                family = name.split('{', 1)[0]  # metrics of one family differ by their labels, described once
+                if family not in described:
+                    lines += [f'# HELP {family} {help}', f'# TYPE {family} {kind}']
+                    described.add(family)
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
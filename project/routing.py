@@ -0,0 +1,55 @@
+import time
+from functools import lru_cache
+
+from bson import Timestamp
+from itsdangerous import BadSignature
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+
+READ_PREFERENCES = {'primary': Primary, 'primaryPreferred': PrimaryPreferred, 'secondary': Secondary,
+                    'secondaryPreferred': SecondaryPreferred, 'nearest': Nearest}
+READ_AFTER_COOKIE = 'read_after'  # operation time of the last post or comment written by the client
+
+
+@lru_cache(maxsize=None)
+def read_preference(mode, max_staleness=-1):
+    """
+    :param mode: name of a read preference, e.g. secondaryPreferred
+    :param max_staleness: seconds a secondary may lag behind the primary and still be read, -1 for no bound,
+                          PyMongo refuses bounds under 90 seconds
+    :return: pymongo read preference
+    :raises ValueError: if mode is not a read preference
+    """
+    if mode not in READ_PREFERENCES:
+        raise ValueError(f'unknown read preference {mode}, expected one of {", ".join(READ_PREFERENCES)}')
+    if mode == 'primary':
+        return Primary()
+    return READ_PREFERENCES[mode](max_staleness=max_staleness)
+
+
+def dump_read_after(serializer, operation_time):
+    """
+    :param serializer: itsdangerous serializer signing the value so a client cannot make its reads wait on a time
+                       the cluster has not reached
+    :param operation_time: bson Timestamp of a write
+    :return: value of the read_after cookie
+    """
+    return serializer.dumps([operation_time.time, operation_time.inc])
+
+
+def load_read_after(serializer, value, window, clock=time.time):
+    """
+    :param value: value of the read_after cookie, None if the client sent none
+    :param window: seconds during which the client reads its own writes on the primary
+    :return: the operation time of the write as a bson Timestamp, None if the cookie is missing, invalid or the write
+             is older than window seconds
+    """
+    if not value:
+        return None
+    try:
+        seconds, inc = serializer.loads(value)
+        operation_time = Timestamp(seconds, inc)
+    except (BadSignature, TypeError, ValueError):
+        return None
+    if operation_time.time < clock() - window:
+        return None
+    return operation_time
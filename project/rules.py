@@ -0,0 +1,20 @@
+from werkzeug.routing import Rule
+
+
+class LazyBuilderRule(Rule):
+    """
+    URL rule compiling its url_for builders on their first use rather than when the route is registered
+    Werkzeug generates and compiles python source for the two builders of every rule, which is most of the time spent
+    importing the views; matching requests never uses them and the API builds no url
+    overrides the private Rule._compile_builder of the Werkzeug pinned in requirements.txt, test_startup fails if its
+    signature or the way Rule.compile installs the builders changes
+    """
+
+    def _compile_builder(self, append_unknown=True):
+        def build(rule, *args, **kwargs):
+            builder = Rule._compile_builder(rule, append_unknown).__get__(rule, None)
+            # replaces this stub on the rule, see Rule.compile
+            setattr(rule, '_build_unknown' if append_unknown else '_build', builder)
+            return builder(*args, **kwargs)
+
+        return build
@@ -0,0 +1,189 @@
+import datetime
+import heapq
+import itertools
+import random
+import uuid
+from collections import Counter, defaultdict
+
+from mongoengine.connection import get_db
+
+from project.models import User, Post, Follow, TimelineEntry, CommentBucket, COMMENT_BUCKET_SIZE
+from project.trending import trend_increment, LIKE_WEIGHT, COMMENT_WEIGHT
+from . import db
+
+SEED_BATCH_SIZE = 1000  # documents written per insert_many
+SEED_PASSWORD = 'password123'  # password of every seeded user
+SEED_DRAW_SIZE = 100000  # popularity draws counted at a time
+SEED_MAX_LIKES = 200000  # likes of a post, its likers are stored in its document which must stay under 16MB
+SEED_HOT_SIZE = 10  # most followed users and hottest posts listed in the summary of a seed
+
+# volumes written by `flask seed --tier` and by the scale fixtures of project/tests/conftest.py, 1x is an estimate of
+# the production database; small seeds in seconds, 100x writes tens of millions of documents
+PRODUCTION_VOLUMES = {'users': 10000, 'posts': 50000, 'likes': 250000, 'comments': 100000, 'follows': 200000}
+SCALE_TIERS = {
+    'small': {'users': 200, 'posts': 1000, 'likes': 5000, 'comments': 3000, 'follows': 4000},
+    **{f'{factor}x': {name: count * factor for name, count in PRODUCTION_VOLUMES.items()} for factor in (1, 10, 100)},
+}
+
+
+def reserve_ids(model, count):
+    """
+    Reserve count consecutive ids on the counter of a model so seeded documents never collide with created ones
+    :return: range of the reserved ids
+    """
+    if not count:
+        return range(0)
+    end = model.id.reserve(count)
+    return range(end - count + 1, end + 1)
+
+
+def insert(model, documents):
+    """
+    Write documents with insert_many in batches of SEED_BATCH_SIZE
+    the collection is not reached through the model, which would build its indexes first: an empty collection loaded
+    then indexed once is written faster than one updating every index on every insert, seed builds them at the end
+    :param documents: iterable of documents, consumed one batch at a time so a generator never sits in memory
+    :return: number of documents written
+    """
+    collection = get_db()[model._get_collection_name()]
+    documents = iter(documents)
+    written = 0
+    while True:
+        batch = list(itertools.islice(documents, SEED_BATCH_SIZE))
+        if not batch:
+            return written
+        collection.insert_many(batch, ordered=False)
+        written += len(batch)
+
+
+def draw_counts(ranked, total, skew, cap, rng):
+    """
+    Spread total draws over items following a Zipf distribution of their rank, the item of rank r weighs 1 / r ** skew
+    :param ranked: items, the first ones get the most draws
+    :param skew: 0 spreads the draws evenly, around 1 a handful of items get a large share, as follower counts and
+                 likes do on a social network
+    :param cap: maximum count of an item, the draws over it are dropped
+    :return: dict item -> count of the items drawn at least once
+    """
+    if not ranked or total <= 0:
+        return {}
+    cum_weights = list(itertools.accumulate(1 / rank ** skew for rank in range(1, len(ranked) + 1)))
+    counts = Counter()
+    for start in range(0, total, SEED_DRAW_SIZE):
+        counts.update(rng.choices(ranked, cum_weights=cum_weights, k=min(SEED_DRAW_SIZE, total - start)))
+    return {item: min(count, cap) for item, count in counts.items()}
+
+
+def sample_ids(ids, count, rng, exclude=None):
+    """
+    :param ids: range of ids
+    :param exclude: id of ids never picked
+    :return: list of count distinct ids of ids picked at random
+    """
+    if exclude is None:
+        return [ids[i] for i in rng.sample(range(len(ids)), count)]
+    skip = ids.index(exclude)
+    return [ids[i + (i >= skip)] for i in rng.sample(range(len(ids) - 1), count)]
+
+
+def seed(users, posts, likes, comments, follows, random_seed=0, follow_skew=1.0, post_skew=1.0):
+    """
+    Write a synthetic social graph with the given volumes, the documents have the shape the API writes: counters match
+    the lists and edges they count and every post is in the timeline of the followers of its author, but for authors
+    with FEED_FANOUT_LIMIT followers or more whose posts are merged into feeds on read
+    follower counts and the likes and comments of posts follow Zipf distributions over a shuffle of the users and the
+    posts: a few celebrities and hot posts with long comment threads take a large share, the other ones little
+    likes and follows are distinct pairs, a user cannot get more followers than there are other users nor a post more
+    likes than there are users (or SEED_MAX_LIKES), the draws over those caps are dropped
+    documents are generated while they are written, memory grows with the number of users and posts only, and the
+    indexes of the models are built once everything is written
+    :param users: number of users, they log in with user<id>@example.com and SEED_PASSWORD
+    :param posts: number of posts, written by random users
+    :param likes: number of likes
+    :param comments: number of comments, stored in buckets of COMMENT_BUCKET_SIZE
+    :param follows: number of follow edges
+    :param random_seed: the same seed on an empty database writes the same documents
+    :param follow_skew: Zipf exponent of the follower counts, 0 spreads the follows evenly
+    :param post_skew: Zipf exponent of the likes and comments of posts, 0 spreads them evenly
+    :return: dict with the ids of the seeded users and posts, the SEED_HOT_SIZE most followed users and hottest posts
+             and the number of documents written per collection
+    """
+    rng = random.Random(random_seed)
+    user_ids = reserve_ids(User, users)
+    post_ids = reserve_ids(Post, posts) if user_ids else range(0)
+    fanout_limit = db.app.config['FEED_FANOUT_LIMIT']
+
+    follower_count = draw_counts(rng.sample(user_ids, len(user_ids)), follows, follow_skew, len(user_ids) - 1, rng)
+    hot_posts = rng.sample(post_ids, len(post_ids))
+    like_count = draw_counts(hot_posts, likes, post_skew, min(len(user_ids), SEED_MAX_LIKES), rng)
+    comment_count = draw_counts(hot_posts, comments, post_skew, comments, rng)
+    authors = {id: rng.choice(user_ids) for id in post_ids}
+    posts_of = defaultdict(list)
+    for id, author in authors.items():
+        posts_of[author].append(id)
+
+    def entity_rng(kind, id):
+        # the documents drawn for one user or post do not depend on the order they are generated in
+        return random.Random(f'{random_seed}:{kind}:{id}')
+
+    def followers_of(user):
+        return sample_ids(user_ids, follower_count.get(user, 0), entity_rng('followers', user), exclude=user)
+
+    now = datetime.datetime.utcnow()
+    created_time = {id: now - datetime.timedelta(seconds=len(post_ids) - i) for i, id in enumerate(post_ids)}
+
+    def post_documents():
+        for id in post_ids:
+            created = created_time[id]
+            liked = sample_ids(user_ids, like_count.get(id, 0), entity_rng('likes', id))
+            commented = comment_count.get(id, 0)
+            yield {'_id': id, 'title': f'Seeded post {id}', 'description': f'Seeded description {id}',
+                   'created_time': created, 'author': authors[id],
+                   'likes': liked, 'like_count': len(liked), 'comment_count': commented,
+                   # as if every interaction happened when the post was created
+                   'trend_score': trend_increment(LIKE_WEIGHT * len(liked) + COMMENT_WEIGHT * commented, created)}
+
+    following_count = defaultdict(int)
+
+    def follow_documents():
+        for followee in follower_count:
+            for follower in followers_of(followee):
+                following_count[follower] += 1
+                yield {'follower': follower, 'followee': followee, 'created_at': now}
+
+    def timeline_documents():
+        for author, written in posts_of.items():
+            if follower_count.get(author, 0) >= fanout_limit:
+                continue
+            followers = followers_of(author)
+            for id in written:
+                for owner in followers:
+                    yield {'owner': owner, 'post': id, 'author': author, 'created_time': created_time[id]}
+
+    def bucket_documents():
+        for id, count in comment_count.items():
+            thread = entity_rng('comments', id)
+            for start in range(0, count, COMMENT_BUCKET_SIZE):
+                stored = [{'_id': str(uuid.UUID(int=thread.getrandbits(128), version=4)),
+                           'user': thread.choice(user_ids), 'text': f'Seeded comment {thread.getrandbits(32):08x}'}
+                          for _ in range(min(COMMENT_BUCKET_SIZE, count - start))]
+                yield {'post': id, 'bucket_no': start // COMMENT_BUCKET_SIZE, 'count': len(stored), 'comments': stored}
+
+    insert(Post, post_documents())
+    follow_edges = insert(Follow, follow_documents())
+    insert(User, ({'_id': id, 'name': f'user{id}', 'email': f'user{id}@example.com', 'password': SEED_PASSWORD,
+                   'follower_count': follower_count.get(id, 0), 'following_count': following_count[id],
+                   'fanout_skipped': follower_count.get(id, 0) >= fanout_limit and id in posts_of}
+                  for id in user_ids))
+    timeline_entries = insert(TimelineEntry, timeline_documents())
+    comment_buckets = insert(CommentBucket, bucket_documents())
+    for model in (User, Post, Follow, TimelineEntry, CommentBucket):
+        model.ensure_indexes()
+
+    return {'user_ids': user_ids, 'post_ids': post_ids,
+            'most_followed_ids': heapq.nlargest(SEED_HOT_SIZE, follower_count, key=follower_count.get),
+            'hot_post_ids': heapq.nlargest(SEED_HOT_SIZE, post_ids,
+                                           key=lambda id: like_count.get(id, 0) + comment_count.get(id, 0)),
+            'users': len(user_ids), 'posts': len(post_ids), 'likes': sum(like_count.values()),
+            'comments': sum(comment_count.values()), 'follows': follow_edges, 'timeline_entries': timeline_entries,
+            'comment_buckets': comment_buckets}
@@ -0,0 +1,34 @@
+from functools import lru_cache
+
+from werkzeug.test import Client
+
+from project.app import app
+
+APP_KINDS = ['wsgi', 'asgi']  # every edition of the API the shared suites run against
+
+# whether a request is shed depends on the latency of the test database, test_admission turns it on where it is tested
+app.config['ADMISSION_ENABLED'] = False
+
+
+@lru_cache(maxsize=None)
+def asgi_app():
+    """
+    The async edition wrapped as a WSGI callable, built once so every test talks to the same event loop
+    """
+    from a2wsgi import ASGIMiddleware
+    from project.aio import app as aio_app
+
+    aio_app.config['TESTING'] = True
+    return ASGIMiddleware(aio_app)
+
+
+def make_client(kind):
+    """
+    Test client of one edition of the API, both answer the same requests with the same responses
+    :param kind: 'wsgi' for the flask app, 'asgi' for the async app of project.aio
+    :return: client with the interface of the flask test client
+    """
+    app.config['TESTING'] = True
+    if kind == 'asgi':
+        return Client(asgi_app(), app.response_class)
+    return app.test_client()
@@ -0,0 +1,109 @@
+import os
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import pytest
+from mongoengine.connection import get_db
+
+from project import reconnect_db, response_cache
+from project.app import app
+from project.models import User, Post
+from project.seed import seed, SCALE_TIERS
+from project.views import trending
+
+try:
+    import mongomock
+    import mongomock.store
+except ImportError:
+    mongomock = None
+
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1', 'mongo', 'mongodb')
+SCALE_RANDOM_SEED = 0
+SCALE_DATASET_FORMAT = 2  # bumped whenever project.seed writes other documents, the outdated datasets are seeded again
+# FEED_FANOUT_LIMIT of the tiers whose most followed users stay under the production one, so feeds merge posts on read
+TIER_FANOUT_LIMITS = {'small': 50, '1x': 1000}
+# in-memory databases of SCALE_DB=mongomock, kept for the whole session like the ones of a mongod
+MEMORY_STORE = mongomock.store.ServerStore() if mongomock else None
+
+
+def scale_settings(tier):
+    """
+    MONGODB_SETTINGS of the database holding the dataset of a tier on SCALE_DB, a local mongod url or mongomock
+    """
+    name = f'reunion_scale_{tier}_{SCALE_RANDOM_SEED}'
+    settings = app.config['MONGODB_SETTINGS']
+    url = os.environ['SCALE_DB']
+    if url == 'mongomock':
+        if mongomock is None:
+            pytest.skip('SCALE_DB=mongomock needs the mongomock package')
+        return {**settings, 'host': f'mongodb://localhost/{name}', 'mongo_client_class': mongomock.MongoClient,
+                '_store': MEMORY_STORE}
+    # the database is dropped and seeded again whenever its dataset is outdated
+    if urlsplit(url).hostname not in LOCAL_HOSTS:
+        pytest.fail(f'refusing to seed the database on {urlsplit(url).hostname}, SCALE_DB must be local')
+    return {**settings, 'host': urlsplit(url)._replace(path=f'/{name}').geturl()}
+
+
+def switch_database(settings):
+    app.config['MONGODB_SETTINGS'] = settings
+    reconnect_db()
+    # ids reserved, responses cached and the trending ranking loaded from the previous database
+    for model in (User, Post):
+        model.id.allocator._reset()
+    response_cache.clear()
+    trending._reset()
+
+
+@contextmanager
+def use_database(settings):
+    """
+    Point the flask app at the database of settings for the duration of the block
+    """
+    previous = app.config['MONGODB_SETTINGS']
+    switch_database(settings)
+    try:
+        yield
+    finally:
+        switch_database(previous)
+
+
+def load_or_seed(tier):
+    """
+    Seed the current database with the volumes of a tier unless it already holds them, with SCALE_RESEED=1 always
+    :return: summary of project.seed.seed
+    """
+    datasets = get_db()['scale_dataset']
+    seeded_with = {'volumes': SCALE_TIERS[tier], 'random_seed': SCALE_RANDOM_SEED,
+                   'fanout_limit': app.config['FEED_FANOUT_LIMIT'], 'format': SCALE_DATASET_FORMAT}
+    record = datasets.find_one({'_id': tier})
+    if record is None or record['seeded_with'] != seeded_with or os.environ.get('SCALE_RESEED') == '1':
+        get_db().client.drop_database(get_db().name)
+        summary = seed(**SCALE_TIERS[tier], random_seed=SCALE_RANDOM_SEED)
+        record = {**summary, '_id': tier, 'seeded_with': seeded_with,
+                  'user_ids': [summary['user_ids'].start, summary['user_ids'].stop],
+                  'post_ids': [summary['post_ids'].start, summary['post_ids'].stop]}
+        datasets.insert_one(record)
+    return {**record, 'user_ids': range(*record['user_ids']), 'post_ids': range(*record['post_ids'])}
+
+
+@pytest.fixture(scope='module')
+def scale_dataset():
+    """
+    Point the flask app at a dataset seeded with the volumes of SCALE_TIER (small by default, see SCALE_TIERS) on
+    SCALE_DB for the tests of a module, skipped without SCALE_DB
+    a dataset is seeded on first use and kept in its own database for the next runs, other databases are left alone
+    :return: summary of project.seed.seed
+    """
+    if not os.environ.get('SCALE_DB'):
+        pytest.skip('set SCALE_DB to a local mongod url or to mongomock to run the scale tests')
+    tier = os.environ.get('SCALE_TIER', 'small')
+    if tier not in SCALE_TIERS:
+        pytest.fail(f'SCALE_TIER must be one of {", ".join(SCALE_TIERS)}')
+
+    fanout_limit = app.config['FEED_FANOUT_LIMIT']
+    app.config['FEED_FANOUT_LIMIT'] = TIER_FANOUT_LIMITS.get(tier, fanout_limit)
+    try:
+        with use_database(scale_settings(tier)):
+            yield load_or_seed(tier)
+    finally:
+        app.config['FEED_FANOUT_LIMIT'] = fanout_limit
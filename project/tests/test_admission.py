@@ -0,0 +1,179 @@
+import json
+import pytest
+
+from project.app import app
+from project.admission import AdaptiveLimit, TokenBuckets, DECREASE_FACTOR
+from project.tests import APP_KINDS, make_client
+from project.models import User
+from project.views import admission, rate_limit_key, token_serializer
+
+
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    client = make_client(request.param)
+    app.config['ADMISSION_ENABLED'] = True
+    yield client
+    app.config['ADMISSION_ENABLED'] = False
+
+
+def login(client, id):
+    """
+    Login user with given id
+    :param client:
+    :param id:
+    :return: TOKEN
+    """
+    USER = User.objects(id=id).first()
+    response = client.post('/api/authenticate',
+                           data=json.dumps({'email': USER.email, 'password': USER.password}),
+                           content_type='application/json')
+
+    assert response.status_code == 200
+    return response.json['token']
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_limit_sheds_over_limit():
+    limit = AdaptiveLimit(2, 1, 10, 0.1)
+    assert limit.try_acquire() and limit.try_acquire()
+    assert not limit.try_acquire()
+    limit.release(0.01)
+    assert limit.try_acquire()
+    assert limit.stats() == {'limit': 2, 'in_flight': 2, 'admitted': 3, 'shed': 1}
+
+
+def test_limit_decreases_once_per_target():
+    clock = Clock()
+    limit = AdaptiveLimit(20, 2, 100, 0.1, clock=clock)
+    for _ in range(10):
+        limit.try_acquire()
+    for _ in range(10):
+        limit.release(0.5)  # every request of the burst was slow, the limit only shrinks once
+    assert limit.limit == pytest.approx(20 * DECREASE_FACTOR)
+    clock.now += 0.1
+    limit.try_acquire()
+    limit.release(0.01, congested=True)  # threads waiting for a connection count as slow
+    assert limit.limit == pytest.approx(20 * DECREASE_FACTOR ** 2)
+
+
+def test_limit_grows_while_used_and_fast():
+    limit = AdaptiveLimit(4, 1, 5, 0.1)
+    for _ in range(50):
+        for _ in range(3):
+            limit.try_acquire()
+        for _ in range(3):
+            limit.release(0.01)
+    assert limit.limit == 5
+    idle = AdaptiveLimit(4, 1, 100, 0.1)
+    for _ in range(50):
+        idle.try_acquire()
+        idle.release(0.01)
+    assert idle.limit == 4  # one request at a time never uses half of the limit
+
+
+def test_limit_fixed_without_target():
+    limit = AdaptiveLimit(2, 2, 2, None)
+    limit.try_acquire()
+    limit.release(100)
+    assert limit.limit == 2
+
+
+def test_token_bucket():
+    clock = Clock()
+    buckets = TokenBuckets(rate=2, burst=3, max_keys=2, clock=clock)
+    assert [buckets.take('a') for _ in range(3)] == [0, 0, 0]
+    assert buckets.take('a') == pytest.approx(0.5)
+    clock.now += 0.5
+    assert buckets.take('a') == 0
+    assert buckets.take('b') == 0  # every key has its own bucket
+    buckets.take('c')  # over max_keys, the least recently used bucket (a) is dropped
+    assert buckets.take('a') == 0
+
+
+def test_rate_limited(client, monkeypatch):
+    token = login(client, 1)
+    monkeypatch.setattr(admission, 'buckets', TokenBuckets(rate=0.5, burst=2))
+    for _ in range(2):
+        assert client.get('/api/user', headers={'Authorization': token}).status_code == 200
+    response = client.get('/api/user', headers={'Authorization': token})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    assert 'error' in response.json
+    # another token is not limited
+    assert client.get('/api/user', headers={'Authorization': login(client, 2)}).status_code == 200
+
+
+def test_rate_limit_follows_the_user(client, monkeypatch):
+    """
+    Altered or forged tokens do not get a bucket of their own, they are limited with the address of the client
+    """
+    token = login(client, 1)
+    monkeypatch.setattr(admission, 'buckets', TokenBuckets(rate=0.5, burst=2))
+    assert client.get('/api/posts/1', headers={'Authorization': token + 'x'}).status_code == 200
+    assert client.get('/api/posts/1', headers={'Authorization': 'forged'}).status_code == 200
+    assert client.get('/api/posts/1').status_code == 429  # anonymous requests share the bucket of the address
+    # the valid token keeps the bucket of its user
+    assert client.get('/api/user', headers={'Authorization': token}).status_code == 200
+
+
+def test_rate_limit_key():
+    with app.app_context():
+        assert rate_limit_key('forged', '10.0.0.1') == rate_limit_key(None, '10.0.0.1') == 'address:10.0.0.1'
+        token = token_serializer(app.config['SECRET_KEY']).dumps({'id': 7, 'email': 'a@example.com'})
+        assert rate_limit_key(token, '10.0.0.1') == rate_limit_key(token, '10.0.0.2') == 'user:7'
+
+
+def test_shed_at_limit(client, monkeypatch):
+    scans = AdaptiveLimit(1, 1, 1, None)
+    monkeypatch.setitem(admission.limits, 'scan', scans)
+    scans.try_acquire()  # the only scan slot is taken
+    response = client.get('/api/all_posts')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert client.get('/api/posts/1').status_code == 200  # other classes are still served
+    scans.release(0)
+    assert client.get('/api/all_posts').status_code == 200
+    assert scans.stats()['in_flight'] == 0
+
+
+def test_ndjson_export_admitted_as_export(client, monkeypatch):
+    """
+    /api/all_posts streaming its ndjson export takes a slot of the export class, a page of json one of the scan class
+    """
+    scans = AdaptiveLimit(1, 1, 1, None)
+    monkeypatch.setitem(admission.limits, 'scan', scans)
+    scans.try_acquire()  # the only scan slot is taken
+    response = client.get('/api/all_posts', headers={'Accept': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert client.get('/api/all_posts', headers={'Accept': 'application/json'}).status_code == 503
+    scans.release(0)
+
+
+def test_admitted_requests_are_released(client):
+    before = {name: limit.stats()['in_flight'] for name, limit in admission.limits.items()}
+    client.get('/api/posts/1')
+    client.get('/api/posts/100000')
+    client.post('/api/like/1', headers={'Authorization': login(client, 1)})
+    assert {name: limit.stats()['in_flight'] for name, limit in admission.limits.items()} == before
+
+
+def test_admission_metrics():
+    """
+    The monitoring routes are never shed and export the limits of every route class
+    """
+    client = app.test_client()
+    body = client.get('/metrics').get_data(as_text=True)
+    assert body.count('# TYPE admission_limit gauge') == 1
+    for name in ('read', 'write', 'scan', 'export'):
+        assert f'admission_limit{{class="{name}"}}' in body
+    assert '# TYPE admission_shed_total counter' in body
+    assert 'admission_shed_total{class="scan"}' in body
+    assert '# TYPE admission_rate_limited_total counter' in body
@@ -1,15 +1,14 @@
 from project.app import app
+from project.tests import APP_KINDS, make_client
 from project.models import User
 
 import json
 import pytest
 
 
-@pytest.fixture
-def client():
-    app.config['TESTING'] = True
-    client = app.test_client()
-    yield client
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    yield make_client(request.param)
 
 
 def login(client, email, password):
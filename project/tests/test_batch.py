@@ -0,0 +1,190 @@
+import datetime
+import json
+import pytest
+from pymongo.errors import BulkWriteError
+
+from project.app import app
+from project.batch import BatchPlan, parse_operations, bucket_updates, duplicate_writes
+from project.tests import APP_KINDS, make_client
+from project.trending import trend_increment, LIKE_WEIGHT
+from project.models import User, Post, Follow, CommentBucket, COMMENT_BUCKET_SIZE
+
+
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    yield make_client(request.param)
+
+
+def login(client, id):
+    """
+    Login user with given id
+    :param client:
+    :param id:
+    :return: TOKEN
+    """
+    USER = User.objects(id=id).first()
+    response = client.post('/api/authenticate',
+                           data=json.dumps({'email': USER.email, 'password': USER.password}),
+                           content_type='application/json')
+
+    assert response.status_code == 200
+    token = response.json['token']
+    return token
+
+
+def run_batch(client, token, operations):
+    return client.post('/api/batch', headers={'Authorization': token},
+                       data=json.dumps({'operations': operations}), content_type='application/json')
+
+
+def test_get_posts_by_ids(client):
+    """
+    Posts are returned in the requested order, in the format of /api/posts/<id>, unknown ids are listed as missing
+    """
+    response = client.get('/api/posts?ids=3,1,1000,2')
+    assert response.status_code == 200
+    assert [post['id'] for post in response.json['posts']] == ['3', '1', '2']
+    assert response.json['missing'] == ['1000']
+    assert response.json['posts'][0] == client.get('/api/posts/3').json
+
+
+@pytest.mark.parametrize('ids', ['', 'a,b', ','.join(str(id) for id in range(1, 200))])
+def test_get_posts_invalid_ids(client, ids):
+    response = client.get(f'/api/posts?ids={ids}')
+    assert response.status_code == 400
+    assert 'error' in response.json
+
+
+def test_batch_results_in_order(client):
+    """
+    Every operation gets the result its own route would return, in the order they were sent
+    """
+    token = login(client, 2)
+    user = User.objects(id=2).first()
+    run_batch(client, token, [{'op': 'unlike', 'id': 4}, {'op': 'unfollow', 'id': 3}])
+    comments_before = Post.objects(id=4).first().comment_count
+
+    response = run_batch(client, token, [
+        {'op': 'like', 'id': 4},
+        {'op': 'like', 'id': 4},
+        {'op': 'comment', 'id': 4, 'comment': 'Batched comment'},
+        {'op': 'follow', 'id': 3},
+        {'op': 'like', 'id': 1000},
+        {'op': 'follow', 'id': 1000},
+        {'op': 'share', 'id': 4},
+        {'op': 'comment', 'id': 4},
+    ])
+    assert response.status_code == 200
+    results = response.json['results']
+    assert [result['status'] for result in results] == [200, 200, 200, 200, 404, 404, 400, 400]
+    assert results[0]['message'] == 'Post liked successfully'
+    assert results[1]['message'] == 'You already liked this post'
+    assert 'Comment-ID' in results[2]
+    assert results[3]['message'] == 'User followed successfully'
+
+    post = Post.objects(id=4).first()
+    assert user in post.likes
+    assert post.like_count == len(post.likes)
+    assert post.comment_count == comments_before + 1
+    comments = [comment.id for bucket in CommentBucket.objects(post=4) for comment in bucket.comments]
+    assert results[2]['Comment-ID'] in comments
+    assert Follow.objects(follower=2, followee=3).count() == 1
+
+
+def test_batch_writes_net_effect(client):
+    """
+    A like undone later in the same batch changes nothing, follow counters move once per edge actually created
+    """
+    token = login(client, 3)
+    run_batch(client, token, [{'op': 'unlike', 'id': 5}, {'op': 'unfollow', 'id': 4}])
+    likes_before = Post.objects(id=5).first().like_count
+    followers_before = User.objects(id=4).first().follower_count
+    following_before = User.objects(id=3).first().following_count
+
+    response = run_batch(client, token, [{'op': 'like', 'id': 5}, {'op': 'unlike', 'id': 5},
+                                         {'op': 'follow', 'id': 4}, {'op': 'follow', 'id': 4}])
+    assert [result['message'] for result in response.json['results']] == [
+        'Post liked successfully', 'Post unliked successfully', 'User followed successfully',
+        'You already follow this user']
+    assert Post.objects(id=5).first().like_count == likes_before
+    assert User.objects(id=4).first().follower_count == followers_before + 1
+    assert User.objects(id=3).first().following_count == following_before + 1
+
+    response = run_batch(client, token, [{'op': 'unfollow', 'id': 4}, {'op': 'unfollow', 'id': 4}])
+    assert response.json['results'][1]['message'] == 'You are not following this user with id 4'
+    assert User.objects(id=4).first().follower_count == followers_before
+    assert Follow.objects(follower=3, followee=4).count() == 0
+
+
+def test_batch_comments_fill_buckets(client):
+    """
+    Comments of one batch spread over the buckets of the post by position, every bucket is numbered and never over
+    COMMENT_BUCKET_SIZE
+    """
+    token = login(client, 2)
+    response = run_batch(client, token, [{'op': 'comment', 'id': 5, 'comment': f'Batch comment {i}'}
+                                         for i in range(COMMENT_BUCKET_SIZE + 3)])
+    assert all(result['status'] == 200 for result in response.json['results'])
+
+    buckets = CommentBucket.objects(post=5).order_by('bucket_no')
+    assert [bucket.bucket_no for bucket in buckets] == list(range(len(buckets)))
+    assert all(bucket.count == len(bucket.comments) <= COMMENT_BUCKET_SIZE for bucket in buckets)
+    assert Post.objects(id=5).first().comment_count == sum(bucket.count for bucket in buckets)
+
+
+def test_bucket_updates_by_position():
+    updates = bucket_updates(7, ['a', 'b', 'c'], COMMENT_BUCKET_SIZE + 1)
+    assert [query for query, _ in updates] == [{'post': 7, 'bucket_no': 0}, {'post': 7, 'bucket_no': 1}]
+    assert [update['$push']['comments']['$each'] for _, update in updates] == [['a', 'b'], ['c']]
+    assert [update['$inc']['count'] for _, update in updates] == [2, 1]
+
+
+def test_duplicate_writes():
+    """
+    Upserts beaten by other requests creating the same buckets are sent again, any other error is raised
+    """
+    error = BulkWriteError({'writeErrors': [{'index': 0, 'code': 11000}, {'index': 2, 'code': 11000}]})
+    assert duplicate_writes(error) == [0, 2]
+    with pytest.raises(BulkWriteError):
+        duplicate_writes(BulkWriteError({'writeErrors': [{'index': 0, 'code': 11000}, {'index': 1, 'code': 2}]}))
+
+
+def test_counter_writes_only_for_deleted_edges():
+    """
+    An unfollow whose edge was already deleted by another request leaves the counters alone
+    """
+    plan = BatchPlan(1, 1, parse_operations({'operations': [{'op': 'unfollow', 'id': 4}, {'op': 'unfollow', 'id': 5},
+                                                            {'op': 'follow', 'id': 6}]}))
+    plan.run({}, {4: 'four', 5: 'five', 6: 'six'}, {4, 5})
+    assert plan.unfollowed == [4, 5]
+    writes = plan.counter_writes(upserted={0: 'edge'}, deleted=[4])
+    assert sorted((write._filter['_id'], write._doc['$inc']) for write in writes) == [
+        (4, {'follower_count': -1}), (6, {'follower_count': 1})]  # the following_count of user 1 nets to 0
+
+
+def test_batch_unlike_takes_back_recorded_score():
+    """
+    An unlike takes back what the like recorded and only applies while that like is still the one read
+    """
+    plan = BatchPlan(1, 1, parse_operations({'operations': [{'op': 'unlike', 'id': 3}, {'op': 'unlike', 'id': 4}]}))
+    recorded = trend_increment(LIKE_WEIGHT, datetime.datetime(2024, 1, 1))
+    plan.run({3: True, 4: True}, {}, set(), like_scores={3: recorded})
+    recorded_unlike, unrecorded_unlike = plan.post_writes
+    assert recorded_unlike._filter == {'_id': 3, 'likes': 1, 'like_scores.1': recorded}
+    assert recorded_unlike._doc['$inc']['trend_score'].to_decimal() == recorded.to_decimal().copy_negate()
+    assert unrecorded_unlike._filter == {'_id': 4, 'likes': 1, 'like_scores.1': {'$exists': False}}
+    assert 'trend_score' not in unrecorded_unlike._doc['$inc']
+
+
+def test_batch_invalid_body(client):
+    token = login(client, 1)
+    response = client.post('/api/batch', headers={'Authorization': token},
+                           data=json.dumps({'operations': []}), content_type='application/json')
+    assert response.status_code == 400
+
+    response = run_batch(client, token, [{'op': 'like', 'id': 1}] * 101)
+    assert response.status_code == 400
+
+    response = client.post('/api/batch', data=json.dumps({'operations': [{'op': 'like', 'id': 1}]}),
+                           content_type='application/json')
+    assert response.status_code == 400  # token is missing
@@ -0,0 +1,184 @@
+from project.app import app
+from project import response_cache
+from project.cache import LocalBackend, ResponseCache
+from project.models import User, Post
+from project.tests import APP_KINDS, make_client
+from project.views import next_created_cursor
+import json
+import time
+import pytest
+from flask import Flask, jsonify
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    response_cache.clear()
+    client = app.test_client()
+    yield client
+
+
+@pytest.fixture(params=APP_KINDS)
+def writer(request):
+    """
+    Client of the edition sending the writes, the reads go through the flask app which caches them
+    """
+    return make_client(request.param)
+
+
+def login(client, id):
+    """
+    Login user with given id
+    :param client:
+    :param id:
+    :return: TOKEN
+    """
+    USER = User.objects(id=id).first()
+    response = client.post('/api/authenticate',
+                           data=json.dumps({'email': USER.email, 'password': USER.password}),
+                           content_type='application/json')
+
+    assert response.status_code == 200
+    token = response.json['token']
+    return token
+
+
+def test_get_post_cached_with_etag(client):
+    """
+    The second read of a post is a cache hit with the same body and ETag,
+    sending the ETag back in If-None-Match returns 304 without a body
+    """
+    before = response_cache.stats()
+    first = client.get('/api/posts/3')
+    second = client.get('/api/posts/3')
+    after = response_cache.stats()
+
+    assert first.status_code == second.status_code == 200
+    assert first.data == second.data
+    assert first.headers['ETag'] == second.headers['ETag']
+    assert 'Last-Modified' in first.headers
+    assert after['misses'] == before['misses'] + 1
+    assert after['hits'] == before['hits'] + 1
+
+    response = client.get('/api/posts/3', headers={'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_like_invalidates_post(client, writer):
+    """
+    Liking a post drops its cached response and the cached pages listing it, from either edition
+    """
+    token = login(writer, 1)
+    writer.post('/api/unlike/3', headers={'Authorization': token}, content_type='application/json')
+    likes = client.get('/api/posts/3').json['likes']
+    client.get('/api/all_posts?limit=100')
+
+    writer.post('/api/like/3', headers={'Authorization': token}, content_type='application/json')
+    assert client.get('/api/posts/3').json['likes'] == likes + 1
+    page = client.get('/api/all_posts?limit=100').json['posts']
+    assert [post['likes'] for post in page if post['id'] == '3'] == [likes + 1]
+
+
+def test_create_post_invalidates_last_page(client, writer):
+    """
+    A new post shows up on the cached last page of /api/all_posts
+    Example: the page after the newest post is empty and cached, after a post is created it lists the new post
+    """
+    token = login(writer, 1)
+    newest = Post.objects().order_by('-created_time', '-id').only('created_time').first()
+    after = next_created_cursor(newest.created_time, newest.id)
+    assert client.get(f'/api/all_posts?after={after}').json['posts'] == []
+
+    response = writer.post('/api/posts',
+                           data=json.dumps({'title': 'Cached listing post', 'description': 'Cached listing post'}),
+                           headers={'Authorization': token},
+                           content_type='application/json')
+    ids = [post['id'] for post in client.get(f'/api/all_posts?after={after}').json['posts']]
+    assert ids == [response.json['id']]
+
+
+def test_missing_post_not_cached(client):
+    before = response_cache.stats()
+    assert client.get('/api/posts/100').status_code == 404
+    assert client.get('/api/posts/100').status_code == 404
+    assert response_cache.stats()['hits'] == before['hits']
+
+
+@pytest.mark.parametrize('kind', APP_KINDS)
+def test_cache_stats(kind):
+    response = make_client(kind).get('/api/cache/stats')
+    assert response.status_code == 200
+    for counter in ('hits', 'misses', 'evictions'):
+        assert counter in response.json
+
+
+def test_local_backend_lru_eviction_and_ttl():
+    """
+    The least recently used entry is evicted once the bodies exceed max_bytes, expired entries are gone
+    """
+    backend = LocalBackend(max_bytes=10)
+    backend.set('a', {'body': 'aaaa'}, ttl=60, tags=['x'])
+    backend.set('b', {'body': 'bbbb'}, ttl=60, tags=['y'])
+    backend.get('a')  # b is now the least recently used
+    backend.set('c', {'body': 'cccc'}, ttl=60, tags=['x'])
+    assert backend.get('b') is None
+    assert backend.get('a') is not None
+    assert backend.stats()['evictions'] == 1
+
+    backend.invalidate(['x'])
+    assert backend.get('a') is None and backend.get('c') is None
+    assert backend.stats()['bytes'] == 0
+
+    backend.set('d', {'body': 'dd'}, ttl=0.01, tags=[])
+    time.sleep(0.02)
+    assert backend.get('d') is None
+
+
+def test_local_backend_skips_entries_invalidated_since():
+    """
+    An entry read before an invalidation of one of its tags is not stored, one read after it is
+    """
+    backend = LocalBackend(max_bytes=100)
+    since = backend.sequence()
+    backend.invalidate(['x'])
+    assert not backend.set('a', {'body': 'stale'}, ttl=60, tags=['x'], since=since)
+    assert backend.get('a') is None
+    assert backend.set('b', {'body': 'other'}, ttl=60, tags=['y'], since=since)
+    assert backend.set('a', {'body': 'fresh'}, ttl=60, tags=['x'], since=backend.sequence())
+
+
+def test_write_during_read_not_cached():
+    """
+    A response computed while a write invalidated its tag is served but not cached, the next read computes it again
+    """
+    cache = ResponseCache(LocalBackend(max_bytes=1024), ttl=60)
+    test_app = Flask(__name__)
+    test_app.config['RESPONSE_CACHE_ENABLED'] = True
+    reads = []
+
+    @test_app.route('/value')
+    @cache.cached(key=lambda: 'value', tags=lambda body: ['value'])
+    def value():
+        reads.append(len(reads))
+        if len(reads) == 1:
+            cache.invalidate('value')  # the write lands after the value was read
+        return jsonify({'value': len(reads)})
+
+    client = test_app.test_client()
+    assert client.get('/value').json == {'value': 1}
+    assert client.get('/value').json == {'value': 2}
+    assert client.get('/value').json == {'value': 2}  # cached from the second read
+    assert len(reads) == 2
+
+
+def test_cache_disabled(client):
+    app.config['RESPONSE_CACHE_ENABLED'] = False
+    try:
+        before = response_cache.stats()
+        client.get('/api/all_posts')
+        client.get('/api/all_posts')
+        assert response_cache.stats()['hits'] == before['hits']
+        assert response_cache.stats()['misses'] == before['misses']
+    finally:
+        app.config['RESPONSE_CACHE_ENABLED'] = True
@@ -0,0 +1,115 @@
+import json
+import zlib
+
+import brotli
+import pytest
+import zstandard
+from werkzeug.http import parse_accept_header
+
+from project import compression, response_cache
+from project.app import app
+from project.compression import StreamCompressor, negotiate, compress_stream, ENCODINGS
+from project.tests import APP_KINDS, make_client
+
+
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    response_cache.clear()
+    yield make_client(request.param)
+
+
+def decompress(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if encoding == 'br':
+        return brotli.decompress(data)
+    return zlib.decompress(data, 31)
+
+
+def partial_decompress(data, encoding):
+    """
+    :return: what can be decoded of the beginning of a compressed body
+    """
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if encoding == 'br':
+        return brotli.Decompressor().process(data)
+    return zlib.decompressobj(31).decompress(data)
+
+
+def test_negotiate():
+    for header, encoding in (('gzip, br', 'br'), ('gzip, br, zstd', 'zstd'), ('gzip;q=1, br;q=0.5', 'gzip'),
+                             ('*', 'zstd'), ('zstd;q=0, *', 'br'), ('gzip;q=0', None), ('identity', None), ('', None)):
+        assert negotiate(parse_accept_header(header), ENCODINGS) == encoding
+
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_stream_compressor(encoding):
+    """
+    A body compressed in flushed chunks decodes to the whole body, and every flush can be decoded on arrival
+    """
+    lines = [json.dumps({'id': str(id), 'title': 'Reunion photos', 'likes': id}).encode() + b'\n'
+             for id in range(2000)]
+    chunks = list(compress_stream(iter(lines), StreamCompressor(encoding, 3), flush_bytes=4096))
+    assert len(chunks) > 2
+    assert decompress(b''.join(chunks), encoding) == b''.join(lines)
+    assert len(b''.join(chunks)) < len(b''.join(lines)) / 4
+    # what was sent before the end of the body decodes to all of it but the last flush_bytes at most
+    assert len(partial_decompress(b''.join(chunks[:-1]), encoding)) > len(b''.join(lines)) - 4096
+
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_listing_compressed(client, encoding):
+    """
+    A page of /api/all_posts requested with Accept-Encoding comes compressed and decodes to the uncompressed page
+    """
+    plain = client.get('/api/all_posts?limit=100')
+    assert 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.headers['Vary']
+
+    response = client.get('/api/all_posts?limit=100', headers={'Accept-Encoding': encoding})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == encoding
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert json.loads(decompress(response.data, encoding)) == plain.json
+
+
+def test_small_body_not_compressed(client):
+    response = client.get('/api/posts/1', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_export_compressed(client):
+    plain = client.get('/api/all_posts/stream')
+    response = client.get('/api/all_posts/stream', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+    assert decompress(response.data, 'gzip') == plain.data
+
+
+def test_conditional_compressed():
+    """
+    A compressed cached post gets a weak ETag, sending it back still answers 304
+    """
+    client = make_client('wsgi')
+    response_cache.clear()
+    app.config['COMPRESSION_MIN_BYTES'] = 0
+    try:
+        response = client.get('/api/posts/1', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['ETag'].startswith('W/')
+        response = client.get('/api/posts/1', headers={'Accept-Encoding': 'gzip',
+                                                       'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+    finally:
+        app.config['COMPRESSION_MIN_BYTES'] = 1024
+
+
+def test_missing_compressor(client, monkeypatch):
+    monkeypatch.setattr(compression, 'zstandard', None)
+    response = client.get('/api/all_posts?limit=100', headers={'Accept-Encoding': 'zstd'})
+    assert 'Content-Encoding' not in response.headers
+    response = client.get('/api/all_posts?limit=100', headers={'Accept-Encoding': 'zstd, gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
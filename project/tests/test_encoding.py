@@ -0,0 +1,128 @@
+import datetime
+import decimal
+import json
+import uuid
+
+import msgpack
+import pytest
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date as werkzeug_http_date
+
+from project import encoding, response_cache
+from project.app import app
+from project.encoding import FastJSONMixin, FastJSONProvider, http_date, unpack, MSGPACK_MIMETYPE
+from project.tests import APP_KINDS, make_client
+
+MSGPACK = {'Accept': MSGPACK_MIMETYPE}
+
+
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    response_cache.clear()
+    yield make_client(request.param)
+
+
+def test_http_date():
+    for value in (datetime.datetime(2023, 10, 18, 9, 30, 5, 123456), datetime.datetime(1999, 1, 3),
+                  datetime.datetime(2024, 2, 29, 23, 59, 59, tzinfo=datetime.timezone(datetime.timedelta(hours=-5)))):
+        assert http_date(value) == werkzeug_http_date(value)
+
+
+def test_same_json_as_default_provider():
+    """
+    The fast provider writes the json the default flask provider writes, datetimes included
+    """
+    obj = {'posts': [{'id': '1', 'created_at': datetime.datetime(2023, 10, 18, 9, 30), 'likes': 3, 'desc': 'café'},
+                     {'id': '2', 'created_at': None, 'likes': 0, 'tags': ['a', 'b']}],
+           'next': 2, 'price': decimal.Decimal('1.50'), 'ref': uuid.UUID(int=7)}
+    with app.app_context():
+        fast = FastJSONProvider(app).dumps(obj)
+        default = DefaultJSONProvider(app).dumps(obj)
+    assert json.loads(fast) == json.loads(default)
+    assert json.loads(fast)['posts'][0]['created_at'] == 'Wed, 18 Oct 2023 09:30:00 GMT'
+
+
+def test_iso_dates():
+    app.config['JSON_ISO_DATES'] = True
+    try:
+        assert json.loads(FastJSONProvider(app).dumps({'at': datetime.datetime(2023, 10, 18, 9, 30)})) == \
+               {'at': '2023-10-18T09:30:00Z'}
+    finally:
+        app.config['JSON_ISO_DATES'] = False
+
+
+def test_msgpack_negotiation(client):
+    """
+    A client accepting application/msgpack gets the page of posts it would get in json, created_at as a timestamp
+    """
+    body = client.get('/api/all_posts?limit=5').json
+    response = client.get('/api/all_posts?limit=5', headers=MSGPACK)
+    assert response.status_code == 200
+    assert response.mimetype == MSGPACK_MIMETYPE
+    assert 'Accept' in response.headers['Vary']
+
+    packed = unpack(response.data)
+    for post in packed['posts']:
+        if post['created_at'] is not None:
+            post['created_at'] = http_date(post['created_at'])
+    assert packed == body
+    assert len(response.data) < len(json.dumps(body, separators=(',', ':')))
+
+
+def test_json_stays_default(client):
+    for accept in ('*/*', 'application/json', f'application/json, {MSGPACK_MIMETYPE};q=0.5'):
+        response = client.get('/api/posts/1', headers={'Accept': accept})
+        assert response.mimetype == 'application/json'
+    assert client.get('/api/posts/1').mimetype == 'application/json'
+
+
+def test_mixin_defaults_to_json():
+    """
+    A provider on FastJSONMixin which does not override accept_mimetypes answers json whatever the client accepts
+    """
+
+    class Provider(FastJSONMixin, DefaultJSONProvider):
+        pass
+
+    with app.test_request_context(headers=MSGPACK):
+        response = Provider(app).response({'n': [1, 2]})
+    assert response.mimetype == 'application/json'
+    assert response.json == {'n': [1, 2]}
+
+
+def test_msgpack_cached_apart():
+    """
+    The json and MessagePack representations of a post are cached by the flask app as two entries with their own ETag
+    """
+    client = make_client('wsgi')
+    response_cache.clear()
+    packed = client.get('/api/posts/1', headers=MSGPACK)
+    hits = response_cache.hits
+    cached = client.get('/api/posts/1', headers=MSGPACK)
+    assert response_cache.hits == hits + 1
+    assert cached.data == packed.data and cached.mimetype == MSGPACK_MIMETYPE
+
+    as_json = client.get('/api/posts/1')
+    assert response_cache.hits == hits + 1
+    assert as_json.mimetype == 'application/json'
+    assert as_json.headers['ETag'] != packed.headers['ETag']
+    assert unpack(packed.data) == as_json.json
+
+    response = client.get('/api/posts/1', headers={**MSGPACK, 'If-None-Match': packed.headers['ETag']})
+    assert response.status_code == 304
+
+
+def test_json_without_msgpack(client, monkeypatch):
+    monkeypatch.setattr(encoding, 'msgpack', None)
+    response = client.get('/api/posts/1', headers=MSGPACK)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+
+
+def test_msgpack_round_trip():
+    at = datetime.datetime(2023, 10, 18, 9, 30, 5, 250000)
+    with app.test_request_context(headers=MSGPACK):
+        response = app.json.response({'at': at, 'n': [1, 2]})
+    assert response.mimetype == MSGPACK_MIMETYPE
+    assert msgpack.unpackb(response.data, timestamp=3) == {'at': at.replace(tzinfo=datetime.timezone.utc),
+                                                           'n': [1, 2]}
@@ -0,0 +1,187 @@
+from project.app import app
+from project.tests import APP_KINDS, make_client
+from project.views import token_serializer
+from project.models import User, Post, TimelineEntry
+import datetime
+import json
+import pytest
+
+
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    yield make_client(request.param)
+
+
+def login(client, id):
+    """
+    Login user with given id
+    :param client:
+    :param id:
+    :return: TOKEN
+    """
+    USER = User.objects(id=id).first()
+    response = client.post('/api/authenticate',
+                           data=json.dumps({'email': USER.email, 'password': USER.password}),
+                           content_type='application/json')
+
+    assert response.status_code == 200
+    token = response.json['token']
+    return token
+
+
+def create_post(client, token, title):
+    response = client.post('/api/posts',
+                           data=json.dumps({'title': title, 'description': f'Description of {title}'}),
+                           headers={'Authorization': token},
+                           content_type='application/json')
+    assert response.status_code == 200
+    return response.json['id']
+
+
+def test_feed_shows_followed_posts_newest_first(client):
+    """
+    USER with ID 3 follows USER with ID 2, posts created by USER with ID 2 show up in the feed of USER with ID 3
+    newest first, and paging with the next cursor never repeats a post
+    """
+    follower_token = login(client, 3)
+    author_token = login(client, 2)
+    client.post('/api/follow/2', headers={'Authorization': follower_token}, content_type='application/json')
+
+    ids = [create_post(client, author_token, f'Feed post {i}') for i in range(3)]
+
+    response = client.get('/api/feed?limit=2', headers={'Authorization': follower_token})
+    assert response.status_code == 200
+    first_page = [post['id'] for post in response.json['posts']]
+    assert first_page == [ids[2], ids[1]]
+
+    response = client.get(f'/api/feed?limit=2&after={response.json["next"]}', headers={'Authorization': follower_token})
+    assert response.status_code == 200
+    assert response.json['posts'][0]['id'] == ids[0]
+
+
+def test_feed_cleaned_on_delete_and_unfollow(client):
+    """
+    Deleting a post removes it from the feeds, unfollowing removes all the posts of that author
+    """
+    follower_token = login(client, 4)
+    author_token = login(client, 2)
+    client.post('/api/follow/2', headers={'Authorization': follower_token}, content_type='application/json')
+    kept, deleted = create_post(client, author_token, 'Kept post'), create_post(client, author_token, 'Deleted post')
+
+    client.delete(f'/api/posts/{deleted}', headers={'Authorization': author_token}, content_type='application/json')
+    assert TimelineEntry.objects(post=int(deleted)).count() == 0
+    feed = [post['id'] for post in client.get('/api/feed', headers={'Authorization': follower_token}).json['posts']]
+    assert kept in feed
+    assert deleted not in feed
+
+    client.post('/api/unfollow/2', headers={'Authorization': follower_token}, content_type='application/json')
+    feed = [post['id'] for post in client.get('/api/feed', headers={'Authorization': follower_token}).json['posts']]
+    assert kept not in feed
+
+
+def test_feed_merges_popular_authors_on_read(client):
+    """
+    Posts of authors above FEED_FANOUT_LIMIT are not written to timelines but still show up in the feed
+    """
+    follower_token = login(client, 5)
+    author_token = login(client, 2)
+    client.post('/api/follow/2', headers={'Authorization': follower_token}, content_type='application/json')
+
+    fanout_limit = app.config['FEED_FANOUT_LIMIT']
+    app.config['FEED_FANOUT_LIMIT'] = 1  # every author with a follower counts as popular
+    try:
+        id = create_post(client, author_token, 'Popular post')
+        assert TimelineEntry.objects(post=int(id)).count() == 0
+        feed = [post['id'] for post in client.get('/api/feed', headers={'Authorization': follower_token}).json['posts']]
+        assert feed[0] == id
+    finally:
+        app.config['FEED_FANOUT_LIMIT'] = fanout_limit
+
+
+def test_feed_keeps_posts_of_authors_dropping_below_the_limit(client):
+    """
+    An author who posted above FEED_FANOUT_LIMIT and then loses followers keeps those posts in the feeds, next to the
+    posts fanned out once they are below the limit
+    """
+    follower_token, leaving_token = login(client, 3), login(client, 4)
+    author_token = login(client, 2)
+    for token in (follower_token, leaving_token):
+        client.post('/api/follow/2', headers={'Authorization': token}, content_type='application/json')
+
+    fanout_limit = app.config['FEED_FANOUT_LIMIT']
+    app.config['FEED_FANOUT_LIMIT'] = User.objects(id=2).first().follower_count
+    try:
+        popular = create_post(client, author_token, 'Posted above the limit')
+        assert TimelineEntry.objects(post=int(popular)).count() == 0
+        client.post('/api/unfollow/2', headers={'Authorization': leaving_token}, content_type='application/json')
+        fanned_out = create_post(client, author_token, 'Posted below the limit')
+        assert TimelineEntry.objects(post=int(fanned_out)).count() > 0
+
+        feed = [post['id'] for post in client.get('/api/feed', headers={'Authorization': follower_token}).json['posts']]
+        assert feed[:2] == [fanned_out, popular]
+    finally:
+        app.config['FEED_FANOUT_LIMIT'] = fanout_limit
+
+
+def test_feed_in_creation_order(client):
+    """
+    Every process takes post ids from its own block, a post created later may have a smaller id: the feed and its
+    cursor follow the created time, in the timelines as in the posts merged on read
+    """
+    follower_token = login(client, 3)
+    client.post('/api/follow/2', headers={'Authorization': follower_token}, content_type='application/json')
+    smaller, larger = Post.id.allocator.take(), Post.id.allocator.take()
+    now = datetime.datetime.utcnow()
+    posts = Post._get_collection()
+    posts.insert_many([{'_id': id, 'title': title, 'description': title, 'author': 2, 'created_time': created,
+                        'like_count': 0, 'comment_count': 0}
+                       for id, title, created in ((larger, 'Created first', now),
+                                                  (smaller, 'Created next', now + datetime.timedelta(seconds=1)))])
+    def feed_pages():
+        first = client.get('/api/feed?limit=1', headers={'Authorization': follower_token})
+        second = client.get(f'/api/feed?limit=1&after={first.json["next"]}', headers={'Authorization': follower_token})
+        return [post['id'] for response in (first, second) for post in response.json['posts']]
+
+    fanout_limit = app.config['FEED_FANOUT_LIMIT']
+    try:
+        TimelineEntry._get_collection().insert_many([{'owner': 3, 'post': post['_id'], 'author': 2,
+                                                      'created_time': post['created_time']}
+                                                     for post in posts.find({'_id': {'$in': [smaller, larger]}})])
+        assert feed_pages() == [str(smaller), str(larger)]
+
+        TimelineEntry.objects(post__in=[smaller, larger]).delete()
+        app.config['FEED_FANOUT_LIMIT'] = 1  # the posts of the author are merged on read
+        assert feed_pages() == [str(smaller), str(larger)]
+    finally:
+        app.config['FEED_FANOUT_LIMIT'] = fanout_limit
+        posts.delete_many({'_id': {'$in': [smaller, larger]}})
+        TimelineEntry.objects(post__in=[smaller, larger]).delete()
+
+
+def test_migrate_timelines(client):
+    """
+    Timeline entries written before the feeds were ordered by created time get the one of their post
+    """
+    post = Post.objects(id=1).only('created_time').first()
+    TimelineEntry._get_collection().insert_one({'owner': 5, 'post': 1, 'author': 1})
+    try:
+        assert app.test_cli_runner().invoke(args=['migrate-timelines']).exit_code == 0
+        assert TimelineEntry.objects(owner=5, post=1).first().created_time == post.created_time
+    finally:
+        TimelineEntry.objects(owner=5, post=1).delete()
+
+
+def test_create_post_deleted_user(client):
+    """
+    A token whose user no longer exists creates no post and reaches no timeline
+    """
+    token = token_serializer(app.config['SECRET_KEY']).dumps({'id': 10 ** 9, 'email': 'deleted@example.com'})
+    response = client.post('/api/posts', data=json.dumps({'title': 'Orphan post', 'description': 'No author'}),
+                           headers={'Authorization': token}, content_type='application/json')
+    assert response.status_code == 401
+    assert Post.objects(author=10 ** 9).count() == 0
+
+
+def test_feed_unauthorized(client):
+    response = client.get('/api/feed')
+    assert response.status_code == 400
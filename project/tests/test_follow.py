@@ -2,14 +2,13 @@ import json
 import pytest
 
 from project.app import app
-from project.models import User
+from project.tests import APP_KINDS, make_client
+from project.models import User, Follow
 
 
-@pytest.fixture
-def client():
-    app.config['TESTING'] = True
-    client = app.test_client()
-    yield client
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    yield make_client(request.param)
 
 
 def login(client, id):
@@ -105,3 +104,70 @@ def test_unfollow_user_not_found(client):
     USER.reload()
     assert response.status_code == 404
     assert 'error' in response.json
+
+
+def test_follow_counters_match_edges(client):
+    """
+    Following and unfollowing keeps follower_count and following_count equal to the number of Follow edges
+    Example:
+    USER with ID 2 follows USER with ID 3 twice, then unfollows
+    """
+    token = login(client, 2)
+    USER = User.objects(id=2).first()
+    USER_TO_FOLLOW = User.objects(id=3).first()
+
+    for _ in range(2):
+        client.post('/api/follow/3', headers={'Authorization': token}, content_type='application/json')
+    USER.reload()
+    USER_TO_FOLLOW.reload()
+    assert Follow.objects(follower=USER, followee=USER_TO_FOLLOW).count() == 1
+    assert USER.following_count == Follow.objects(follower=USER).count()
+    assert USER_TO_FOLLOW.follower_count == Follow.objects(followee=USER_TO_FOLLOW).count()
+
+    response = client.get('/api/user', headers={'Authorization': token}, content_type='application/json')
+    assert response.json['following'] == USER.following_count
+
+    client.post('/api/unfollow/3', headers={'Authorization': token}, content_type='application/json')
+    USER.reload()
+    USER_TO_FOLLOW.reload()
+    assert Follow.objects(follower=USER, followee=USER_TO_FOLLOW).count() == 0
+    assert USER.following_count == Follow.objects(follower=USER).count()
+    assert USER_TO_FOLLOW.follower_count == Follow.objects(followee=USER_TO_FOLLOW).count()
+
+
+def test_followers_and_following_pages(client):
+    """
+    USER with ID 1 follows users 2 to 5, page through its following list 2 at a time
+    and check USER with ID 1 shows up in the followers list of USER with ID 2
+    """
+    token = login(client, 1)
+    for id in [2, 3, 4, 5]:
+        client.post(f'/api/follow/{id}', headers={'Authorization': token}, content_type='application/json')
+
+    ids = []
+    cursor = None
+    while True:
+        url = f'/api/users/1/following?limit=2&after={cursor}' if cursor else '/api/users/1/following?limit=2'
+        response = client.get(url)
+        assert response.status_code == 200
+        assert len(response.json['users']) <= 2
+        ids += [int(user['id']) for user in response.json['users']]
+        cursor = response.json['next']
+        if not cursor:
+            break
+    assert ids == sorted(set(ids))
+    assert {2, 3, 4, 5} <= set(ids)
+
+    response = client.get('/api/users/2/followers?limit=100')
+    assert response.status_code == 200
+    assert '1' in [user['id'] for user in response.json['users']]
+    assert all('name' in user for user in response.json['users'])
+
+
+def test_followers_user_not_found(client):
+    """
+    Listing the followers of a user that does not exist
+    """
+    response = client.get('/api/users/1000/followers')
+    assert response.status_code == 404
+    assert 'error' in response.json
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from project.app import app
+from project.ids import IdBlockAllocator
+from project.models import Post, User
+from mongoengine.connection import get_db
+
+
+class Counter:
+    """
+    Stand-in for the counter document, counts the reservations and can be slowed down
+    """
+
+    def __init__(self, delay=0):
+        self.next = 0
+        self.reservations = 0
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        time.sleep(self.delay)
+        with self.lock:
+            self.reservations += 1
+            self.next += size
+            return self.next
+
+
+def test_ids_taken_from_blocks():
+    counter = Counter()
+    allocator = IdBlockAllocator(counter.reserve, lambda: 10)
+    ids = [allocator.take() for _ in range(25)]
+    assert ids == list(range(1, 26))
+    assert counter.reservations == 3
+
+
+def test_next_block_reserved_in_background():
+    """
+    Once less than a quarter of the block is left the next one is reserved by a thread, the takes do not wait for it
+    """
+    counter = Counter(delay=0.2)
+    allocator = IdBlockAllocator(counter.reserve, lambda: 8)
+    allocator.take()  # waits for the first block
+    start = time.perf_counter()
+    for _ in range(7):
+        allocator.take()
+    assert time.perf_counter() - start < 0.2
+    assert allocator.take(wait=False) in (None, 9)
+    assert allocator.take() >= 9
+
+
+def test_concurrent_takes_unique_and_increasing():
+    counter = Counter()
+    allocator = IdBlockAllocator(counter.reserve, lambda: 16)
+
+    def take_many(_):
+        ids = [allocator.take() for _ in range(200)]
+        assert ids == sorted(ids)  # increasing as seen by each thread
+        return ids
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        ids = [id for taken in executor.map(take_many, range(8)) for id in taken]
+    assert len(set(ids)) == len(ids) == 1600
+
+
+def test_documents_ids_from_blocks():
+    """
+    New documents get increasing ids below the counter, which stays compatible with SequenceField
+    """
+    user = User(name='Block ids', email='block.ids@example.com', password='password123')
+    user.save(force_insert=True)
+    posts = [Post(title=f'Block id {i}', description='Block id', author=user) for i in range(3)]
+    for post in posts:
+        post.save(force_insert=True)
+    try:
+        ids = [post.id for post in posts]
+        assert ids == sorted(ids) and len(set(ids)) == 3
+        counter = get_db()['mongoengine.counters'].find_one({'_id': 'post.id'})
+        assert counter['next'] >= ids[-1]
+        assert Post.objects(id=ids[-1]).first().title == 'Block id 2'
+    finally:
+        Post.objects(author=user).delete()
+        user.delete()
@@ -0,0 +1,261 @@
+from mongoengine.connection import get_db
+
+from project.app import app
+from project import response_cache
+from project.models import User, Post, Follow, TimelineEntry, CommentBucket
+from project.monitoring import command_counter
+from project.views import token_serializer, trending
+
+import json
+import pytest
+
+# a query may examine at most this many documents per document it returns
+MAX_EXAMINED_RATIO = 2
+# commands that look documents up, every one of them sent by a route is explained
+EXPLAINED_COMMANDS = ('find', 'aggregate', 'count', 'distinct', 'update', 'delete', 'findAndModify')
+# fields the driver adds to a command, the explain command does not take them
+DRIVER_FIELDS = ('lsid', 'txnNumber', 'autocommit', 'startTransaction', 'readConcern', 'writeConcern')
+
+
+@pytest.fixture(scope='module', autouse=True)
+def indexes():
+    """
+    Make sure the declared indexes exist before looking at the plans
+    """
+    for model in (User, Post, Follow, TimelineEntry, CommentBucket):
+        model.ensure_indexes()
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    response_cache.clear()  # cached responses make no queries at all
+    client = app.test_client()
+    yield client
+
+
+def login(client, id):
+    """
+    Login user with given id
+    :return: TOKEN
+    """
+    USER = User.objects(id=id).first()
+    response = client.post('/api/authenticate',
+                           data=json.dumps({'email': USER.email, 'password': USER.password}),
+                           content_type='application/json')
+    assert response.status_code == 200
+    return response.json['token']
+
+
+def find_values(document, key):
+    """
+    Collect every value stored under key anywhere in a nested explain output
+    :param document: explain output, dicts and lists nested arbitrarily
+    :param key: key to look for
+    :return: list of values
+    """
+    values = []
+    if isinstance(document, dict):
+        for k, v in document.items():
+            if k == key:
+                values.append(v)
+            values += find_values(v, key)
+    elif isinstance(document, list):
+        for item in document:
+            values += find_values(item, key)
+    return values
+
+
+def assert_indexed(explain):
+    """
+    Fail if the winning plan scans the collection or examines too many documents for what it returns
+    a text search reads every match to rank it, only its scan is checked
+    :param explain: output of an explain run with executionStats verbosity
+    """
+    plans = find_values(explain, 'winningPlan')
+    assert plans, 'explain output has no winning plan'
+    stages = find_values(plans, 'stage')
+    assert 'COLLSCAN' not in stages, f'collection scan in {plans}'
+    if 'TEXT_MATCH' in stages or 'TEXT' in stages:
+        return
+
+    for stats in find_values(explain, 'executionStats'):
+        if 'totalDocsExamined' in stats:
+            assert stats['totalDocsExamined'] <= max(stats['nReturned'], 1) * MAX_EXAMINED_RATIO, stats
+
+
+def statements(event):
+    """
+    Commands to explain for a command sent to the database, one per statement of a bulk update or delete
+    :param event: CommandStartedEvent of the command
+    :return: list of command documents without the fields added by the driver
+    """
+    command = {key: value for key, value in event.command.items()
+               if not key.startswith('$') and key not in DRIVER_FIELDS}
+    for field in ('updates', 'deletes'):
+        if field in command:
+            return [dict(command, **{field: [statement]}) for statement in command[field]]
+    return [command]
+
+
+def assert_queries_indexed(f, *args, **kwargs):
+    """
+    Run f, typically a request of the test client, and explain every query it sent to the database
+    :param f: callable, e.g. client.get
+    :return: what f returned
+    """
+    with command_counter.recording() as events:
+        result = f(*args, **kwargs)
+    queries = [event for event in events if event.command_name in EXPLAINED_COMMANDS]
+    assert queries, f'{f.__name__} {args[:1]} sent no query'
+    for event in queries:
+        for command in statements(event):
+            explain = get_db().client[event.database_name].command('explain', command, verbosity='executionStats')
+            assert_indexed(explain)
+    return result
+
+
+def test_user_routes(client):
+    """
+    authenticate, the current user with a token carrying the id and with a legacy token looked up by email
+    """
+    user = User.objects(id=1).first()
+    response = assert_queries_indexed(client.post, '/api/authenticate', content_type='application/json',
+                                      data=json.dumps({'email': user.email, 'password': user.password}))
+    assert response.status_code == 200
+    response = assert_queries_indexed(client.get, '/api/user', headers={'Authorization': response.json['token']})
+    assert response.status_code == 200
+
+    legacy_token = token_serializer(app.config['SECRET_KEY']).dumps({'email': user.email})
+    response = assert_queries_indexed(client.get, '/api/user', headers={'Authorization': legacy_token})
+    assert response.status_code == 200
+
+
+def test_follow_routes(client):
+    """
+    follow upserts and unfollow deletes one edge, the follower pages from their first page and from a cursor
+    """
+    headers = {'Authorization': login(client, 5)}
+    followed = Follow.objects(follower=5, followee=4).first() is not None
+    for route in ('unfollow', 'follow') if followed else ('follow', 'unfollow'):
+        response = assert_queries_indexed(client.post, f'/api/{route}/4', headers=headers)
+        assert response.status_code == 200
+
+    for page in ('followers', 'following'):
+        response = assert_queries_indexed(client.get, f'/api/users/1/{page}?limit=1')
+        assert response.status_code == 200
+        response = assert_queries_indexed(client.get, f'/api/users/1/{page}?limit=1&after=1')
+        assert response.status_code == 200
+
+
+def test_post_routes(client):
+    """
+    the listing from its first page and from a cursor, its export, one post, several posts by id, and a post created
+    then deleted by its author
+    """
+    response = assert_queries_indexed(client.get, '/api/all_posts?limit=2')
+    assert response.status_code == 200
+    response = assert_queries_indexed(client.get, f'/api/all_posts?limit=2&after={response.json["next"]}')
+    assert response.status_code == 200
+    response = assert_queries_indexed(client.get, '/api/all_posts/stream')
+    assert response.status_code == 200
+    response = assert_queries_indexed(client.get, '/api/posts/3')
+    assert response.status_code == 200
+    response = assert_queries_indexed(client.get, '/api/posts?ids=1,2,3')
+    assert response.status_code == 200
+
+    headers = {'Authorization': login(client, 1)}
+    response = assert_queries_indexed(client.post, '/api/posts', headers=headers, content_type='application/json',
+                                      data=json.dumps({'title': 'Explained post', 'description': 'Explained post'}))
+    assert response.status_code == 200
+    response = assert_queries_indexed(client.delete, f'/api/posts/{response.json["id"]}', headers=headers)
+    assert response.status_code == 200
+
+
+def test_like_and_comment_routes(client):
+    """
+    like and unlike updates, comments appended to their bucket and the comment pages from their first page and from
+    a cursor
+    """
+    headers = {'Authorization': login(client, 1)}
+    post_id = client.post('/api/posts', headers=headers, content_type='application/json',
+                          data=json.dumps({'title': 'Explained post', 'description': 'Explained post'})).json['id']
+    try:
+        for route in ('like', 'unlike'):
+            response = assert_queries_indexed(client.post, f'/api/{route}/{post_id}', headers=headers)
+            assert response.status_code == 200
+        for text in ('First explained comment', 'Second explained comment'):
+            response = assert_queries_indexed(client.post, f'/api/comment/{post_id}', headers=headers,
+                                              content_type='application/json', data=json.dumps({'comment': text}))
+            assert response.status_code == 200
+
+        response = assert_queries_indexed(client.get, f'/api/posts/{post_id}/comments?limit=1')
+        assert response.status_code == 200
+        response = assert_queries_indexed(client.get,
+                                          f'/api/posts/{post_id}/comments?limit=1&after={response.json["next"]}')
+        assert response.status_code == 200
+    finally:
+        client.delete(f'/api/posts/{post_id}', headers=headers)
+
+
+def test_feed_route(client):
+    """
+    feed pages from the timeline and with the posts of popular authors merged on read, from their first page and from
+    a cursor
+    """
+    headers = {'Authorization': login(client, 3)}
+    followed = Follow.objects(follower=3, followee=1).first() is not None
+    author_headers = {'Authorization': login(client, 1)}
+    client.post('/api/follow/1', headers=headers)
+    post_ids = [client.post('/api/posts', headers=author_headers, content_type='application/json',
+                            data=json.dumps({'title': 'Explained post', 'description': 'Explained post'})).json['id']
+                for _ in range(2)]
+    fanout_limit = app.config['FEED_FANOUT_LIMIT']
+    try:
+        for limit in (fanout_limit, 1):  # every followed author is popular with a limit of 1
+            app.config['FEED_FANOUT_LIMIT'] = limit
+            response = assert_queries_indexed(client.get, '/api/feed?limit=1', headers=headers)
+            assert response.status_code == 200
+            response = assert_queries_indexed(client.get, f'/api/feed?limit=1&after={response.json["next"]}',
+                                              headers=headers)
+            assert response.status_code == 200
+    finally:
+        app.config['FEED_FANOUT_LIMIT'] = fanout_limit
+        for post_id in post_ids:
+            client.delete(f'/api/posts/{post_id}', headers=author_headers)
+        if not followed:
+            client.post('/api/unfollow/1', headers=headers)
+
+
+def test_batch_route(client):
+    """
+    the posts, users and edges a batch reads at once and its bulk writes
+    """
+    headers = {'Authorization': login(client, 5)}
+    post_id = int(client.post('/api/posts', headers=headers, content_type='application/json',
+                              data=json.dumps({'title': 'Explained post', 'description': 'Explained post'})).json['id'])
+    followed = Follow.objects(follower=5, followee=4).first() is not None
+    follows = [{'op': op, 'id': 4} for op in (('unfollow', 'follow') if followed else ('follow', 'unfollow'))]
+    operations = [{'op': 'like', 'id': post_id}, {'op': 'comment', 'id': post_id, 'comment': 'Explained comment'},
+                  {'op': 'unlike', 'id': post_id}] + follows
+    try:
+        response = assert_queries_indexed(client.post, '/api/batch', headers=headers, content_type='application/json',
+                                          data=json.dumps({'operations': operations}))
+        assert response.status_code == 200
+    finally:
+        client.delete(f'/api/posts/{post_id}', headers=headers)
+
+
+def test_search_route(client):
+    """
+    /api/search is answered from the text index
+    """
+    response = assert_queries_indexed(client.get, '/api/search?q=post')
+    assert response.status_code == 200
+
+
+def test_trending_refresh():
+    """
+    the trending ranking is reloaded from the start of the trend_score index
+    """
+    assert_queries_indexed(trending.refresh)
@@ -1,15 +1,20 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 
 from project.app import app
-from project.models import User, Post
+from project.tests import APP_KINDS, make_client
+from project.models import User, Post, CommentBucket, COMMENT_BUCKET_SIZE
+
+
+@pytest.fixture(params=APP_KINDS)
+def kind(request):
+    return request.param
 
 
 @pytest.fixture
-def client():
-    app.config['TESTING'] = True
-    client = app.test_client()
-    yield client
+def client(kind):
+    yield make_client(kind)
 
 
 def login(client, id):
@@ -131,3 +136,132 @@ def test_comment_negative(client):
                            content_type='application/json')
     # 404 - Post not found
     assert response.status_code == 404
+
+
+def test_like_counter_matches_likes(client):
+    """
+    Liking and unliking a post keeps the like_count counter equal to the number of likes
+    Example:
+    USER with ID 1 likes post with ID 4 twice and unlikes it, the counter follows the likes list every time
+    """
+    token = login(client, 1)
+
+    client.post('/api/like/4', headers={'Authorization': token}, content_type='application/json')
+    client.post('/api/like/4', headers={'Authorization': token}, content_type='application/json')
+    post = Post.objects(id=4).first()
+    assert post.like_count == len(post.likes)
+    assert client.get('/api/posts/4').json['likes'] == post.like_count
+
+    client.post('/api/unlike/4', headers={'Authorization': token}, content_type='application/json')
+    post.reload()
+    assert post.like_count == len(post.likes)
+
+
+def test_comment_counter_matches_comments(client):
+    """
+    Commenting a post increments comment_count together with the comments stored in its buckets
+    """
+    token = login(client, 1)
+    client.post('/api/comment/4',
+                headers={'Authorization': token},
+                data=json.dumps({'comment': 'Counter comment'}),
+                content_type='application/json')
+    post = Post.objects(id=4).first()
+    assert post.comment_count == sum(len(bucket.comments) for bucket in CommentBucket.objects(post=post))
+
+
+def test_comments_pages_newest_first(client):
+    """
+    Comments span several buckets, paging with the next cursor returns all of them newest first exactly once
+    """
+    token = login(client, 1)
+    post_id = Post.objects().order_by('-id').first().id
+    texts = [f'Paged comment {i}' for i in range(COMMENT_BUCKET_SIZE + 5)]
+    for text in texts:
+        client.post(f'/api/comment/{post_id}',
+                    headers={'Authorization': token},
+                    data=json.dumps({'comment': text}),
+                    content_type='application/json')
+    assert all(bucket.count <= COMMENT_BUCKET_SIZE for bucket in CommentBucket.objects(post=post_id))
+
+    read = []
+    cursor = None
+    while True:
+        url = f'/api/posts/{post_id}/comments?limit=7' + (f'&after={cursor}' if cursor else '')
+        response = client.get(url)
+        assert response.status_code == 200
+        assert len(response.json['comments']) <= 7
+        read += [comment['text'] for comment in response.json['comments']]
+        cursor = response.json['next']
+        if not cursor:
+            break
+
+    assert read[:len(texts)] == list(reversed(texts))
+    assert len(read) == Post.objects(id=post_id).first().comment_count
+
+
+def test_migrate_comments_keeps_newer_ones(client):
+    """
+    Embedded comments are merged before the comments written to buckets since, the counter keeps both, and
+    reconcile-counters refuses to run while comments are still embedded
+    """
+    token = login(client, 1)
+    post_id = Post.id.allocator.take()
+    embedded = [{'_id': f'embedded-{post_id}-{i}', 'user': 1, 'text': f'Embedded comment {i}'}
+                for i in range(COMMENT_BUCKET_SIZE + 3)]
+    Post._get_collection().insert_one({'_id': post_id, 'title': 'Legacy post', 'description': 'Legacy post',
+                                       'author': 1, 'comments': embedded, 'comment_count': len(embedded)})
+    try:
+        for text in ('Newer comment 0', 'Newer comment 1'):
+            client.post(f'/api/comment/{post_id}', headers={'Authorization': token},
+                        data=json.dumps({'comment': text}), content_type='application/json')
+        runner = app.test_cli_runner()
+        assert runner.invoke(args=['reconcile-counters']).exit_code != 0
+
+        assert runner.invoke(args=['migrate-comments']).exit_code == 0
+        post = Post._get_collection().find_one({'_id': post_id})
+        assert 'comments' not in post and post['comment_count'] == len(embedded) + 2
+        response = client.get(f'/api/posts/{post_id}/comments?limit=100')
+        texts = [comment['text'] for comment in reversed(response.json['comments'])]
+        assert texts == [comment['text'] for comment in embedded] + ['Newer comment 0', 'Newer comment 1']
+    finally:
+        Post._get_collection().delete_one({'_id': post_id})
+        CommentBucket._get_collection().delete_many({'post': post_id})
+
+
+def test_comments_of_missing_post(client):
+    response = client.get('/api/posts/1000/comments')
+    assert response.status_code == 404
+    assert 'error' in response.json
+
+    response = client.get('/api/posts/3/comments?after=bad')
+    assert response.status_code == 400
+
+
+def test_concurrent_likes_on_hot_post(client, kind):
+    """
+    Many threads like and unlike the same post at the same time as different users,
+    no update may be lost so like_count must still equal the number of likes
+    """
+    post_id = 5
+    tokens = [login(client, id) for id in range(1, 6)]
+
+    def hammer(token):
+        thread_client = make_client(kind)
+        for i in range(20):
+            action = 'like' if i % 2 == 0 else 'unlike'
+            response = thread_client.post(f'/api/{action}/{post_id}',
+                                          headers={'Authorization': token},
+                                          content_type='application/json')
+            assert response.status_code == 200
+        # leave every user liking the post
+        thread_client.post(f'/api/like/{post_id}', headers={'Authorization': token}, content_type='application/json')
+
+    with ThreadPoolExecutor(max_workers=len(tokens) * 2) as executor:
+        # every user runs in two threads so the same user also races with itself
+        list(executor.map(hammer, tokens * 2))
+
+    post = Post.objects(id=post_id).first()
+    assert len(post.likes) == len(tokens)
+    assert len(set(user.id for user in post.likes)) == len(tokens)
+    assert post.like_count == len(post.likes)
@@ -0,0 +1,129 @@
+from project.app import app
+from project import response_cache
+from project.tests import APP_KINDS, make_client
+from project.monitoring import CommandCounter, RequestMetrics, command_shape, RUNNING_COMMAND_TIMEOUT
+from pymongo import monitoring
+import datetime
+import logging
+import pytest
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    response_cache.clear()
+    client = app.test_client()
+    yield client
+
+
+def run_command(counter, command, duration_ms, request_id=1):
+    """
+    Feed a command and its reply through the listener as PyMongo would
+    """
+    address = ('localhost', 27017)
+    counter.started(monitoring.CommandStartedEvent(command, 'flask', request_id, address, request_id))
+    counter.succeeded(monitoring.CommandSucceededEvent(datetime.timedelta(milliseconds=duration_ms), {'ok': 1},
+                                                       next(iter(command)), request_id, address, request_id))
+
+
+def test_server_timing(client):
+    """
+    Every response tells how long the request spent in the database, in json encoding and in the rest of the handler
+    """
+    response = client.get('/api/posts/1')
+    assert response.status_code == 200
+    timings = dict(part.split(';', 1) for part in response.headers['Server-Timing'].split(', '))
+    assert set(timings) == {'db', 'json', 'app', 'total'}
+    assert timings['db'].endswith('desc="1 commands"')
+
+
+def test_metrics_endpoint(client):
+    """
+    The requests show up in the latency histogram of their endpoint and status
+    """
+    client.get('/api/posts/1')
+    client.get('/api/posts/100000')
+    body = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE http_request_duration_seconds histogram' in body
+    assert 'http_request_duration_seconds_count{endpoint="get_post",method="GET",status="200"}' in body
+    assert 'http_request_duration_seconds_bucket{endpoint="get_post",method="GET",status="404",le="+Inf"}' in body
+    assert 'http_request_db_commands_total{endpoint="get_post"}' in body
+    assert 'mongodb_pool_connections_in_use' in body
+    # values that only grow are counters
+    assert '# TYPE mongodb_pool_connections_in_use gauge' in body
+    assert '# TYPE mongodb_slow_commands_total counter' in body
+    assert '# TYPE like_buffer_refused_total counter' in body
+
+
+@pytest.mark.parametrize('kind', APP_KINDS)
+def test_metrics_of_both_editions(kind):
+    """
+    The async edition exports the same metrics, with the latency of its requests but not their commands
+    """
+    client = make_client(kind)
+    client.get('/api/all_posts?limit=1')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{endpoint="get_all_posts",method="GET",status="200"}' in body
+    assert '# TYPE admission_limit gauge' in body
+
+
+def test_request_metrics_histogram():
+    metrics = RequestMetrics(buckets=(0.1, 1.0))
+    metrics.observe('get_post', 'GET', 200, 0.05, 1, 0.01)
+    metrics.observe('get_post', 'GET', 200, 0.5, 2, 0.2)
+    body = metrics.render()
+    assert 'http_request_duration_seconds_bucket{endpoint="get_post",method="GET",status="200",le="0.1"} 1' in body
+    assert 'http_request_duration_seconds_bucket{endpoint="get_post",method="GET",status="200",le="1.0"} 2' in body
+    assert 'http_request_duration_seconds_count{endpoint="get_post",method="GET",status="200"} 2' in body
+    assert 'http_request_db_commands_total{endpoint="get_post"} 3' in body
+
+
+def test_command_shape_hides_values():
+    assert command_shape('find', {'find': 'user', 'filter': {'email': 'john@example.com'}}) == {'email': '?'}
+    assert command_shape('update', {'update': 'post', 'updates': [{'q': {'_id': 3, 'likes': {'$ne': 1}}}]}) == \
+        {'_id': '?', 'likes': {'$ne': '?'}}
+    assert command_shape('aggregate', {'aggregate': 'post', 'pipeline': [
+        {'$match': {'_id': {'$in': [1, 2, 3]}}}, {'$limit': 21}]}) == [{'$match': {'_id': {'$in': ['?']}}},
+                                                                        {'$limit': '?'}]
+    assert command_shape('insert', {'insert': 'post'}) is None
+
+
+def test_slow_commands_logged(caplog):
+    counter = CommandCounter(slow_ms=50)
+    with caplog.at_level(logging.WARNING, logger='project.monitoring'):
+        run_command(counter, {'find': 'user', 'filter': {'email': 'john@example.com'}}, 10, request_id=1)
+        run_command(counter, {'find': 'user', 'filter': {'email': 'john@example.com'}}, 80, request_id=2)
+
+    assert counter.count == 2
+    assert counter.duration == pytest.approx(0.09)
+    assert counter.slow_commands == 1
+    assert len(caplog.records) == 1
+    assert '{"email": "?"}' in caplog.text
+    assert 'john@example.com' not in caplog.text
+
+
+def test_unfinished_commands_forgotten():
+    """
+    A command whose reply is never reported is dropped from the running ones once RUNNING_COMMAND_TIMEOUT passed
+    """
+    now = [0.0]
+    counter = CommandCounter(slow_ms=50, clock=lambda: now[0])
+    address = ('localhost', 27017)
+    counter.started(monitoring.CommandStartedEvent({'find': 'user'}, 'flask', 1, address, 1))
+    now[0] += RUNNING_COMMAND_TIMEOUT + 1
+    run_command(counter, {'find': 'user', 'filter': {}}, 10, request_id=2)
+    assert len(counter._running) == 0
+
+
+def test_commands_recorded_in_block():
+    """
+    Only the commands started while the recording block runs are kept
+    """
+    counter = CommandCounter()
+    run_command(counter, {'find': 'user', 'filter': {'_id': 1}}, 1, request_id=1)
+    with counter.recording() as recorded:
+        run_command(counter, {'find': 'post', 'filter': {'_id': 2}}, 1, request_id=2)
+    run_command(counter, {'find': 'post', 'filter': {'_id': 3}}, 1, request_id=3)
+    assert [event.command['filter'] for event in recorded] == [{'_id': 2}]
@@ -0,0 +1,69 @@
+from project.app import app
+from project import reconnect_db
+from project.models import User
+from project.monitoring import PoolMonitor
+from project.tests import APP_KINDS, make_client
+from pymongo import monitoring
+import os
+import pytest
+
+
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    yield make_client(request.param)
+
+
+def test_pool_settings_applied():
+    """
+    The pool options of MONGODB_SETTINGS reach the client and nothing is connected before the first query
+    """
+    settings = app.config['MONGODB_SETTINGS']
+    pool_options = User._get_db().client.options.pool_options
+    assert pool_options.max_pool_size == settings['maxPoolSize']
+    assert pool_options.min_pool_size == settings['minPoolSize']
+    assert settings['connect'] is False
+
+
+def test_reconnect_db_builds_new_client():
+    """
+    reconnect_db, run in every worker after the fork, replaces the client and the documents use the new one
+    """
+    before = User._get_db().client
+    reconnect_db()
+    assert User._get_db().client is not before
+    assert User.objects(id=1).only('id').first() is not None
+
+
+def test_pool_monitor_measures_checkouts():
+    monitor = PoolMonitor()
+    address = ('localhost', 27017)
+    monitor.connection_created(monitoring.ConnectionCreatedEvent(address, 1))
+    monitor.connection_check_out_started(monitoring.ConnectionCheckOutStartedEvent(address))
+    monitor.connection_checked_out(monitoring.ConnectionCheckedOutEvent(address, 1))
+    assert monitor.stats()['in_use'] == 1
+
+    monitor.connection_checked_in(monitoring.ConnectionCheckedInEvent(address, 1))
+    monitor.connection_check_out_started(monitoring.ConnectionCheckOutStartedEvent(address))
+    monitor.connection_check_out_failed(monitoring.ConnectionCheckOutFailedEvent(
+        address, monitoring.ConnectionCheckOutFailedReason.TIMEOUT))
+
+    stats = monitor.stats()
+    assert stats['open'] == 1
+    assert stats['in_use'] == 0
+    assert stats['max_in_use'] == 1
+    assert stats['checkouts'] == 1
+    assert stats['checkout_failures'] == stats['checkout_timeouts'] == 1
+    assert stats['wait_max_ms'] >= stats['wait_avg_ms'] >= 0
+
+
+def test_pool_stats(client):
+    """
+    The stats of the worker serving the request, once a query ran a connection was checked out and returned
+    """
+    client.get('/api/posts/1')
+    response = client.get('/api/pool/stats')
+    assert response.status_code == 200
+    assert response.json['pid'] == os.getpid()
+    assert response.json['max_pool_size'] == app.config['MONGODB_SETTINGS']['maxPoolSize']
+    assert response.json['checkouts'] >= 1
+    assert response.json['in_use'] == 0
@@ -1,14 +1,15 @@
 from project.app import app
+from project import response_cache
+from project.tests import APP_KINDS, make_client
 from project.models import User, Post
+import datetime
 import json
 import pytest
 
 
-@pytest.fixture
-def client():
-    app.config['TESTING'] = True
-    client = app.test_client()
-    yield client
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    yield make_client(request.param)
 
 
 def login(client, id):
@@ -62,7 +63,93 @@ def test_get_all_posts(client):
     """
     response = client.get('/api/all_posts')
     assert response.status_code == 200
-    assert len(response.json) > 0
+    assert len(response.json['posts']) > 0
+    assert 'next' in response.json
+
+
+def test_get_all_posts_pagination(client):
+    """
+    Walk all posts 5 at a time with the next cursor, posts come in creation order and never repeat
+    """
+    ids = walk_all_posts(client, 5)
+    assert ids == [str(id) for id in Post.objects().order_by('created_time', 'id').scalar('id')]
+
+
+def walk_all_posts(client, limit):
+    """
+    Follow the next cursors of /api/all_posts to the last page
+    :return: ids of the posts of every page
+    """
+    ids = []
+    cursor = None
+    while True:
+        url = f'/api/all_posts?limit={limit}&after={cursor}' if cursor else f'/api/all_posts?limit={limit}'
+        response = client.get(url)
+        assert response.status_code == 200
+        assert len(response.json['posts']) <= limit
+        ids += [post['id'] for post in response.json['posts']]
+        cursor = response.json['next']
+        if not cursor:
+            return ids
+
+
+def test_all_posts_in_creation_order(client):
+    """
+    Every process takes post ids from its own block, a post created later may have a smaller id: the pages and their
+    cursors follow the created time
+    """
+    smaller, larger = Post.id.allocator.take(), Post.id.allocator.take()
+    now = datetime.datetime.utcnow()
+    posts = Post._get_collection()
+    posts.insert_many([{'_id': id, 'title': title, 'description': title, 'author': 1, 'created_time': created,
+                        'like_count': 0, 'comment_count': 0}
+                       for id, title, created in ((larger, 'Created first', now),
+                                                  (smaller, 'Created next', now + datetime.timedelta(seconds=1)))])
+    response_cache.clear()  # the posts are written behind the back of the cache
+    try:
+        ids = walk_all_posts(client, 2)
+        assert ids[-2:] == [str(larger), str(smaller)]
+        assert len(ids) == len(set(ids)) == Post.objects().count()
+    finally:
+        posts.delete_many({'_id': {'$in': [smaller, larger]}})
+        response_cache.clear()
+
+
+def test_get_all_posts_invalid_cursor(client):
+    """
+    Non numeric cursor or limit is a bad request
+    """
+    response = client.get('/api/all_posts?after=abc')
+    assert response.status_code == 400
+    assert 'error' in response.json
+
+    response = client.get(f'/api/all_posts?after={10 ** 20}:1')
+    assert response.status_code == 400
+
+    response = client.get('/api/all_posts?limit=0')
+    assert response.status_code == 400
+
+
+def test_stream_all_posts(client):
+    """
+    Export all posts as ndjson, one post per line, same posts as the paginated listing
+    """
+    response = client.get('/api/all_posts/stream')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+
+    posts = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert len(posts) == Post.objects().count()
+    assert all('id' in post and 'likes' in post for post in posts)
+
+
+def test_all_posts_accept_ndjson(client):
+    """
+    Asking /api/all_posts for ndjson returns the streaming export
+    """
+    response = client.get('/api/all_posts', headers={'Accept': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
 
 
 def test_post_create(client):
@@ -91,6 +178,19 @@ def test_post_create(client):
     assert 'Created Time(UTC)' in response.json
 
 
+def test_post_created_time_is_now(client):
+    """
+    Both editions stamp a new post with the time it was created, not a time taken once when the app was imported
+    """
+    token = login(client, 1)
+    before = datetime.datetime.utcnow().replace(microsecond=0)
+    response = client.post('/api/posts', data=json.dumps({'title': 'Timed post', 'description': 'Timed post'}),
+                           headers={'Authorization': token}, content_type='application/json')
+    assert response.status_code == 200
+    created = Post.objects(id=int(response.json['id'])).only('created_time').first().created_time
+    assert before <= created <= datetime.datetime.utcnow()
+
+
 def test_post_create_negative(client):
     """
     Try to create a post with missing title by authorized user
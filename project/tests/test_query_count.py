@@ -0,0 +1,192 @@
+from project.app import app
+from project import response_cache
+from project.models import User, Post, Follow, TimelineEntry
+from project.monitoring import command_counter
+from project.views import token_serializer, trending
+
+import json
+import pytest
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    # the first use of a collection creates its indexes, do it before counting
+    for model in (User, Post, Follow, TimelineEntry):
+        model._get_collection()
+    response_cache.clear()  # cached responses make no queries at all
+    client = app.test_client()
+    yield client
+
+
+def login(client, id):
+    """
+    Login user with given id
+    :param client:
+    :param id:
+    :return: TOKEN
+    """
+    USER = User.objects(id=id).first()
+    response = client.post('/api/authenticate',
+                           data=json.dumps({'email': USER.email, 'password': USER.password}),
+                           content_type='application/json')
+
+    assert response.status_code == 200
+    token = response.json['token']
+    return token
+
+
+def count_commands(request, *args, **kwargs):
+    """
+    Run one request and count the database commands it issued
+    :param request: test client method, e.g. client.get
+    :return: tuple (response, number of commands)
+    """
+    before = command_counter.count
+    response = request(*args, **kwargs)
+    return response, command_counter.count - before
+
+
+def test_authenticate_query_count(client):
+    USER = User.objects(id=1).first()
+    response, commands = count_commands(client.post, '/api/authenticate',
+                                        data=json.dumps({'email': USER.email, 'password': USER.password}),
+                                        content_type='application/json')
+    assert response.status_code == 200
+    assert commands == 1
+
+
+def test_public_reads_query_count(client):
+    """
+    get_post and a page of all_posts are one query each
+    """
+    response, commands = count_commands(client.get, '/api/posts/3')
+    assert response.status_code == 200
+    assert commands == 1
+
+    response, commands = count_commands(client.get, '/api/all_posts?limit=5')
+    assert response.status_code == 200
+    assert commands == 1
+
+
+def test_user_profile_query_count(client):
+    """
+    The token carries the user id, the profile is the only read
+    """
+    token = login(client, 1)
+    response, commands = count_commands(client.get, '/api/user', headers={'Authorization': token})
+    assert response.status_code == 200
+    assert commands == 1
+
+
+def test_legacy_token_query_count(client):
+    """
+    Tokens without the id claim still work at the cost of one email lookup
+    """
+    token = token_serializer(app.config['SECRET_KEY']).dumps({'email': User.objects(id=1).first().email})
+    response, commands = count_commands(client.get, '/api/user', headers={'Authorization': token})
+    assert response.status_code == 200
+    assert commands == 2
+
+
+def test_like_and_unlike_query_count(client):
+    """
+    Like and unlike write by user id without reading the user or the post, the unlike takes back from trend_score what
+    the like recorded in the same update
+    """
+    token = login(client, 1)
+    headers = {'Authorization': token}
+    client.post('/api/unlike/3', headers=headers)
+
+    response, commands = count_commands(client.post, '/api/like/3', headers=headers)
+    assert response.json['message'] == 'Post liked successfully'
+    assert commands == 1
+
+    response, commands = count_commands(client.post, '/api/unlike/3', headers=headers)
+    assert response.json['message'] == 'Post unliked successfully'
+    assert commands == 1
+
+
+def test_comment_query_count(client):
+    """
+    The comment counter of the post and the append to its open bucket
+    """
+    token = login(client, 1)
+    response, commands = count_commands(client.post, '/api/comment/3',
+                                        headers={'Authorization': token},
+                                        data=json.dumps({'comment': 'Counted comment'}),
+                                        content_type='application/json')
+    assert response.status_code == 200
+    assert commands == 2
+
+
+def test_follow_query_count(client):
+    """
+    Follow and unfollow check the other user, change the edge and update both counters in one bulk write,
+    unfollow also clears the posts of that user from the feed
+    """
+    token = login(client, 4)
+    headers = {'Authorization': token}
+    client.post('/api/unfollow/5', headers=headers)
+
+    response, commands = count_commands(client.post, '/api/follow/5', headers=headers)
+    assert response.json['message'] == 'User followed successfully'
+    assert commands == 3
+
+    response, commands = count_commands(client.post, '/api/unfollow/5', headers=headers)
+    assert response.status_code == 200
+    assert commands == 4
+
+
+def test_create_and_delete_post_query_count(client):
+    """
+    Creating a post reads the follower count of the author, inserts and fans out to the followers, the id comes
+    from the block reserved by the process, deleting your own post deletes it, its timeline entries and its comments
+    """
+    token = login(client, 1)
+    Post.id.allocator.take()  # make sure a block is reserved
+    fan_out = 2 if Follow.objects(followee=1).count() else 1  # the follower edges and, if any, one insert_many
+    headers = {'Authorization': token}
+    response, commands = count_commands(client.post, '/api/posts', headers=headers,
+                                        data=json.dumps({'title': 'Counted post', 'description': 'Counted post'}),
+                                        content_type='application/json')
+    assert response.status_code == 200
+    assert commands == 2 + fan_out
+
+    response, commands = count_commands(client.delete, f'/api/posts/{response.json["id"]}', headers=headers)
+    assert response.status_code == 200
+    assert commands == 3
+
+
+def test_batch_query_count(client):
+    """
+    A batch reads the posts, the users and the follow edges once and sends one bulk write per collection,
+    the number of commands does not grow with the number of operations, only with the posts commented and the users
+    unfollowed
+    """
+    token = login(client, 5)
+    headers = {'Authorization': token}
+    client.post('/api/batch', headers=headers, content_type='application/json',
+                data=json.dumps({'operations': [{'op': 'unfollow', 'id': id} for id in range(1, 4)] +
+                                               [{'op': 'follow', 'id': 4}]}))
+    operations = [{'op': 'like', 'id': id} for id in range(1, 11)] + \
+                 [{'op': 'comment', 'id': id, 'comment': 'Counted comment'} for id in range(1, 11)] + \
+                 [{'op': 'follow', 'id': id} for id in range(1, 4)] + [{'op': 'unfollow', 'id': 4}]
+    response, commands = count_commands(client.post, '/api/batch', headers=headers, content_type='application/json',
+                                        data=json.dumps({'operations': operations}))
+    assert response.status_code == 200
+    assert commands == 8 + 10 + 1  # the comment_count of every commented post, the edge of the unfollow
+
+    response, commands = count_commands(client.get, '/api/posts?ids=' + ','.join(str(id) for id in range(1, 11)))
+    assert len(response.json['posts']) == 10
+    assert commands == 1
+
+
+def test_trending_query_count(client):
+    """
+    Trending posts are served from the ranking kept in memory, only its reload reads the database
+    """
+    trending.refresh()
+    response, commands = count_commands(client.get, '/api/trending')
+    assert response.status_code == 200
+    assert commands == 0
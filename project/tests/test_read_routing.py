@@ -0,0 +1,143 @@
+import json
+import time
+import pytest
+from bson import Timestamp
+from itsdangerous import URLSafeSerializer
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+from project.app import app
+from project.routing import read_preference, dump_read_after, load_read_after, READ_AFTER_COOKIE
+from project.tests import APP_KINDS, make_client
+from project.models import User, Post
+from project.views import public_collection, public_read_preference, read_after_serializer, response_cache
+
+
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    yield make_client(request.param)
+
+
+@pytest.fixture
+def replica_set():
+    """
+    The causal reads need a replica set, e.g. a single member one started with --replSet
+    """
+    if 'setName' not in Post._get_db().command('hello'):
+        pytest.skip('the test database is not a replica set')
+
+
+def login(client, id):
+    """
+    Login user with given id
+    :param client:
+    :param id:
+    :return: TOKEN
+    """
+    USER = User.objects(id=id).first()
+    response = client.post('/api/authenticate',
+                           data=json.dumps({'email': USER.email, 'password': USER.password}),
+                           content_type='application/json')
+
+    assert response.status_code == 200
+    return response.json['token']
+
+
+def read_after_cookie(response):
+    """
+    :return: value of the read_after cookie set by the response, None if there is none
+    """
+    for header in response.headers.getlist('Set-Cookie'):
+        name, _, value = header.partition(';')[0].partition('=')
+        if name == READ_AFTER_COOKIE:
+            return value
+    return None
+
+
+def test_read_preference():
+    assert read_preference('primary', 90) == Primary()
+    preference = read_preference('secondaryPreferred', 120)
+    assert isinstance(preference, SecondaryPreferred) and preference.max_staleness == 120
+    with pytest.raises(ValueError):
+        read_preference('secondaryFirst')
+
+
+def test_read_after_cookie():
+    serializer = URLSafeSerializer('secret', salt='read-after')
+    value = dump_read_after(serializer, Timestamp(1000, 7))
+    assert load_read_after(serializer, value, 90, clock=lambda: 1050) == Timestamp(1000, 7)
+    assert load_read_after(serializer, value, 90, clock=lambda: 1100) is None  # older than the window
+    assert load_read_after(serializer, value[:-1] + 'x', 90, clock=lambda: 1050) is None  # not signed by us
+    assert load_read_after(URLSafeSerializer('other'), value, 90, clock=lambda: 1050) is None
+    assert load_read_after(serializer, None, 90) is None
+
+
+def test_public_reads_follow_read_preference():
+    """
+    Public reads use MONGODB_READ_PREFERENCE, a client that just wrote reads from the primary
+    """
+    with app.test_request_context('/api/posts/1'):
+        assert public_collection(Post).read_preference == public_read_preference()
+
+    cookie = dump_read_after(read_after_serializer(app.config['SECRET_KEY']), Timestamp(int(time.time()), 1))
+    with app.test_request_context('/api/posts/1', headers={'Cookie': f'{READ_AFTER_COOKIE}={cookie}'}):
+        assert public_collection(Post).read_preference == Primary()
+
+
+def test_primary_writes_no_cookie(client):
+    """
+    With public reads on the primary already, creating a post sets no read_after cookie
+    """
+    mode, app.config['MONGODB_READ_PREFERENCE'] = app.config['MONGODB_READ_PREFERENCE'], 'primary'
+    try:
+        token = login(client, 1)
+        response = client.post('/api/posts', headers={'Authorization': token},
+                                json={'title': 'Routed post', 'description': 'Routed post'})
+        assert response.status_code == 200
+        assert read_after_cookie(response) is None
+    finally:
+        app.config['MONGODB_READ_PREFERENCE'] = mode
+
+
+def test_public_reads_without_secret_key(client, monkeypatch):
+    """
+    A client sending no read_after cookie reads the public routes whether SECRET_KEY is set or not
+    """
+    monkeypatch.setitem(app.config, 'SECRET_KEY', None)
+    response_cache.clear()
+    for url in ('/api/posts/1', '/api/all_posts', '/api/posts/1/comments'):
+        assert client.get(url).status_code != 500, url
+
+
+def test_author_reads_own_post(client, replica_set):
+    """
+    USER with ID 1 creates a post, gets a read_after cookie and reads the post back at once, from the primary and
+    never from the response cache
+    """
+    token = login(client, 1)
+    response = client.post('/api/posts', headers={'Authorization': token},
+                           json={'title': 'Causal post', 'description': 'Causal post'})
+    assert response.status_code == 200
+    assert read_after_cookie(response)
+    post_id = response.json['id']
+
+    hits = response_cache.hits
+    for _ in range(2):
+        response = client.get(f'/api/posts/{post_id}')
+        assert response.status_code == 200
+        assert response.json['title'] == 'Causal post'
+    assert response_cache.hits == hits
+
+
+def test_author_reads_own_comment(client, replica_set):
+    """
+    USER with ID 2 comments on post with ID 1 and finds the comment first in the comments of the post
+    """
+    token = login(client, 2)
+    response = client.post('/api/comment/1', headers={'Authorization': token}, json={'comment': 'Causal comment'})
+    assert response.status_code == 200
+    assert read_after_cookie(response)
+    comment_id = response.json['Comment-ID']
+
+    response = client.get('/api/posts/1/comments?limit=1')
+    assert response.status_code == 200
+    assert response.json['comments'][0]['id'] == comment_id
@@ -0,0 +1,128 @@
+import json
+import os
+
+import pytest
+
+from project import response_cache
+from project.app import app
+from project.models import User, Post, Follow, CommentBucket
+from project.seed import SEED_PASSWORD
+from project.tests import make_client
+from project.views import MAX_PAGE_SIZE, next_created_cursor
+
+# run against the dataset of the scale_dataset fixture, the flask app only: the async edition keeps its own client
+pytestmark = pytest.mark.scale
+
+
+@pytest.fixture
+def client(scale_dataset):
+    response_cache.clear()
+    yield make_client('wsgi')
+
+
+def login(client, id):
+    """
+    Login the seeded user with given id
+    :return: TOKEN
+    """
+    response = client.post('/api/authenticate',
+                           data=json.dumps({'email': f'user{id}@example.com', 'password': SEED_PASSWORD}),
+                           content_type='application/json')
+    assert response.status_code == 200
+    return response.json['token']
+
+
+def walk(client, url, key, headers=None):
+    """
+    Follow the next cursors of a paginated route to its last page
+    :param key: key of the listed items in the json response
+    :return: list of the items of every page
+    """
+    items, after = [], None
+    while True:
+        response = client.get(f'{url}?limit={MAX_PAGE_SIZE}' + (f'&after={after}' if after else ''), headers=headers)
+        assert response.status_code == 200
+        items += response.json[key]
+        after = response.json['next']
+        if after is None:
+            return items
+
+
+def test_dataset_skewed(scale_dataset):
+    """
+    A few users hold a large share of the follows and a few posts of the likes and comments, counters match
+    """
+    celebrity = User.objects(id=scale_dataset['most_followed_ids'][0]).first()
+    assert celebrity.follower_count == Follow.objects(followee=celebrity.id).count()
+    assert celebrity.follower_count > 5 * scale_dataset['follows'] / scale_dataset['users']
+
+    post = Post.objects(id=scale_dataset['hot_post_ids'][0]).as_pymongo().first()
+    assert post['like_count'] == len(post['likes'])
+    buckets = CommentBucket.objects(post=post['_id']).only('count')
+    assert post['comment_count'] == sum(bucket.count for bucket in buckets)
+    interactions = (scale_dataset['likes'] + scale_dataset['comments']) / scale_dataset['posts']
+    assert post['like_count'] + post['comment_count'] > 10 * interactions
+
+
+def test_long_thread(client, scale_dataset):
+    """
+    Every comment of the hottest post is listed once across the pages
+    """
+    post = Post.objects(id=scale_dataset['hot_post_ids'][0]).only('comment_count').first()
+    comments = walk(client, f'/api/posts/{post.id}/comments', 'comments')
+    assert len(comments) == post.comment_count
+    assert len({comment['id'] for comment in comments}) == post.comment_count
+
+
+def test_followers_of_most_followed(client, scale_dataset):
+    celebrity = User.objects(id=scale_dataset['most_followed_ids'][0]).only('follower_count').first()
+    followers = [int(user['id']) for user in walk(client, f'/api/users/{celebrity.id}/followers', 'users')]
+    assert len(followers) == celebrity.follower_count
+    assert followers == sorted(set(followers))
+
+
+def test_feed_merges_popular_authors(client, scale_dataset):
+    """
+    The feed of a follower of a user over FEED_FANOUT_LIMIT holds the posts of every user it follows, newest first,
+    whether they were fanned out to its timeline or are merged on read
+    """
+    celebrity = User.objects(id=scale_dataset['most_followed_ids'][0]).only('follower_count').first()
+    assert celebrity.follower_count >= app.config['FEED_FANOUT_LIMIT']
+    reader = Follow.objects(followee=celebrity.id).as_pymongo().first()['follower']
+    followees = [edge['followee'] for edge in Follow.objects(follower=reader).only('followee').as_pymongo()]
+    expected = [str(id) for id in Post.objects(author__in=followees).order_by('-created_time', '-id').scalar('id')]
+
+    token = login(client, reader)
+    feed = walk(client, '/api/feed', 'posts', headers={'Authorization': token})
+    assert [post['id'] for post in feed] == expected
+
+
+def test_all_posts_deep_cursor(client, scale_dataset):
+    """
+    Pages read from a cursor at the end of the collection hold the posts after it, as on the first pages
+    the seeded posts were created in the order of their ids
+    """
+    post_ids = scale_dataset['post_ids']
+
+    def cursor(id):
+        return next_created_cursor(Post.objects(id=id).only('created_time').first().created_time, id)
+
+    response = client.get(f'/api/all_posts?limit={MAX_PAGE_SIZE}&after={cursor(post_ids[-2 * MAX_PAGE_SIZE - 1])}')
+    assert response.status_code == 200
+    expected = post_ids[-2 * MAX_PAGE_SIZE:-MAX_PAGE_SIZE]
+    assert [post['id'] for post in response.json['posts']] == [str(id) for id in expected]
+    assert response.json['next'] == cursor(post_ids[-MAX_PAGE_SIZE - 1])
+
+
+def test_unlike_and_like_hot_post(client, scale_dataset):
+    if os.environ['SCALE_DB'] == 'mongomock':
+        pytest.skip('mongomock cannot $inc the Decimal128 trend scores')
+    # read raw, the likers of a hot post are too many to load as users
+    post = Post.objects(id=scale_dataset['hot_post_ids'][0]).only('like_count', 'likes').as_pymongo().first()
+    token = login(client, post['likes'][0])
+
+    response = client.post(f'/api/unlike/{post["_id"]}', headers={'Authorization': token})
+    assert response.json['message'] == 'Post unliked successfully'
+    response = client.post(f'/api/like/{post["_id"]}', headers={'Authorization': token})
+    assert response.json['message'] == 'Post liked successfully'
+    assert Post.objects(id=post['_id']).only('like_count').first().like_count == post['like_count']
@@ -0,0 +1,68 @@
+import pytest
+
+from project.app import app
+from project.tests import APP_KINDS, make_client
+from project.models import User, Post
+
+
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    yield make_client(request.param)
+
+
+@pytest.fixture(scope='module')
+def posts():
+    """
+    Posts with words found nowhere else in the database, removed at the end
+    """
+    Post.ensure_indexes()
+    author = User.objects(id=1).first()
+    created = [Post(title='Quokkasearch sunset', description='A walk on the beach', author=author),
+               Post(title='Morning run', description='Saw a quokkasearch on the way', author=author)]
+    created += [Post(title=f'Wombatsearch diary {i}', description='Wombatsearch', author=author) for i in range(5)]
+    for post in created:
+        post.save(force_insert=True)
+    yield created
+    for post in created:
+        post.delete()
+
+
+def test_search_ranks_title_first(client, posts):
+    """
+    Both posts contain the word, the one with it in the title is more relevant
+    """
+    response = client.get('/api/search?q=quokkasearch')
+    assert response.status_code == 200
+    ids = [post['id'] for post in response.json['posts']]
+    assert ids == [str(posts[0].id), str(posts[1].id)]
+    assert response.json['posts'][0]['score'] > response.json['posts'][1]['score']
+    assert {'title', 'desc', 'likes', 'comments'} <= set(response.json['posts'][0])
+    assert response.json['next'] is None
+
+
+def test_search_pages(client, posts):
+    """
+    Following the next cursor returns every match once
+    """
+    seen = []
+    url = '/api/search?q=wombatsearch&limit=2'
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        assert len(response.json['posts']) <= 2
+        seen += [post['id'] for post in response.json['posts']]
+        url = f'/api/search?q=wombatsearch&limit=2&after={response.json["next"]}' if response.json['next'] else None
+    assert sorted(seen) == sorted(str(post.id) for post in posts[2:])
+
+
+def test_search_no_match(client, posts):
+    response = client.get('/api/search?q=nosuchwordanywhere')
+    assert response.status_code == 200
+    assert response.json == {'posts': [], 'next': None}
+
+
+@pytest.mark.parametrize('query', ['', 'q=', 'q=' + 'a' * 201, 'q=quokkasearch&after=bad', 'q=quokkasearch&limit=0'])
+def test_search_invalid(client, query):
+    response = client.get(f'/api/search?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.json
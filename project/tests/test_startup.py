@@ -0,0 +1,94 @@
+import inspect
+import os
+import subprocess
+import sys
+import textwrap
+
+from flask import url_for
+from werkzeug.routing import Rule
+
+from project.app import app
+from project.rules import LazyBuilderRule
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+
+def run_fresh(code, **env):
+    """
+    Run code in a new interpreter importing the app from scratch
+    :param env: environment variables set for it, None removes one
+    :return: completed process
+    """
+    env = {**os.environ, 'SECRET_KEY': 'startup', 'PYTHONPATH': ROOT, **env}
+    return subprocess.run([sys.executable, '-c', textwrap.dedent(code)], cwd=ROOT, capture_output=True, text=True,
+                          timeout=120, env={name: value for name, value in env.items() if value is not None})
+
+
+def test_urls_built_on_demand():
+    # but the static route, added by Flask before the rule class is set
+    assert all(isinstance(rule, LazyBuilderRule) for rule in app.url_map.iter_rules() if rule.endpoint != 'static')
+    with app.test_request_context():
+        assert url_for('get_post', id=3) == '/api/posts/3'
+        assert url_for('get_all_posts', limit=10) == '/api/all_posts?limit=10'
+        assert url_for('get_post', id=4, _external=True) == 'http://localhost/api/posts/4'
+
+
+def test_private_builder_hook_unchanged():
+    """
+    LazyBuilderRule relies on Werkzeug internals: Rule.compile binds Rule._compile_builder(append_unknown) to the rule
+    as _build and _build_unknown, and each stub replaces itself on its first call
+    """
+    parameters = list(inspect.signature(Rule._compile_builder).parameters.values())
+    assert [parameter.name for parameter in parameters] == ['self', 'append_unknown']
+    assert parameters[1].default is True
+    source = inspect.getsource(Rule.compile)
+    assert 'self._build = self._compile_builder(False).__get__(self, None)' in source
+    assert 'self._build_unknown = self._compile_builder(True).__get__(self, None)' in source
+
+    rule = next(rule for rule in app.url_map.iter_rules() if rule.endpoint == 'get_post')
+    assert rule.build({'id': 5}, append_unknown=False) == ('', '/api/posts/5')
+    assert rule.build({'id': 6, 'x': 1}) == ('', '/api/posts/6?x=1')
+    assert rule._build.__func__.__name__ != 'build' and rule._build_unknown.__func__.__name__ != 'build'
+
+
+def test_lazy_init_skips_srv_lookup():
+    """
+    With LAZY_INIT the app imports without resolving a mongodb+srv url, here one that does not resolve at all
+    """
+    process = run_fresh('''
+        from project import db
+        from project.app import app
+        assert db.app is None
+    ''', LAZY_INIT='1', REUNION_DB='mongodb+srv://cluster0.reunion.invalid/reunion')
+    assert process.returncode == 0, process.stderr
+
+
+def test_lazy_init_on_first_request():
+    process = run_fresh('''
+        from mongoengine.connection import get_db
+        from project import db
+        from project.app import app
+        assert db.app is None
+        assert app.test_client().get('/api/pool/stats').status_code == 200
+        assert db.app is app and get_db().name == 'reunion'
+    ''', LAZY_INIT='1', REUNION_DB='mongodb://localhost:1/reunion')
+    assert process.returncode == 0, process.stderr
+
+
+def test_import_without_secret_key():
+    """
+    The views and the commands import without SECRET_KEY, the serializers are only built once a token is signed
+    """
+    process = run_fresh('''
+        import project.commands
+        from project.app import app
+        from project.views import token_serializer
+        assert app.config['SECRET_KEY'] is None
+        try:
+            token_serializer(app.config['SECRET_KEY'])
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('signed without SECRET_KEY')
+    ''', SECRET_KEY=None, REUNION_DB='mongodb://localhost:1/reunion')
+    assert process.returncode == 0, process.stderr
@@ -0,0 +1,137 @@
+import datetime
+import json
+import time
+import pytest
+
+from project.app import app
+from project.tests import APP_KINDS, make_client
+from project.models import User, Post
+from project.trending import TrendingRanking, trend_increment, decayed_score, like_score_field, LIKE_WEIGHT
+from project.views import trending
+
+
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    yield make_client(request.param)
+
+
+def login(client, id):
+    """
+    Login user with given id
+    :param client:
+    :param id:
+    :return: TOKEN
+    """
+    USER = User.objects(id=id).first()
+    response = client.post('/api/authenticate',
+                           data=json.dumps({'email': USER.email, 'password': USER.password}),
+                           content_type='application/json')
+
+    assert response.status_code == 200
+    return response.json['token']
+
+
+@pytest.fixture
+def posts(client):
+    """
+    Two new posts, the first one commented twice and the second one liked once
+    """
+    headers = {'Authorization': login(client, 1)}
+    ids = [client.post('/api/posts', headers=headers, json={'title': 'Trending', 'description': 'Trending'}).json['id']
+           for _ in range(2)]
+    for _ in range(2):
+        assert client.post(f'/api/comment/{ids[0]}', headers=headers, json={'comment': 'Hot'}).status_code == 200
+    assert client.post(f'/api/like/{ids[1]}', headers=headers).status_code == 200
+    yield ids
+    for id in ids:
+        client.delete(f'/api/posts/{id}', headers=headers)
+
+
+def test_trend_increment_doubles_every_half_life():
+    now = datetime.datetime.utcnow()
+    later = now + datetime.timedelta(hours=app.config['TRENDING_HALF_LIFE'])
+    assert decayed_score(trend_increment(1, later), now) == pytest.approx(2)
+    # a like stored a half-life ago weighs half a like happening now
+    assert decayed_score(trend_increment(1, now), later) == pytest.approx(0.5)
+
+
+def test_trending_ranks_by_score(client, posts):
+    trending.refresh()
+    response = client.get('/api/trending?limit=100')
+    assert response.status_code == 200
+    ranked = [post['id'] for post in response.json['posts']]
+    assert ranked.index(posts[0]) < ranked.index(posts[1])  # two comments weigh more than one like
+    scores = [post['score'] for post in response.json['posts']]
+    assert scores == sorted(scores, reverse=True)
+    first = response.json['posts'][ranked.index(posts[0])]
+    assert first['comments'] == 2 and first['score'] == pytest.approx(4, rel=0.01)
+
+
+def test_unlike_takes_the_like_back(client, posts):
+    headers = {'Authorization': login(client, 1)}
+    assert client.post(f'/api/unlike/{posts[1]}', headers=headers).status_code == 200
+    assert decayed_score(Post.objects(id=posts[1]).scalar('trend_score').first()) == pytest.approx(0, abs=0.01)
+
+
+def test_unlike_takes_back_what_the_like_added(client, posts):
+    """
+    A like written a half-life ago is taken back at its own weight, not at the doubled one of a like happening now
+    """
+    half_life_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=app.config['TRENDING_HALF_LIFE'])
+    earlier = trend_increment(LIKE_WEIGHT, half_life_ago)
+    Post._get_collection().update_one({'_id': int(posts[1])},
+                                      {'$set': {'trend_score': earlier, like_score_field(1): earlier}})
+    headers = {'Authorization': login(client, 1)}
+    assert client.post(f'/api/unlike/{posts[1]}', headers=headers).status_code == 200
+    post = Post._get_collection().find_one({'_id': int(posts[1])})
+    assert post['trend_score'].to_decimal() == 0
+    assert '1' not in post.get('like_scores', {})
+
+
+@pytest.mark.parametrize('limit', ['0', 'many', '100000'])
+def test_trending_invalid_limit(client, limit):
+    response = client.get(f'/api/trending?limit={limit}')
+    assert response.status_code == 400
+    assert 'error' in response.json
+
+
+def test_ranking_served_until_stale():
+    """
+    Reads are answered from memory, a stale ranking is still served while a background thread reloads it
+    """
+    loads = []
+    max_age = [60]
+    ranking = TrendingRanking(lambda size: loads.append(size) or [len(loads)] * size, lambda: 3, lambda: max_age[0])
+    assert ranking.top(2, wait=False) is None
+    assert ranking.top(2) == [1, 1]
+    assert ranking.top(3) == [1, 1, 1]
+    assert loads == [3]
+
+    max_age[0] = 0
+    assert ranking.top(2) == [1, 1]  # stale, the reload runs in the background
+    for _ in range(100):
+        if ranking.stats()['refreshes'] == 2:
+            break
+        time.sleep(0.01)
+    assert ranking.top(2)[0] == 2
+    assert ranking.stats()['size'] == 3
+
+
+def test_ranking_kept_when_reload_fails():
+    calls = []
+
+    def load(size):
+        calls.append(size)
+        if len(calls) > 1:
+            raise RuntimeError('database down')
+        return ['post']
+
+    ranking = TrendingRanking(load, lambda: 10, lambda: 0)
+    assert ranking.top(1) == ['post']
+    ranking.top(1)
+    for _ in range(100):
+        if ranking.stats()['refresh_failures']:
+            break
+        time.sleep(0.01)
+    assert ranking.stats()['refresh_failures'] == 1
+    assert ranking.top(1) == ['post']
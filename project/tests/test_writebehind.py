@@ -0,0 +1,180 @@
+import json
+import threading
+import pytest
+
+from project.app import app
+from project.writebehind import HotKeys, LikeBuffer
+from project.tests import APP_KINDS, make_client
+from project.models import User, Post
+from project import views
+from project.views import like_buffer
+
+
+@pytest.fixture(params=APP_KINDS)
+def client(request):
+    client = make_client(request.param)
+    app.config.update(LIKE_WRITE_BEHIND=True, LIKE_HOT_THRESHOLD=0)  # every post is hot
+    yield client
+    like_buffer.flush()
+    app.config.update(LIKE_WRITE_BEHIND=False, LIKE_HOT_THRESHOLD=20)
+
+
+def login(client, id):
+    """
+    Login user with given id
+    :param client:
+    :param id:
+    :return: TOKEN
+    """
+    USER = User.objects(id=id).first()
+    response = client.post('/api/authenticate',
+                           data=json.dumps({'email': USER.email, 'password': USER.password}),
+                           content_type='application/json')
+
+    assert response.status_code == 200
+    return response.json['token']
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_buffer(write, max_batch=100, max_buffered=100):
+    # an interval long enough for the flush thread never to run during a test
+    return LikeBuffer(write, lambda: 3600, lambda: max_batch, lambda: max_buffered)
+
+
+def test_hot_keys_threshold():
+    clock = Clock()
+    hot = HotKeys(lambda: 3, clock=clock)
+    assert [hot.hit(1) for _ in range(4)] == [False, False, True, True]
+    assert not hot.hit(2)
+    clock.now = 1.5
+    assert hot.hit(1)  # still hot the second after
+    assert not hot.hit(2)
+    clock.now = 5
+    assert not hot.hit(1)  # cooled down after an idle second
+    assert HotKeys(lambda: 0).hit(3)
+
+
+def test_buffer_last_intent_wins():
+    written = []
+    buffer = make_buffer(written.append)
+    assert buffer.add(1, 10, True) and buffer.add(1, 10, False) and buffer.add(1, 11, True) and buffer.add(2, 10, True)
+    assert buffer.size == 3 and buffer.holds(1) and not buffer.holds(3)
+    assert buffer.flush() == 3
+    assert written == [{1: {10: False, 11: True}, 2: {10: True}}]
+    assert buffer.flush() == 0 and not buffer.holds(1)
+    assert buffer.stats() == {'buffered': 0, 'added': 4, 'written': 3, 'flushes': 1, 'failures': 0, 'refused': 0}
+
+
+def test_buffer_flushes_at_max_batch():
+    flushed = threading.Event()
+    buffer = make_buffer(lambda intents: flushed.set(), max_batch=2)
+    buffer.add(1, 10, True)
+    assert not flushed.wait(0.1)
+    buffer.add(1, 11, True)
+    assert flushed.wait(5)
+
+
+def test_buffer_refuses_when_full():
+    buffer = make_buffer(lambda intents: None, max_buffered=2)
+    assert buffer.add(1, 10, True) and buffer.add(1, 11, True)
+    assert not buffer.add(1, 12, True)
+    assert buffer.add(1, 10, False)  # replacing a held intent takes no room
+    assert buffer.refused == 1
+    buffer.close()
+    assert buffer.size == 0 and not buffer.add(1, 12, True)
+
+
+def test_buffer_requeues_failed_write():
+    written = []
+
+    def write(intents):
+        if not written:
+            written.append(None)
+            buffer.add(1, 10, False)  # a newer intent arriving during the failed write
+            raise RuntimeError('database unavailable')
+        written.append(intents)
+
+    buffer = make_buffer(write)
+    buffer.add(1, 10, True)
+    buffer.add(1, 11, True)
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+    assert buffer.size == 2 and buffer.failures == 1
+    buffer.flush()
+    assert written[1] == {1: {10: False, 11: True}}
+
+
+def test_buffered_like_is_written(client):
+    """
+    With write-behind, USER with ID 2 likes post with ID 5, the like is accepted with 202 and written by the flush
+    """
+    token = login(client, 2)
+    Post._get_collection().update_one({'_id': 5}, {'$pull': {'likes': 2}})
+    response = client.post('/api/like/5', headers={'Authorization': token}, content_type='application/json')
+    assert response.status_code == 202
+    assert like_buffer.flush() == 1
+    post = Post._get_collection().find_one({'_id': 5})
+    assert 2 in post['likes'] and post['like_count'] == len(post['likes'])
+
+
+def test_buffered_like_then_unlike(client):
+    """
+    A like followed by an unlike of the same user before the flush leaves the post as it was
+    """
+    token = login(client, 3)
+    Post._get_collection().update_one({'_id': 6}, {'$pull': {'likes': 3}})
+    before = Post._get_collection().find_one({'_id': 6})
+    client.post('/api/like/6', headers={'Authorization': token}, content_type='application/json')
+    response = client.post('/api/unlike/6', headers={'Authorization': token}, content_type='application/json')
+    assert response.status_code == 202
+    like_buffer.flush()
+    after = Post._get_collection().find_one({'_id': 6})
+    assert sorted(after['likes']) == sorted(before['likes']) and after['like_count'] == len(after['likes'])
+
+
+def test_buffered_unlike_takes_back_recorded_score(client):
+    """
+    A buffered like records what it added to trend_score, the buffered unlike flushed later takes back exactly that
+    """
+    token = login(client, 4)
+    Post._get_collection().update_one({'_id': 7}, {'$pull': {'likes': 4}, '$unset': {'like_scores.4': ''}})
+    before = Post._get_collection().find_one({'_id': 7}).get('trend_score')
+    client.post('/api/like/7', headers={'Authorization': token}, content_type='application/json')
+    like_buffer.flush()
+    liked = Post._get_collection().find_one({'_id': 7})
+    assert 4 in liked['likes'] and '4' in liked['like_scores']
+
+    client.post('/api/unlike/7', headers={'Authorization': token}, content_type='application/json')
+    like_buffer.flush()
+    after = Post._get_collection().find_one({'_id': 7})
+    assert 4 not in after['likes'] and '4' not in after.get('like_scores', {})
+    assert after['trend_score'].to_decimal() == (before.to_decimal() if before is not None else 0)
+
+
+def test_refused_like_written_after_held_ones(client, monkeypatch):
+    """
+    A like refused by the full buffer is written directly only once the buffered likes of the post are
+    """
+    written = []
+
+    def write(intents):
+        written.append(intents)
+        views.write_likes(intents)
+
+    buffer = make_buffer(write, max_buffered=1)
+    monkeypatch.setattr(views, 'like_buffer', buffer)
+    Post._get_collection().update_one({'_id': 8}, {'$pull': {'likes': {'$in': [1, 5]}}})
+    response = client.post('/api/like/8', headers={'Authorization': login(client, 5)}, content_type='application/json')
+    assert response.status_code == 202
+    response = client.post('/api/like/8', headers={'Authorization': login(client, 1)}, content_type='application/json')
+    assert response.status_code == 200
+    assert written == [{8: {5: True}}] and not buffer.holds(8)
+    post = Post._get_collection().find_one({'_id': 8})
+    assert 5 in post['likes'] and 1 in post['likes'] and post['like_count'] == len(post['likes'])
@@ -0,0 +1,147 @@
+import datetime
+import os
+import threading
+import time
+from decimal import Decimal, localcontext
+
+from bson.decimal128 import Decimal128, create_decimal128_context
+
+from . import db
+
+DECIMAL128_CONTEXT = create_decimal128_context()
+
+LIKE_WEIGHT = 1  # trend score of a like, an unlike takes back what its like added, see like_score_field
+COMMENT_WEIGHT = 2  # trend score of a comment
+
+
+def decay_exponent(now=None):
+    """
+    Half-lives elapsed between TRENDING_EPOCH and now
+    """
+    config = db.app.config
+    now = now or datetime.datetime.utcnow()
+    return (now - config['TRENDING_EPOCH']).total_seconds() / (config['TRENDING_HALF_LIFE'] * 3600)
+
+
+def trend_increment(weight, now=None):
+    """
+    Amount added to Post.trend_score by an interaction happening now
+    instead of decaying every score as time passes, newer interactions weigh 2 ** (half-lives since the epoch) more,
+    so the order of the stored scores is the order of the time-decayed ones and a single $inc keeps it up to date
+    the amounts are Decimal128, a double would overflow 1024 half-lives after the epoch, a Decimal128 after 20000
+    :param weight: LIKE_WEIGHT or COMMENT_WEIGHT, negative to take an interaction back
+    :return: Decimal128 to $inc trend_score by
+    """
+    with localcontext(DECIMAL128_CONTEXT):
+        return Decimal128(Decimal(weight) * Decimal(2) ** Decimal(decay_exponent(now)))
+
+
+def trend_decrement(increment):
+    """
+    Amount taking an interaction back from Post.trend_score
+    :param increment: Decimal128 the interaction added, as returned by trend_increment when it happened
+    :return: Decimal128 to $inc trend_score by
+    """
+    with localcontext(DECIMAL128_CONTEXT):
+        return Decimal128(-increment.to_decimal())
+
+
+def like_score_field(user_id):
+    """
+    Field of a post holding what the like of a user added to trend_score, the unlike takes back exactly that: the
+    same weight taken at the time of the unlike would be worth more, as newer interactions weigh more
+    """
+    return f'like_scores.{user_id}'
+
+
+def decayed_score(trend_score, now=None):
+    """
+    :param trend_score: stored score, Decimal128 as read by pymongo or Decimal as read by mongoengine
+    :return: the score brought back to the scale of interactions happening now, as a float
+    """
+    if isinstance(trend_score, Decimal128):
+        trend_score = trend_score.to_decimal()
+    with localcontext(DECIMAL128_CONTEXT):
+        return float(Decimal(trend_score) / Decimal(2) ** Decimal(decay_exponent(now)))
+
+
+class TrendingRanking:
+    """
+    The size highest trend scores kept in process and read without touching the database
+    once the ranking is older than max_age seconds, the next read starts a background thread reloading it through the
+    trend_score index and still answers from the previous ranking, only the first read waits for the database
+    """
+
+    def __init__(self, load, size, max_age):
+        """
+        :param load: function returning the n posts with the highest trend_score, highest first
+        :param size: function returning the number of posts kept
+        :param max_age: function returning the seconds a ranking is served before it is reloaded
+        """
+        self._load = load
+        self._size = size
+        self._max_age = max_age
+        self._reset()
+        # the refresh thread of the parent does not exist in a forked process
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._posts = None  # ranking, None until loaded
+        self._loaded_at = 0.0
+        self._refresh_thread = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.last_refresh_seconds = 0.0
+
+    def refresh(self):
+        """
+        Reload the ranking from the database
+        """
+        start = time.perf_counter()
+        try:
+            posts = self._load(self._size())
+        except Exception:
+            self.refresh_failures += 1
+            raise
+        with self._lock:
+            self._posts = posts
+            self._loaded_at = time.monotonic()
+            self.refreshes += 1
+            self.last_refresh_seconds = time.perf_counter() - start
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            pass  # counted in refresh_failures, the stale ranking is served and the next read tries again
+        finally:
+            self._refresh_thread = None
+
+    def top(self, limit, wait=True):
+        """
+        :param limit: number of posts, at most size
+        :param wait: if False, return None instead of waiting for the first load
+        :return: list of the limit posts with the highest trend score
+        """
+        with self._lock:
+            posts = self._posts
+            stale = time.monotonic() - self._loaded_at > self._max_age()
+            if posts is not None and stale and self._refresh_thread is None:
+                self._refresh_thread = threading.Thread(target=self._refresh_in_background, daemon=True)
+                self._refresh_thread.start()
+        if posts is None:
+            if not wait:
+                return None
+            self.refresh()
+            posts = self._posts
+        return posts[:limit]
+
+    def stats(self):
+        """
+        :return: dict with the number of posts kept, the age of the ranking in seconds and the refresh counters
+        """
+        return {'size': len(self._posts or []),
+                'age_seconds': round(time.monotonic() - self._loaded_at, 3) if self._posts is not None else None,
+                'refreshes': self.refreshes, 'refresh_failures': self.refresh_failures,
+                'last_refresh_ms': round(self.last_refresh_seconds * 1000, 3)}
@@ -1,14 +1,55 @@
+import atexit
+import datetime
 import os
+import time
 import uuid
-from functools import wraps
+from contextlib import contextmanager
+from functools import wraps, lru_cache
 
-from flask import request, jsonify, json
+from bson import DBRef
+from bson.errors import InvalidId
+from flask import request, jsonify, json, Response, stream_with_context, g, current_app
 from itsdangerous import URLSafeSerializer as Serializer, BadSignature, SignatureExpired
+from mongoengine import NotUniqueError, Q
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.read_preferences import Primary
+from werkzeug.local import LocalProxy
 
-from project.models import User, Post, Comment
-from . import app
+from project.batch import (BatchPlan, parse_operations, upserted_from_error, comment_count_update, bucket_updates,
+                           duplicate_writes)
+from project.models import User, Post, Comment, Follow, TimelineEntry, CommentBucket, COMMENT_BUCKET_SIZE
+from . import app, response_cache, init_db
+from .admission import AdmissionController
+from .compression import (COMPRESSION_LEVELS, StreamCompressor, available_encodings, negotiate, compressible,
+                          compress_stream)
+from .encoding import EPOCH
+from .monitoring import command_counter, pool_monitor, request_metrics
+from .routing import read_preference, dump_read_after, load_read_after, READ_AFTER_COOKIE
+from .writebehind import HotKeys, LikeBuffer, like_writes
+from .trending import TrendingRanking, trend_increment, like_score_field, decayed_score, LIKE_WEIGHT
 
-SECRET_KEY = os.environ.get('SECRET_KEY')  # secret key for token generation
+
+@lru_cache(maxsize=None)
+def token_serializer(secret_key):
+    """
+    Serializer signing and verifying tokens, built on first use rather than at import so that the app, its commands and
+    its tests import without SECRET_KEY, then shared by every request
+    :param secret_key: SECRET_KEY of the app
+    """
+    if not secret_key:
+        raise RuntimeError('SECRET_KEY must be set to sign tokens')
+    return Serializer(secret_key)
+
+
+# fields of the authenticated user loaded by current_user, never the password
+CURRENT_USER_FIELDS = ('name', 'email', 'follower_count', 'following_count', 'fanout_skipped')
+
+
+@app.before_request
+def connect_db():
+    # with LAZY_INIT the first request registers the MongoDB connection, the following ones find it registered
+    init_db(app)
 
 
 # ---------------------------------- AUTHENTICATION MIDDLEWARE ---------------------------------------------------------
@@ -23,20 +64,77 @@ def auth_required(f):
     def auth_wrapper(*args, **kwargs):
         token = request.headers.get('Authorization')
         if token:
+            serializer = token_serializer(current_app.config['SECRET_KEY'])
             try:
-                serializer = Serializer(SECRET_KEY)
                 data = serializer.loads(token, max_age=24 * 60 * 60)  # max_age is the expiration 24 hours
-                return f(data, *args, **kwargs)
             except SignatureExpired:  # if token is expired
                 return jsonify({'error': 'Token has expired'}), 401
             except BadSignature:  # if token is invalid
                 return jsonify({'error': 'Invalid token'}), 401
+            if 'id' not in data:
+                # tokens issued before the id claim only carry the email, resolve it once here
+                user_id = User.objects(email=data['email']).scalar('id').first()
+                if user_id is None:
+                    return jsonify({'error': 'Invalid token'}), 401
+                data = dict(data, id=user_id)
+            g.token_data = data
+            return f(data, *args, **kwargs)
         else:  # if token is missing in the request header
             return jsonify({'error': 'Token is missing'}), 400
 
     return auth_wrapper
 
 
+def load_current_user():
+    """
+    Load the authenticated user of the request the first time current_user is used,
+    only CURRENT_USER_FIELDS are read and the document is kept for the rest of the request
+    :return: User or None if the user no longer exists
+    """
+    if 'current_user' not in g:
+        g.current_user = User.objects(id=g.token_data['id']).only(*CURRENT_USER_FIELDS).first()
+    return g.current_user
+
+
+current_user = LocalProxy(load_current_user)
+
+
+def user_ref(data):
+    """
+    Reference to the authenticated user built from the token claims, usable in queries and updates without reading
+    the user document
+    :param data: token data passed to the handler by auth_required
+    :return: DBRef to the user
+    """
+    return DBRef(User._get_collection_name(), data['id'])
+
+
+# ---------------------------------- PAGINATION -----------------------------------------------------------------------
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def page_args(parse_after=int, args=None):
+    """
+    Read the keyset pagination arguments ?after=<cursor>&limit=<n> from the query string
+    :param parse_after: converts the after cursor, ids by default
+    :param args: query string arguments, those of the current flask request by default
+    :return: tuple (after, limit), after is None for the first page
+    :raises ValueError: if after is not a valid cursor or limit is not a positive integer
+    """
+    args = request.args if args is None else args
+    try:
+        after = args.get('after')
+        after = parse_after(after) if after else None
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except (ValueError, OverflowError, InvalidId):
+        raise ValueError('after must be a cursor returned as next and limit an integer')
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+
+    return after, min(limit, MAX_PAGE_SIZE)
+
+
 # --------------------------------------------------------- USER Management --------------------------------------------
 
 
@@ -54,10 +152,11 @@ def authenticate():
     email = request.json.get('email')
     password = request.json.get('password')
 
-    user = User.objects(email=email).first()
+    user = User.objects(email=email).only('id', 'email', 'password').first()
     if user and user.password == password:
-        s = Serializer(SECRET_KEY)
-        token = s.dumps({'email': user.email})
+        # the id lets handlers address the user without looking the email up again
+        serializer = token_serializer(current_app.config['SECRET_KEY'])
+        token = serializer.dumps({'id': user.id, 'email': user.email})
         return jsonify({'token': token}), 200
 
     else:
@@ -69,37 +168,49 @@ def authenticate():
 def get_user(data):
     """
     Authentication via token is required to access this route
-    :param data: it is the data returned from the auth_required decorator that contains the email of the current user
+    :param data: it is the data returned from the auth_required decorator that contains the id and email of the current user
     :return:json response containing username, number of followers and number of following of the current authenticated user
     """
-    current_user_email = data['email']
-    current_user = User.objects(email=current_user_email).first()
     json_data = {
         'username': current_user.name,
-        'followers': len(current_user.followers),
-        'following': len(current_user.following)
+        'followers': current_user.follower_count,
+        'following': current_user.following_count
     }
     return jsonify(json_data), 200
 
 
+def update_follow_counters(follower_id, followee_id, delta):
+    """
+    Change following_count of the follower and follower_count of the followee by delta in one round trip
+    :param follower_id: id of the user who follows
+    :param followee_id: id of the user being followed
+    :param delta: 1 after a follow, -1 after an unfollow
+    """
+    User._get_collection().bulk_write([
+        UpdateOne({'_id': follower_id}, {'$inc': {'following_count': delta}}),
+        UpdateOne({'_id': followee_id}, {'$inc': {'follower_count': delta}}),
+    ], ordered=False)
+
+
 @app.route('/api/follow/<id>', methods=['POST'])
 @auth_required
 def follow(data, id):
     """
     Authentication via token is required to access this route
-    :param data: data returned from the auth_required decorator that contains the email of the current user
+    :param data: data returned from the auth_required decorator that contains the id and email of the current user
     :param id: id of the user to follow
     :return: json response containing a message
     """
-    current_user_email = data['email']
-    current_user = User.objects(email=current_user_email).first()
-    user_to_follow = User.objects(id=id).first()
+    user_to_follow = User.objects(id=id).only('id').first()
     if user_to_follow:
-        if user_to_follow not in current_user.following:
-            current_user.following.append(user_to_follow)  # add user to following list
-            user_to_follow.followers.append(current_user)  # add user to followers list
-            current_user.save()
-            user_to_follow.save()
+        try:
+            # the edge is only inserted if it does not exist yet, the unique index settles concurrent follows
+            result = Follow.objects(follower=user_ref(data), followee=user_to_follow).update_one(
+                set_on_insert__created_at=datetime.datetime.utcnow(), upsert=True, full_result=True)
+        except NotUniqueError:
+            result = None
+        if result and result.upserted_id:
+            update_follow_counters(data['id'], user_to_follow.id, 1)
             return jsonify({'message': 'User followed successfully'}), 200
         else:
             return jsonify({'message': 'You already follow this user'}), 200
@@ -112,20 +223,17 @@ def follow(data, id):
 def unfollow(data, id):
     """
     Authentication via token is required to access this route
-    :param data: data returned from the auth_required decorator that contains the email of the current user
+    :param data: data returned from the auth_required decorator that contains the id and email of the current user
     :param id: id of the user to unfollow
     :return: json response containing a message
     """
 
-    current_user_email = data['email']
-    current_user = User.objects(email=current_user_email).first()
-    user_to_unfollow = User.objects(id=id).first()
+    user_to_unfollow = User.objects(id=id).only('id', 'name').first()
     if user_to_unfollow:
-        if user_to_unfollow in current_user.following:
-            current_user.following.remove(user_to_unfollow)  # remove user from following list
-            user_to_unfollow.followers.remove(current_user)  # remove user from followers list
-            current_user.save()
-            user_to_unfollow.save()
+        if Follow.objects(follower=user_ref(data), followee=user_to_unfollow).delete():  # remove the follow edge
+            update_follow_counters(data['id'], user_to_unfollow.id, -1)
+            # their posts leave the feed of the current user
+            TimelineEntry.objects(owner=user_ref(data), author=user_to_unfollow).delete()
             return jsonify(
                 {'message': f'Authenticated User  unfollowed {user_to_unfollow.name} with {id} successfully'}), 200
         else:
@@ -134,30 +242,302 @@ def unfollow(data, id):
         return jsonify({'error': f'User with given {id} not found'}), 404
 
 
+def follow_page(id, user_field, other_field):
+    """
+    One keyset page of the users on the other end of the follow edges of a user, ordered by their id
+    :param id: id of the user whose edges are listed
+    :param user_field: edge field holding the user, 'followee' to list followers, 'follower' to list following
+    :param other_field: the opposite edge field, holds the listed users
+    :return: json response containing the users with id and name and the cursor of the next page
+    """
+    try:
+        after, limit = page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    query = {user_field: id}
+    if after is not None:
+        query[f'{other_field}__gt'] = after
+    # served by the unique (user_field, other_field) index, only the ids of the listed users are read
+    edges = Follow.objects(**query).order_by(other_field).only(other_field).limit(limit + 1).as_pymongo()
+    ids = [edge[other_field] for edge in edges]
+
+    if not ids and not User.objects(id=id).only('id').first():
+        return jsonify({'error': f'User with given {id} not found'}), 404
+
+    next_cursor = None
+    if len(ids) > limit:
+        ids = ids[:limit]
+        next_cursor = str(ids[-1])
+
+    names = {user['_id']: user.get('name') for user in User.objects(id__in=ids).only('name').as_pymongo()}
+    users = [{'id': str(user_id), 'name': names.get(user_id)} for user_id in ids]
+    return jsonify({'users': users, 'next': next_cursor}), 200
+
+
+@app.route('/api/users/<int:id>/followers', methods=['GET'])
+def get_followers(id):
+    """
+    No need for authentication, paginated with ?after=<next>&limit=<n>
+    :param id: id of the user
+    :return: json response containing a page of the users following the given user
+    """
+    return follow_page(id, 'followee', 'follower')
+
+
+@app.route('/api/users/<int:id>/following', methods=['GET'])
+def get_following(id):
+    """
+    No need for authentication, paginated with ?after=<next>&limit=<n>
+    :param id: id of the user
+    :return: json response containing a page of the users followed by the given user
+    """
+    return follow_page(id, 'follower', 'followee')
+
+
+# ---------------------------------- READ ROUTING ---------------------------------------------------------------------
+@lru_cache(maxsize=None)
+def read_after_serializer(secret_key):
+    """
+    Serializer signing the read_after cookie, built on first use like token_serializer
+    :param secret_key: SECRET_KEY of the app
+    """
+    if not secret_key:
+        raise RuntimeError('SECRET_KEY must be set to sign the read_after cookie')
+    return Serializer(secret_key, salt='read-after')
+
+
+def public_read_preference():
+    """
+    :return: read preference of the public routes, built from MONGODB_READ_PREFERENCE and MONGODB_MAX_STALENESS
+    """
+    return read_preference(app.config['MONGODB_READ_PREFERENCE'], app.config['MONGODB_MAX_STALENESS'])
+
+
+def read_after():
+    """
+    :return: operation time of the post or comment the client wrote in the last READ_YOUR_WRITES_SECONDS, else None
+    """
+    if 'read_after' not in g:
+        cookie = request.cookies.get(READ_AFTER_COOKIE)
+        g.read_after = None
+        if cookie:  # only a cookie needs the serializer, the other clients read without SECRET_KEY
+            serializer = read_after_serializer(current_app.config['SECRET_KEY'])
+            g.read_after = load_read_after(serializer, cookie, app.config['READ_YOUR_WRITES_SECONDS'])
+    return g.read_after
+
+
+def public_collection(model):
+    """
+    Collection of model for the reads of the public routes, on the primary for a client reading its own writes
+    """
+    preference = Primary() if read_after() else public_read_preference()
+    return model._get_collection().with_options(read_preference=preference)
+
+
+def read_session():
+    """
+    Causally consistent session of a client reading its own writes, advanced to its write so that a primary elected
+    since still waits for the write before answering, ended with the request
+    :return: ClientSession, None for the other clients
+    """
+    operation_time = read_after()
+    if operation_time is None:
+        return None
+    if 'read_session' not in g:
+        g.read_session = Post._get_db().client.start_session(causal_consistency=True)
+        g.read_session.advance_operation_time(operation_time)
+    return g.read_session
+
+
+@contextmanager
+def causal_write():
+    """
+    Session for the last write of a request creating a post or a comment, its operation time is sent back in the
+    read_after cookie so the client then reads the public routes from the primary
+    nothing is recorded when public reads already go to the primary, or without a replica set where writes return no
+    operation time
+    :return: context manager giving the session to pass to the write, None if not needed
+    """
+    if isinstance(public_read_preference(), Primary):
+        yield None
+        return
+    with Post._get_db().client.start_session(causal_consistency=True) as session:
+        yield session
+        g.written_at = session.operation_time
+
+
+@app.after_request
+def send_read_after(response):
+    written_at = g.pop('written_at', None)
+    if written_at is not None:
+        serializer = read_after_serializer(current_app.config['SECRET_KEY'])
+        response.set_cookie(READ_AFTER_COOKIE, dump_read_after(serializer, written_at),
+                            max_age=app.config['READ_YOUR_WRITES_SECONDS'], httponly=True, samesite='Lax')
+    return response
+
+
+@app.teardown_request
+def end_read_session(exc):
+    session = g.pop('read_session', None)
+    if session is not None:
+        session.end_session()
+
+
+# --------------------------------------------------------------------------------------------------------------------
+
 # ------------------------------------------------- GET, CREATE, DELETE POSTS -----------------------------------------
+# only the fields needed by the post listings, the likes list is never sent over the wire
+POST_SUMMARY_PROJECTION = {'title': 1, 'description': 1, 'created_time': 1,
+                           'comments': {'$ifNull': ['$comment_count', 0]}, 'likes': {'$ifNull': ['$like_count', 0]}}
+STREAM_BATCH_SIZE = 1000  # posts fetched per getMore by the streaming export
+
+
+def to_id(id):
+    """
+    :param id: id taken from the url
+    :return: the integer id, None if it is not one so that it matches no document
+    """
+    try:
+        return int(id)
+    except ValueError:
+        return None
+
+
+def post_summary(post):
+    """
+    Convert a post document projected with POST_SUMMARY_PROJECTION into its json representation
+    :param post: raw post document returned by the aggregation
+    :return: dict with id, title, desc, created_at, number of comments and number of likes
+    """
+    return {'id': str(post['_id']), 'title': post['title'], 'desc': post['description'],
+            'created_at': post.get('created_time'), 'comments': post['comments'], 'likes': post['likes']}
+
+
+def created_cursor(after):
+    """
+    Parse the cursor of a page of posts in creation order, <created time in ms since the epoch>:<post id> of the last
+    post returned
+    :return: tuple (created time, post id)
+    """
+    created_ms, post_id = after.split(':')
+    return EPOCH + datetime.timedelta(milliseconds=int(created_ms)), int(post_id)
+
+
+def next_created_cursor(created_time, post_id):
+    """
+    :return: cursor of the page after the post created at created_time with post_id, read back by created_cursor
+    """
+    return f'{(created_time - EPOCH) // datetime.timedelta(milliseconds=1)}:{post_id}'
+
+
+def created_keyset(after, id_field='_id', newest_first=False):
+    """
+    Query on the posts after a cursor in creation order, or before it newest first
+    ids taken from blocks do not follow the creation order, they only order the posts created in the same millisecond:
+    the index scans the range on created_time and the ids filter the posts of its first millisecond
+    :param after: (created time, post id) of the last post of the previous page
+    :param id_field: field holding the post id, 'post' in the timelines
+    :param newest_first: True for the posts before the cursor
+    """
+    created_time, post_id = after
+    bound, strict = ('$lte', '$lt') if newest_first else ('$gte', '$gt')
+    return {'created_time': {bound: created_time},
+            '$or': [{'created_time': {strict: created_time}}, {id_field: {strict: post_id}}]}
+
+
+def wants_ndjson(accept_mimetypes):
+    """
+    :return: True if the client asks /api/all_posts for the ndjson export rather than a page of json
+    """
+    return accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+def all_posts_cache_key():
+    """
+    Cache key of a page of /api/all_posts, the ndjson export and the reads of a client reading its own writes are
+    never cached
+    """
+    if read_after():
+        return None
+    if wants_ndjson(request.accept_mimetypes):
+        return None
+    return f"all_posts:{request.args.get('after', '')}:{request.args.get('limit', '')}"
+
+
+def all_posts_cache_tags(body):
+    """
+    A page depends on each of its posts, the last page also changes when a post is created: pages are in creation
+    order, a new post always lands on the last one
+    """
+    tags = [f"post:{post['id']}" for post in body['posts']]
+    if body['next'] is None:
+        tags.append('posts:tail')
+    return tags
+
+
 @app.route('/api/all_posts', methods=['GET'])
+@response_cache.cached(all_posts_cache_key, all_posts_cache_tags)
 def get_all_posts():
     """
     No need for authentication to access this route as it was not mentioned in the assignment
-    :return: json response containing all posts with id,title, description, created time, comments and likes
-    """
-    posts = Post.objects()
-    if posts:
-        json_data = []
-        for post in posts:
-            comments = []
-            # get all comments for the current post and append them to the comments list
-            for comment in post.comments:
-                comments.append(comment.text)
-            # append the post data to the json_data list
-            json_data.append({'id': str(post.id), 'title': post.title, 'desc': post.description,
-                              'created_at': post.created_time, 'comments': comments, 'likes': len(post.likes)})
-
-        return jsonify(json_data), 200
-    else:
+    Posts are returned in pages in creation order, pass ?after=<next>&limit=<n> to get the following page
+    Clients sending Accept: application/x-ndjson get the streaming export of /api/all_posts/stream
+    :return: json response containing a page of posts with id,title, description, created time, number of comments
+             and likes and the cursor of the next page (null on the last page), comments are read from
+             /api/posts/<id>/comments
+    """
+    if wants_ndjson(request.accept_mimetypes):
+        return stream_all_posts()
+
+    try:
+        after, limit = page_args(created_cursor)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    pipeline = []
+    if after is not None:
+        pipeline.append({'$match': created_keyset(after)})
+    pipeline += [
+        {'$sort': {'created_time': 1, '_id': 1}},
+        {'$limit': limit + 1},  # one extra post tells us if there is a next page
+        {'$project': POST_SUMMARY_PROJECTION},
+    ]
+    posts = list(public_collection(Post).aggregate(pipeline, session=read_session()))
+
+    if not posts and after is None:
         # return an error message if no posts found
         return jsonify({'error': 'No posts found'}), 404
 
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = next_created_cursor(posts[-1]['created_time'], posts[-1]['_id'])
+
+    return jsonify({'posts': [post_summary(post) for post in posts], 'next': next_cursor}), 200
+
+
+@app.route('/api/all_posts/stream', methods=['GET'])
+def stream_all_posts():
+    """
+    Export every post as newline delimited json, one post per line in creation order
+    posts are read from a server side cursor in batches of STREAM_BATCH_SIZE and written out as they arrive,
+    so memory stays flat whatever the size of the collection
+    :return: streamed application/x-ndjson response
+    """
+    # the export only follows the read preference, a causal session would have to outlive the request
+    cursor = public_collection(Post).aggregate([{'$sort': {'created_time': 1, '_id': 1}},
+                                                {'$project': POST_SUMMARY_PROJECTION}], batchSize=STREAM_BATCH_SIZE)
+
+    def generate():
+        try:
+            for post in cursor:
+                yield json.dumps(post_summary(post)) + '\n'
+        finally:
+            cursor.close()  # release the server side cursor if the client disconnects
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 
 @app.route('/api/posts', methods=['POST'])
 @auth_required
@@ -167,76 +547,393 @@ def create_post(data):
     create a post with title and description from the request body via request.json
     if title or description is missing return an error message with code 400
 
-    :param data: data returned from the auth_required decorator that contains the email of the current user
+    :param data: data returned from the auth_required decorator that contains the id and email of the current user
     :return: json response containing the id, title, description and created time of the created post with code 201
     """
 
     if not request.json or 'title' not in request.json or 'description' not in request.json:
         return jsonify({'error': 'Title or description  is missing'}), 400
 
-    current_user_email = data['email']
-    current_user = User.objects(email=current_user_email).first()
-    # UTC time
+    author = load_current_user()
+    if author is None:
+        # the token outlived its user
+        return jsonify({'error': 'Invalid token'}), 401
 
-    post = Post(title=request.json['title'], description=request.json['description'], author=current_user)
-    post.save()
-    post = Post.objects(id=post.id).first()
+    post = Post(title=request.json['title'], description=request.json['description'], author=user_ref(data))
+    post.validate()
+    fan_out = author.follower_count < app.config['FEED_FANOUT_LIMIT']
+    if not fan_out and not author.fanout_skipped:
+        # flagged before the insert, the post is merged on read even if the author loses followers right after
+        User.objects(id=data['id']).update_one(set__fanout_skipped=True)
+    with causal_write() as session:
+        # the id is new, inserted without the replace-or-insert lookup of save()
+        Post._get_collection().insert_one(post.to_mongo(), session=session)
+    response_cache.invalidate('posts:tail')
+    if fan_out:
+        fan_out_post(post.id, post.created_time, data['id'])
 
     return jsonify({'id': str(post.id), 'Title': post.title, 'Description': post.description,
                     'Created Time(UTC)': post.created_time}), 200
 
 
+POST_DETAIL_FIELDS = ('title', 'description', 'like_count', 'comment_count')  # counters only, never the lists
+
+
+def post_detail(post):
+    """
+    Convert a raw post document read with POST_DETAIL_FIELDS into its json representation
+    :param post: raw post document
+    :return: dict with id, title, description, number of likes and number of comments
+    """
+    return {'id': str(post['_id']), 'title': post['title'], 'description': post['description'],
+            'likes': post.get('like_count', 0), 'comments': post.get('comment_count', 0)}
+
+
 @app.route('/api/posts/<id>', methods=['GET'])
+@response_cache.cached(lambda id: None if read_after() else f'post:{id}', lambda body, id: [f"post:{body['id']}"])
 def get_post(id):
     """
     :param id: id of the post to get, don't need to be authenticated to access this route as it was not mentioned in the assignment
     :return: json response containing the id, title, description, number of likes and number of comments of the post
     """
-    post = Post.objects(id=id).first()  # get post with given id
+    # get post with given id, counters only, the likes and comments lists are never loaded
+    post = public_collection(Post).find_one({'_id': to_id(id)}, POST_DETAIL_FIELDS, session=read_session())
     if post:  # if post exists
-        json_data = {
-            'id': str(post.id),
-            'title': post.title,
-            'description': post.description,
-            'likes': len(post.likes),
-            'comments': len(post.comments)
-        }
-        return jsonify(json_data), 200
+        return jsonify(post_detail(post)), 200
     else:
         # if post does not exists with given id, return response with code 404
         return jsonify({'error': 'Post with given id not found'}), 404
 
 
+def post_ids_arg(args=None):
+    """
+    Read the ?ids=1,2,3 argument of the batch read
+    :param args: query string arguments, those of the current flask request by default
+    :return: list of distinct ids in the requested order
+    :raises ValueError: if an id is not an integer or there are none or more than MAX_PAGE_SIZE
+    """
+    args = request.args if args is None else args
+    try:
+        ids = list(dict.fromkeys(int(id) for id in args.get('ids', '').split(',') if id.strip()))
+    except ValueError:
+        raise ValueError('ids must be a comma separated list of post ids')
+    if not ids or len(ids) > MAX_PAGE_SIZE:
+        raise ValueError(f'between 1 and {MAX_PAGE_SIZE} ids must be given')
+    return ids
+
+
+@app.route('/api/posts', methods=['GET'])
+def get_posts():
+    """
+    No need for authentication, several posts read at once with ?ids=1,2,3 in a single query
+    :return: json response containing the posts found in the requested order, in the format of /api/posts/<id>,
+             and the ids of the posts not found
+    """
+    try:
+        ids = post_ids_arg()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    posts = {post['_id']: post for post in public_collection(Post).find({'_id': {'$in': ids}}, POST_DETAIL_FIELDS,
+                                                                        session=read_session())}
+    return jsonify({'posts': [post_detail(posts[id]) for id in ids if id in posts],
+                    'missing': [str(id) for id in ids if id not in posts]}), 200
+
+
 @app.route('/api/posts/<id>', methods=['DELETE'])
 @auth_required
 def delete_post(data, id):
     """
     Delete a post with given id from the database only if the current user is the author of the post
     if post does not exists with given id, it is assumed that the post is already deleted and return response with code 401
-    :param data: data returned from the auth_required decorator that contains the email of the current user
+    :param data: data returned from the auth_required decorator that contains the id and email of the current user
     :param id: id of the post to delete
     :return: json response containing a message
     """
 
-    current_user_email = data['email']
-    current_user = User.objects(email=current_user_email).first()
-    post = Post.objects(id=id).first()
-
-    if post:
-        if post.author == current_user:  # check if the current user is the author of the post
-            post.delete()
-            return jsonify({'message': 'Post deleted successfully'}), 200
-        else:
-            # unauthorized user is trying to delete the post
-            return jsonify({'error': 'You are not authorized to delete this post'}), 401
+    # only deletes if the current user is the author of the post
+    if Post.objects(id=id, author=user_ref(data)).delete():
+        TimelineEntry.objects(post=int(id)).delete()  # remove the post from every feed it was fanned out to
+        CommentBucket.objects(post=int(id)).delete()
+        response_cache.invalidate(f'post:{int(id)}')
+        return jsonify({'message': 'Post deleted successfully'}), 200
+    # nothing deleted, the post is either missing or written by someone else
+    elif Post.objects(id=id).only('id').first():
+        # unauthorized user is trying to delete the post
+        return jsonify({'error': 'You are not authorized to delete this post'}), 401
     else:
         # post with given id not found or post already deleted
         return jsonify({'message': 'Post with given id not found or Post already deleted'}), 404
 
 
+# --------------------------------------------------------------------------------------------------------------------
+
+# -------------------------------------------------- SEARCH ------------------------------------------------------
+MAX_SEARCH_LENGTH = 200  # characters of a search query
+
+
+def search_cursor(after):
+    """
+    Parse the cursor of a search page, <score>:<post id> of the last post returned
+    :return: tuple (score, post id)
+    """
+    score, post_id = after.rsplit(':', 1)
+    return float(score), int(post_id)
+
+
+def search_pipeline(query, after, limit):
+    """
+    Posts matching the words of query through the text index, most relevant first then newest first
+    :param query: words to look for, "quoted phrases" and -excluded words follow the $text syntax
+    :param after: (score, id) of the last post of the previous page, None for the first page
+    :param limit: maximum number of posts
+    :return: aggregation pipeline on the post collection
+    """
+    pipeline = [
+        {'$match': {'$text': {'$search': query}}},
+        {'$project': dict(POST_SUMMARY_PROJECTION, score={'$meta': 'textScore'})},
+    ]
+    if after is not None:
+        score, post_id = after
+        pipeline.append({'$match': {'$or': [{'score': {'$lt': score}}, {'score': score, '_id': {'$lt': post_id}}]}})
+    pipeline += [{'$sort': {'score': -1, '_id': -1}}, {'$limit': limit}]
+    return pipeline
+
+
+def search_args(args=None):
+    """
+    Read ?q=<words>&after=<cursor>&limit=<n> of a search
+    :param args: query string arguments, those of the current flask request by default
+    :return: tuple (query, after, limit)
+    :raises ValueError: if q is missing or too long or the pagination arguments are not valid
+    """
+    args = request.args if args is None else args
+    query = args.get('q', '').strip()
+    if not query or len(query) > MAX_SEARCH_LENGTH:
+        raise ValueError(f'q must hold between 1 and {MAX_SEARCH_LENGTH} characters')
+    after, limit = page_args(search_cursor, args)
+    return query, after, limit
+
+
+def search_page(posts, limit):
+    """
+    :param posts: up to limit + 1 posts returned by search_pipeline
+    :return: json body of a search page, the posts with their score and the cursor of the next page
+    """
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = f"{posts[-1]['score']!r}:{posts[-1]['_id']}"
+    return {'posts': [dict(post_summary(post), score=post['score']) for post in posts], 'next': next_cursor}
+
+
+@app.route('/api/search', methods=['GET'])
+def search_posts():
+    """
+    No need for authentication, posts whose title or description contain the words of ?q=, ranked by relevance,
+    pass ?after=<next>&limit=<n> to get the next page
+    :return: json response containing a page of posts with their relevance score and the cursor of the next page
+    """
+    try:
+        query, after, limit = search_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    posts = list(public_collection(Post).aggregate(search_pipeline(query, after, limit + 1), session=read_session()))
+    return jsonify(search_page(posts, limit)), 200
+
+
+# --------------------------------------------------------------------------------------------------------------------
+
+# -------------------------------------------------- TRENDING ----------------------------------------------------
+def trending_pipeline(size):
+    """
+    The size posts with the highest trend score, read from the start of the trend_score index
+    """
+    return [{'$match': {'trend_score': {'$gt': 0}}}, {'$sort': {'trend_score': -1}}, {'$limit': size},
+            {'$project': dict(POST_SUMMARY_PROJECTION, trend_score=1)}]
+
+
+def load_trending(size):
+    # refreshed outside of any request, always from the public read preference
+    collection = Post._get_collection().with_options(read_preference=public_read_preference())
+    return list(collection.aggregate(trending_pipeline(size)))
+
+
+trending = TrendingRanking(load_trending, lambda: app.config['TRENDING_SIZE'], lambda: app.config['TRENDING_MAX_AGE'])
+
+
+def trending_limit(args=None):
+    """
+    Read ?limit=<n> of the trending posts
+    :raises ValueError: if limit is not an integer between 1 and TRENDING_SIZE
+    """
+    args = request.args if args is None else args
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= app.config['TRENDING_SIZE']:
+        raise ValueError(f'limit must be an integer between 1 and {app.config["TRENDING_SIZE"]}')
+    return limit
+
+
+def trending_page(posts):
+    """
+    :param posts: posts returned by TrendingRanking.top
+    :return: json body of /api/trending, every post with its score on the scale of interactions happening now
+    """
+    return {'posts': [dict(post_summary(post), score=round(decayed_score(post['trend_score']), 3)) for post in posts]}
+
+
+@app.route('/api/trending', methods=['GET'])
+def get_trending():
+    """
+    No need for authentication, posts ranked by their likes and comments, every interaction losing half its weight
+    every TRENDING_HALF_LIFE hours, the ranking is at most TRENDING_MAX_AGE seconds old
+    :return: json response containing the ?limit=<n> trending posts with their score
+    """
+    try:
+        limit = trending_limit()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(trending_page(trending.top(limit))), 200
+
+
+# --------------------------------------------------------------------------------------------------------------------
+
+# -------------------------------------------------- FEED --------------------------------------------------------------
+FANOUT_BATCH_SIZE = 1000  # timeline entries written per insert_many by fan_out_post
+
+
+def fan_out_post(post_id, created_time, author_id):
+    """
+    Write a new post into the timeline of every follower of its author (fan-out on write)
+    :param post_id: id of the new post
+    :param created_time: created_time of the new post, the timelines are ordered by it
+    :param author_id: id of the author
+    :return: number of timelines the post was written to
+    """
+    timelines = TimelineEntry._get_collection()
+    followers = Follow.objects(followee=author_id).only('follower').as_pymongo().batch_size(FANOUT_BATCH_SIZE)
+    batch = []
+    written = 0
+    for edge in followers:
+        batch.append({'owner': edge['follower'], 'post': post_id, 'author': author_id, 'created_time': created_time})
+        if len(batch) >= FANOUT_BATCH_SIZE:
+            written += len(timelines.insert_many(batch, ordered=False).inserted_ids)
+            batch = []
+    if batch:
+        written += len(timelines.insert_many(batch, ordered=False).inserted_ids)
+    return written
+
+
+def feed_post_keys(user_id, before, limit):
+    """
+    Newest posts in the feed of a user, merged from the materialized timeline and, for followed authors too popular to
+    be fanned out or with posts that once skipped fan-out, from their posts read directly (fan-out on read)
+    :param user_id: id of the user whose feed is read
+    :param before: (created time, post id) of the last post of the previous page, None for the first page
+    :param limit: maximum number of posts
+    :return: list of (created time, post id), newest first
+    """
+    timeline = TimelineEntry.objects(owner=user_id)
+    if before is not None:
+        timeline = timeline.filter(__raw__=created_keyset(before, 'post', newest_first=True))
+    entries = timeline.order_by('-created_time', '-post').only('created_time', 'post').limit(limit).as_pymongo()
+    keys = {(entry['created_time'], entry['post']) for entry in entries}
+
+    followees = [edge['followee'] for edge in Follow.objects(follower=user_id).only('followee').as_pymongo()]
+    popular = list(User.objects(Q(follower_count__gte=app.config['FEED_FANOUT_LIMIT']) | Q(fanout_skipped=True),
+                                id__in=followees).scalar('id')) if followees else []
+    if popular:
+        posts = Post.objects(author__in=popular)
+        if before is not None:
+            posts = posts.filter(__raw__=created_keyset(before, newest_first=True))
+        keys.update((post['created_time'], post['_id'])
+                    for post in posts.order_by('-created_time', '-id').only('created_time').limit(limit).as_pymongo())
+
+    return sorted(keys, reverse=True)[:limit]
+
+
+@app.route('/api/feed', methods=['GET'])
+@auth_required
+def get_feed(data):
+    """
+    Authentication via token is required to access this route
+    Posts of the users followed by the current user, newest first, pass ?after=<next>&limit=<n> to get the next page
+    :param data: data returned from the auth_required decorator that contains the id and email of the current user
+    :return: json response containing a page of posts and the cursor of the next page (null on the last page)
+    """
+    try:
+        after, limit = page_args(created_cursor)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    keys = feed_post_keys(data['id'], after, limit + 1)  # one extra post tells us if there is a next page
+    next_cursor = None
+    if len(keys) > limit:
+        keys = keys[:limit]
+        next_cursor = next_created_cursor(*keys[-1])
+
+    ids = [post_id for _, post_id in keys]
+    posts = Post.objects.aggregate([{'$match': {'_id': {'$in': ids}}}, {'$sort': {'created_time': -1, '_id': -1}},
+                                    {'$project': POST_SUMMARY_PROJECTION}]) if ids else []
+    return jsonify({'posts': [post_summary(post) for post in posts], 'next': next_cursor}), 200
+
+
 # --------------------------------------------------------------------------------------------------------------------
 
 # -------------------------------------------------- LIKE AND UNLIKE POSTS --------------------------------------------
+def write_likes(intents):
+    """
+    Write the like and unlike intents flushed by like_buffer, one bulk_write whatever the number of posts and users
+    """
+    Post._get_collection().bulk_write(like_writes(intents, trend_increment(LIKE_WEIGHT)), ordered=False)
+    response_cache.invalidate(*(f'post:{id}' for id in intents))
+
+
+hot_posts = HotKeys(lambda: app.config['LIKE_HOT_THRESHOLD'])
+like_buffer = LikeBuffer(write_likes, lambda: app.config['LIKE_FLUSH_MS'] / 1000, lambda: app.config['LIKE_FLUSH_OPS'],
+                         lambda: app.config['LIKE_BUFFER_MAX'])
+atexit.register(like_buffer.close)
+
+
+def buffer_like(post_id, user_id, liked):
+    """
+    Hand a like or an unlike of a hot post to like_buffer when LIKE_WRITE_BEHIND is on
+    :param post_id: id of the post taken from the url
+    :return: True if the intent is buffered, the caller answers without writing; False once the older intents of the
+             post are written, which a full buffer does in the request, the async edition included
+    """
+    if not app.config['LIKE_WRITE_BEHIND'] or not post_id.isdigit():
+        return False
+    post_id = int(post_id)
+    # a post with intents still buffered stays buffered, its likes are written in the order they came
+    hot = hot_posts.hit(post_id) or like_buffer.holds(post_id)
+    if not hot or like_buffer.add(post_id, user_id, liked):
+        return hot
+    # refused, the buffer is full: older intents of the post still held are written first, waiting for a flush in
+    # progress, so that the direct write lands after them
+    if like_buffer.holds(post_id):
+        like_buffer.flush()
+    return False
+
+
+def unlike_update(user_id):
+    """
+    Pipeline update taking the like of a user off a post that has it, the likes list, like_count and what the like
+    added to trend_score (see project.trending.like_score_field) in one write, as project.writebehind.like_writes
+    :return: list of update stages
+    """
+    field = like_score_field(user_id)
+    return [{'$set': {'likes': {'$filter': {'input': '$likes', 'cond': {'$ne': ['$$this', user_id]}}},
+                      'like_count': {'$add': ['$like_count', -1]},
+                      # a like written before the scores were recorded is never taken back
+                      'trend_score': {'$subtract': [{'$ifNull': ['$trend_score', 0]}, {'$ifNull': [f'${field}', 0]}]}}},
+            {'$unset': field}]
+
+
 @app.route('/api/like/<id>', methods=['POST'])
 @auth_required
 def like_post(data, id):
@@ -248,19 +945,26 @@ def like_post(data, id):
         json response containing a message with code 200 if post liked successfully,
                                                      202 if  post is already liked by the user
                                                      404 if post with given id not found
+        with LIKE_WRITE_BEHIND, the likes of a hot post are answered with 202 at once and written within
+        LIKE_FLUSH_MS, whether the post exists or was already liked is not checked
     """
+    if buffer_like(id, data['id'], True):
+        return jsonify({'message': 'Like accepted'}), 202
 
-    post = Post.objects(id=id).first()
-    current_user_email = data['email']
-    current_user = User.objects(email=current_user_email).first()
-    if post:
-        if current_user and current_user not in post.likes:  # check if the user  not already liked the post
-            post.likes.append(current_user)
-            post.save()
-            return jsonify({'message': 'Post liked successfully'}), 200
-        else:
-            # user already liked the post
-            return jsonify({'message': 'You already liked this post'}), 200
+    increment = trend_increment(LIKE_WEIGHT)
+    # single atomic update, the filter only matches if the user has not liked the post yet,
+    # so the list and the counter change together and concurrent likes never overwrite each other,
+    # what the like adds to trend_score is kept for the unlike to take back
+    if Post._get_collection().update_one({'_id': to_id(id), 'likes': {'$ne': data['id']}},
+                                         {'$addToSet': {'likes': data['id']},
+                                          '$set': {like_score_field(data['id']): increment},
+                                          '$inc': {'like_count': 1, 'trend_score': increment}}).modified_count:
+        response_cache.invalidate(f'post:{int(id)}')
+        return jsonify({'message': 'Post liked successfully'}), 200
+    # nothing was modified, the post is either missing or already liked, only this path needs a second look
+    elif Post.objects(id=id).only('id').first():
+        # user already liked the post
+        return jsonify({'message': 'You already liked this post'}), 200
     else:
         # post with given id not found
         return jsonify({'error': 'Post with given id not found'}), 404
@@ -276,19 +980,20 @@ def unlike_post(data, id):
     :return: json response containing a message with code 200 if post unliked successfully,
                                                           202 if  post is already unliked by the user
                                                           404 if post with given id not found
-
+        with LIKE_WRITE_BEHIND, the unlikes of a hot post are answered with 202 at once like the likes
     """
-    post = Post.objects(id=id).first()
-    current_user_email = data['email']
-    current_user = User.objects(email=current_user_email).first()  # get the current user
-    if post:
-        if current_user in post.likes:  # check if the user already unliked the post
-            post.likes.remove(current_user)
-            post.save()
-            return jsonify({'message': 'Post unliked successfully'}), 200
-        else:
-            # user already unliked the post
-            return jsonify({'message': 'You already unliked this post'}), 200
+    if buffer_like(id, data['id'], False):
+        return jsonify({'message': 'Unlike accepted'}), 202
+
+    # single atomic update, only matches if the user liked the post
+    result = Post._get_collection().update_one({'_id': to_id(id), 'likes': data['id']}, unlike_update(data['id']))
+    if result.matched_count:
+        response_cache.invalidate(f'post:{int(id)}')
+        return jsonify({'message': 'Post unliked successfully'}), 200
+    # nothing was modified, the post is either missing or not liked by the user
+    elif Post.objects(id=id).only('id').first():
+        # user already unliked the post
+        return jsonify({'message': 'You already unliked this post'}), 200
     else:
         # post with given id not found
         return jsonify({'error': 'Post with given id not found'}), 404
@@ -313,16 +1018,381 @@ def create_comment(data, id):
     """
     if not request.json or 'comment' not in request.json:
         return jsonify({'error': 'Comment is missing'}), 400
-    current_user_email = data['email']
-    current_user = User.objects(email=current_user_email).first()
-    post = Post.objects(id=id).first()
-    if post:
-        comment = Comment()
-        comment.user = current_user
-        comment.text = request.json['comment']
-        comment.id = str(uuid.uuid4())  # generate random id, guaranteed to be unique
-        post.comments.append(comment)
-        post.save()
+    comment = Comment()
+    comment.user = user_ref(data)
+    comment.text = request.json['comment']
+    comment.id = str(uuid.uuid4())  # generate random id, guaranteed to be unique
+    if store_comments(to_id(id), [comment.to_mongo()]):
+        response_cache.invalidate(f'post:{int(id)}')
         return jsonify({"Comment-ID": comment.id}), 200
     else:
         return jsonify({'error': 'Post with given id not found'}), 404
+
+
+def store_comments(post_id, comments):
+    """
+    Count comments on a post and append them to its buckets, a new bucket is started every COMMENT_BUCKET_SIZE comments
+    the counter is the only change to the post document and numbers the comments, see bucket_updates
+    :param comments: comments as stored, to_mongo of Comment
+    :return: False if the post does not exist
+    """
+    post = Post._get_collection().find_one_and_update({'_id': post_id}, comment_count_update(len(comments)),
+                                                      {'comment_count': 1}, return_document=ReturnDocument.AFTER)
+    if post is None:
+        return False
+    with causal_write() as session:
+        for query, update in bucket_updates(post_id, comments, post['comment_count']):
+            try:
+                CommentBucket._get_collection().update_one(query, update, upsert=True, session=session)
+            except DuplicateKeyError:  # another request created the bucket first
+                CommentBucket._get_collection().update_one(query, update, upsert=True, session=session)
+    return True
+
+
+def comment_cursor(after):
+    """
+    Parse the cursor of a comments page, <bucket number>:<position> of the last comment returned
+    :return: tuple (bucket number, position)
+    """
+    bucket_no, position = after.split(':')
+    return int(bucket_no), int(position)
+
+
+@app.route('/api/posts/<int:id>/comments', methods=['GET'])
+def get_comments(id):
+    """
+    No need for authentication, comments of a post newest first, pass ?after=<next>&limit=<n> to get the next page
+    :param id: id of the post
+    :return: json response containing a page of comments with id, user and text and the cursor of the next page
+    """
+    try:
+        after, limit = page_args(comment_cursor)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    query = {'post': id}
+    if after:
+        query['bucket_no'] = {'$lte': after[0]}
+    # newest buckets first, fetched lazily until the page is full
+    buckets = public_collection(CommentBucket).find(query, {'bucket_no': 1, 'comments': 1}, sort=[('bucket_no', -1)],
+                                                    batch_size=limit // COMMENT_BUCKET_SIZE + 2, session=read_session())
+
+    comments = []
+    last = None
+    has_more = False
+    for bucket in buckets:
+        stored = bucket.get('comments', [])
+        end = after[1] if after and bucket['bucket_no'] == after[0] else len(stored)
+        for i in reversed(range(end)):
+            if len(comments) == limit:
+                has_more = True
+                break
+            comments.append({'id': stored[i]['_id'], 'user': str(stored[i].get('user')), 'text': stored[i]['text']})
+            last = (bucket['bucket_no'], i)
+        if has_more:
+            break
+
+    buckets.close()
+
+    if not comments and not public_collection(Post).find_one({'_id': id}, {'_id': 1}, session=read_session()):
+        return jsonify({'error': 'Post with given id not found'}), 404
+
+    next_cursor = f'{last[0]}:{last[1]}' if has_more else None
+    return jsonify({'comments': comments, 'next': next_cursor}), 200
+
+
+# -------------------------------------------------- BATCH ------------------------------------------------------
+def liked_posts_pipeline(ids, user_id):
+    """
+    Existing posts among ids and whether the user likes them, only a boolean per post comes back with what the like
+    added to trend_score
+    """
+    return [{'$match': {'_id': {'$in': ids}}},
+            {'$project': {'liked': {'$in': [user_id, {'$ifNull': ['$likes', []]}]},
+                          'like_score': f'${like_score_field(user_id)}'}}]
+
+
+@app.route('/api/batch', methods=['POST'])
+@auth_required
+def batch(data):
+    """
+    Authentication via token is required to access this route
+    Run a list of like, unlike, comment, follow and unfollow operations, e.g. the actions of a client that was offline
+    {"operations": [{"op": "like", "id": 3}, {"op": "comment", "id": 3, "comment": "..."}, {"op": "follow", "id": 2}]}
+    operations run in order as if sent one by one to their own route, the state is read once and the writes are sent
+    with one bulk_write per collection, so a batch costs at most 8 round trips whatever its size, plus one per post it
+    comments whose comment_count numbers the comments and one per user it unfollows
+    :param data: data returned from the auth_required decorator that contains the id and email of the current user
+    :return: json response containing one result per operation with the status and body its own route would return
+    """
+    try:
+        operations = parse_operations(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    plan = BatchPlan(data['id'], user_ref(data), operations)
+    posts, like_scores = {}, {}
+    if plan.post_ids:
+        for post in Post.objects.aggregate(liked_posts_pipeline(plan.post_ids, data['id'])):
+            posts[post['_id']] = post['liked']
+            if 'like_score' in post:
+                like_scores[post['_id']] = post['like_score']
+    users, followees = {}, set()
+    if plan.user_ids:
+        users = {user['_id']: user.get('name') for user in User.objects(id__in=plan.user_ids).only('name').as_pymongo()}
+        followees = {edge['followee'] for edge in Follow.objects(follower=data['id'], followee__in=plan.user_ids)
+                     .only('followee').as_pymongo()}
+    plan.run(posts, users, followees, like_scores)
+
+    if plan.post_writes:
+        Post._get_collection().bulk_write(plan.post_writes, ordered=False)
+    bucket_writes = []
+    for id, comments in plan.comments.items():
+        post = Post._get_collection().find_one_and_update({'_id': id}, comment_count_update(len(comments)),
+                                                          {'comment_count': 1}, return_document=ReturnDocument.AFTER)
+        if post is not None:  # not deleted since it was read
+            bucket_writes += [UpdateOne(query, update, upsert=True)
+                              for query, update in bucket_updates(id, comments, post['comment_count'])]
+    while bucket_writes:
+        try:
+            CommentBucket._get_collection().bulk_write(bucket_writes, ordered=False)
+            bucket_writes = []
+        except BulkWriteError as e:
+            bucket_writes = [bucket_writes[i] for i in duplicate_writes(e)]
+    upserted = {}
+    if plan.follow_writes:
+        try:
+            upserted = Follow._get_collection().bulk_write([write for write, _ in plan.follow_writes],
+                                                           ordered=False).upserted_ids
+        except BulkWriteError as e:
+            upserted = upserted_from_error(e)
+    # one by one, only deleted_count tells which edges this request removed and another one did not
+    deleted = [id for id in plan.unfollowed
+               if Follow._get_collection().delete_one({'follower': data['id'], 'followee': id}).deleted_count]
+    counters = plan.counter_writes(upserted, deleted)
+    if counters:
+        User._get_collection().bulk_write(counters, ordered=False)
+    if plan.unfollowed:
+        TimelineEntry._get_collection().delete_many({'owner': data['id'], 'author': {'$in': plan.unfollowed}})
+    response_cache.invalidate(*(f'post:{id}' for id in plan.touched_posts))
+
+    return jsonify({'results': plan.results}), 200
+
+
+# -------------------------------------------------- RESPONSE CACHE -----------------------------------------------
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """
+    :return: json response containing the hit, miss and eviction counters and the size of the response cache
+    """
+    return jsonify(response_cache.stats()), 200
+
+
+# -------------------------------------------------- CONNECTION POOL ----------------------------------------------
+@app.route('/api/pool/stats', methods=['GET'])
+def pool_stats():
+    """
+    Statistics of the MongoDB connection pool of the worker process serving the request, every worker of a pre-fork
+    server has its own pool so the pid tells which one answered
+    :return: json response containing the pid, the pool size limits, the open and checked out connections and the
+             number of checkouts with their average and maximum wait
+    """
+    return jsonify(pool_summary()), 200
+
+
+def pool_summary():
+    """
+    :return: dict with the pid, the pool size limits and the statistics of pool_monitor, shared by both editions
+    """
+    settings = app.config['MONGODB_SETTINGS']
+    return {'pid': os.getpid(), 'max_pool_size': settings['maxPoolSize'], 'min_pool_size': settings['minPoolSize'],
+            **pool_monitor.stats()}
+
+
+# -------------------------------------------------- METRICS ------------------------------------------------------
+@app.before_request
+def start_request_timer():
+    g.request_start = (time.perf_counter(), command_counter.count, command_counter.duration)
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Add the time spent in the database, in json encoding and in the rest of the handler to the Server-Timing header
+    and record the request in request_metrics
+    """
+    if 'request_start' not in g:
+        return response
+    start, commands, db_time = g.request_start
+    total = time.perf_counter() - start
+    commands = command_counter.count - commands
+    db_time = command_counter.duration - db_time
+    json_time = g.get('json_time', 0.0)
+    response.headers['Server-Timing'] = (f'db;dur={db_time * 1000:.2f};desc="{commands} commands", '
+                                         f'json;dur={json_time * 1000:.2f}, '
+                                         f'app;dur={max(total - db_time - json_time, 0) * 1000:.2f}, '
+                                         f'total;dur={total * 1000:.2f}')
+    request_metrics.observe(request.endpoint or 'unmatched', request.method, response.status_code, total, commands,
+                            db_time)
+    return response
+
+
+METRICS_MIMETYPE = 'text/plain; version=0.0.4'
+
+
+def metrics_text():
+    """
+    :return: metrics of the worker process in the Prometheus text format, shared by both editions
+    """
+    pool = pool_monitor.stats()
+    gauges = [('mongodb_pool_connections_open', 'Open connections of the pool', pool['open']),
+              ('mongodb_pool_connections_in_use', 'Connections checked out of the pool', pool['in_use']),
+              ('mongodb_pool_checkout_wait_max_seconds', 'Longest wait for a connection', pool['wait_max_ms'] / 1000),
+              ('trending_refresh_seconds', 'Duration of the last reload of the trending posts',
+               trending.last_refresh_seconds),
+              ('like_buffer_size', 'Like and unlike intents waiting to be written', like_buffer.size)]
+    counters = [('mongodb_slow_commands_total', 'Commands slower than SLOW_COMMAND_MS', command_counter.slow_commands),
+                ('trending_refreshes_total', 'Reloads of the trending posts', trending.refreshes),
+                ('trending_refresh_failures_total', 'Failed reloads of the trending posts', trending.refresh_failures),
+                ('like_buffer_refused_total', 'Intents written directly because the like buffer was full',
+                 like_buffer.refused),
+                ('like_buffer_flush_failures_total', 'Failed writes of the like buffer', like_buffer.failures),
+                ('admission_rate_limited_total', 'Requests rejected by the rate limit of their client',
+                 admission.rate_limited)]
+    for name, limit in admission.limits.items():
+        stats = limit.stats()
+        gauges += [(f'admission_limit{{class="{name}"}}', 'Requests of the class admitted at once', stats['limit']),
+                   (f'admission_in_flight{{class="{name}"}}', 'Requests of the class being served', stats['in_flight'])]
+        counters.append((f'admission_shed_total{{class="{name}"}}', 'Requests of the class rejected with a 503',
+                         stats['shed']))
+    return request_metrics.render(gauges, counters)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Request latency histograms per endpoint and status, database commands and time per endpoint and the connection
+    pool of the worker process serving the request, in the Prometheus text format
+    """
+    return Response(metrics_text(), mimetype=METRICS_MIMETYPE)
+
+
+# -------------------------------------------------- ADMISSION CONTROL --------------------------------------------
+SCAN_ENDPOINTS = {'get_all_posts', 'search_posts'}  # reads going through many documents
+EXPORT_ENDPOINTS = {'stream_all_posts'}
+# monitoring routes stay available under overload, unmatched urls are answered without handler
+EXEMPT_ENDPOINTS = {'metrics', 'pool_stats', 'cache_stats', None}
+
+admission = AdmissionController(app.config['RATE_LIMIT_PER_SECOND'], app.config['RATE_LIMIT_BURST'],
+                                congested=lambda: pool_monitor.waiting > 0)
+
+
+def route_class(endpoint, method, accept_mimetypes=None):
+    """
+    :param accept_mimetypes: Accept header of the request, /api/all_posts streams the export when it asks for ndjson
+    :return: key of project.admission.ROUTE_CLASSES the concurrency limit of the route is taken from
+    """
+    if endpoint in EXPORT_ENDPOINTS:
+        return 'export'
+    if endpoint == 'get_all_posts' and accept_mimetypes is not None and wants_ndjson(accept_mimetypes):
+        return 'export'
+    if endpoint in SCAN_ENDPOINTS:
+        return 'scan'
+    return 'read' if method in ('GET', 'HEAD') else 'write'
+
+
+def rate_limit_key(token, address):
+    """
+    Key of the token bucket of a client: the user its token was signed for, else the address of the client, so that
+    a client altering or dropping its Authorization header is still limited with the requests it sent before
+    :param token: Authorization header of the request, None if missing
+    :param address: address of the client
+    """
+    # app rather than current_app, the async edition shares the settings of the flask app
+    if token and app.config['SECRET_KEY']:
+        try:
+            data = token_serializer(app.config['SECRET_KEY']).loads(token)
+        except BadSignature:
+            data = None
+        if isinstance(data, dict):
+            # tokens issued before the id claim only carry the email, which is as unique
+            return f"user:{data['id']}" if 'id' in data else f"email:{data.get('email')}"
+    return f'address:{address}'
+
+
+def rejection(status, retry_after):
+    """
+    :return: tuple (json body, status, headers) of a request rejected by the admission controller
+    """
+    error = 'Rate limit exceeded' if status == 429 else 'Server overloaded, retry later'
+    return {'error': error}, status, {'Retry-After': str(retry_after)}
+
+
+@app.before_request
+def admit_request():
+    """
+    Reject the request before its handler runs if its client is over its rate limit (429) or its route class is at
+    its concurrency limit (503), so a slow database fails the excess requests fast instead of queueing all of them
+    """
+    if not app.config['ADMISSION_ENABLED'] or request.endpoint in EXEMPT_ENDPOINTS:
+        return None
+    route = route_class(request.endpoint, request.method, request.accept_mimetypes)
+    key = rate_limit_key(request.headers.get('Authorization'), request.remote_addr)
+    status, retry_after = admission.admit(route, key)
+    if status:
+        body, status, headers = rejection(status, retry_after)
+        return jsonify(body), status, headers
+    g.admitted = (route, time.perf_counter())
+
+
+@app.teardown_request
+def release_admission(exc):
+    # also runs when the handler raised, a streamed response releases once the stream is over
+    admitted = g.pop('admitted', None)
+    if admitted:
+        admission.release(admitted[0], time.perf_counter() - admitted[1])
+
+
+# -------------------------------------------------- COMPRESSION --------------------------------------------------
+def response_compressor():
+    """
+    :return: StreamCompressor of the encoding negotiated with the client at the level of the route class, None if
+             the client accepts none of COMPRESSION_ENCODINGS
+    """
+    encoding = negotiate(request.accept_encodings, available_encodings(app.config['COMPRESSION_ENCODINGS']))
+    if encoding is None:
+        return None
+    route = route_class(request.endpoint, request.method, request.accept_mimetypes)
+    return StreamCompressor(encoding, COMPRESSION_LEVELS[route][encoding])
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compress the body in the encoding negotiated from Accept-Encoding once it is over COMPRESSION_MIN_BYTES, a streamed
+    body is compressed chunk by chunk while it is sent
+    """
+    if not app.config['COMPRESSION_ENABLED'] or response.direct_passthrough:
+        return response
+    if not compressible(response, request.method):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not response.is_streamed and response.content_length < app.config['COMPRESSION_MIN_BYTES']:
+        return response
+    compressor = response_compressor()
+    if compressor is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compressor.compress_body(response.get_data()))
+    response.headers['Content-Encoding'] = compressor.encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)  # the compressed body is not the one the strong ETag was computed on
+    return response
+
+
+# --------------------------------------------------------------------------------------------------------------------
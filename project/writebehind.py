@@ -0,0 +1,212 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from pymongo import UpdateOne
+
+from .trending import like_score_field
+
+logger = logging.getLogger(__name__)
+
+
+class HotKeys:
+    """
+    Keys used at least threshold times within a second by this process, e.g. the posts receiving a burst of likes
+    a key stays hot for the second after the one it crossed the threshold in
+    """
+
+    def __init__(self, threshold, clock=time.monotonic):
+        """
+        :param threshold: function returning the uses per second from which a key is hot, 0 makes every key hot
+        """
+        self._threshold = threshold
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._window = int(clock())
+        self._counts = defaultdict(int)
+        self._hot = set()  # hot keys of the previous window
+
+    def hit(self, key):
+        """
+        Count one use of key
+        :return: True if key is hot
+        """
+        threshold = self._threshold()
+        if threshold <= 0:
+            return True
+        with self._lock:
+            window = int(self._clock())
+            if window != self._window:
+                self._hot = {k for k, count in self._counts.items() if count >= threshold} \
+                    if window == self._window + 1 else set()
+                self._counts = defaultdict(int)
+                self._window = window
+            self._counts[key] += 1
+            return key in self._hot or self._counts[key] >= threshold
+
+
+def like_writes(intents, increment):
+    """
+    One update per post applying the like and unlike intents of its users, counters included
+    the likes list is rebuilt with set operations so like_count and trend_score follow the likes actually added or
+    removed, a like of a user already liking the post changes nothing; every like added records increment as what it
+    added to trend_score and every like removed takes back what it recorded (see project.trending.like_score_field)
+    :param intents: dict post id -> dict user id -> True to like, False to unlike
+    :param increment: trend_score of one like, see project.trending.trend_increment
+    :return: list of UpdateOne with pipeline updates
+    """
+    writes = []
+    for post_id, users in intents.items():
+        liked = sorted(user for user, like in users.items() if like)
+        unliked = sorted(user for user, like in users.items() if not like)
+        # the expressions of one $set stage all read the document as it was before the update
+        before = {'$ifNull': ['$likes', []]}
+        after = {'$setUnion': [{'$setDifference': [before, unliked]}, liked]}
+        added = {'$size': {'$setDifference': [liked, before]}}
+        taken_back = [{'$cond': [{'$in': [user, before]}, {'$ifNull': [f'${like_score_field(user)}', 0]}, 0]}
+                      for user in unliked]
+        stages = [{'$set': {
+            'likes': after,
+            'like_count': {'$size': after},
+            'trend_score': {'$subtract': [
+                {'$add': [{'$ifNull': ['$trend_score', 0]}, {'$multiply': [increment, added]}]},
+                {'$add': [0] + taken_back},
+            ]},
+            # a user already liking the post keeps what its like recorded
+            **{like_score_field(user): {'$cond': [{'$in': [user, before]}, f'${like_score_field(user)}', increment]}
+               for user in liked},
+        }}]
+        if unliked:
+            stages.append({'$unset': [like_score_field(user) for user in unliked]})
+        writes.append(UpdateOne({'_id': post_id}, stages))
+    return writes
+
+
+class LikeBuffer:
+    """
+    Like and unlike intents collected in process and written in the background (write-behind), so a burst of likes on
+    one post costs one update of its document per flush instead of one per like
+    intents are reduced per post and user, the last one wins: a like followed by an unlike of the same user before the
+    flush writes nothing that was not already there
+    a flush runs every interval seconds, or sooner once max_batch intents wait, and when the process exits; at most
+    max_buffered intents are held, add refuses more so the caller writes them directly, which bounds what a crash loses
+    """
+
+    def __init__(self, write, interval, max_batch, max_buffered):
+        """
+        :param write: function writing a dict post id -> dict user id -> liked, raises if the write failed
+        :param interval: function returning the seconds between two flushes
+        :param max_batch: function returning the number of intents that triggers a flush
+        :param max_buffered: function returning the number of intents held at most
+        """
+        self._write = write
+        self._interval = interval
+        self._max_batch = max_batch
+        self._max_buffered = max_buffered
+        self._reset()
+        # the buffer and the flush thread of the parent are not those of a forked worker
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush at a time, in order
+        self._wake = threading.Event()
+        self._intents = defaultdict(dict)
+        self._flushing = {}  # intents being written by the current flush
+        self._size = 0
+        self._thread = None
+        self._closed = False
+        self.added = 0
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.refused = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def holds(self, post_id):
+        """
+        :return: True if intents of the post wait or are being written, its next ones must then be buffered too so
+                 that a direct write never lands before an older buffered one
+        """
+        with self._lock:
+            return post_id in self._intents or post_id in self._flushing
+
+    def add(self, post_id, user_id, liked):
+        """
+        :param liked: True for a like, False for an unlike
+        :return: False if the buffer is full or closed and the intent must be written directly
+        """
+        with self._lock:
+            if self._closed or (self._size >= self._max_buffered() and user_id not in self._intents.get(post_id, {})):
+                self.refused += 1
+                return False
+            users = self._intents[post_id]
+            self._size += user_id not in users
+            users[user_id] = liked
+            self.added += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            if self._size >= self._max_batch():
+                self._wake.set()
+        return True
+
+    def flush(self):
+        """
+        Write the intents held, those of a failed write are put back unless newer ones replaced them
+        :return: number of intents written
+        """
+        with self._flush_lock:
+            with self._lock:
+                intents, self._intents, size, self._size = self._intents, defaultdict(dict), self._size, 0
+                self._flushing = intents
+            if not intents:
+                return 0
+            try:
+                self._write(intents)
+            except Exception:
+                self.failures += 1
+                with self._lock:
+                    for post_id, users in intents.items():
+                        newer = self._intents[post_id]
+                        for user_id, liked in users.items():
+                            if user_id not in newer:
+                                newer[user_id] = liked
+                                self._size += 1
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+            self.flushes += 1
+            self.written += size
+            return size
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self._interval())
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('flushing %s buffered likes failed, retrying at the next flush', self._size)
+
+    def close(self):
+        """
+        Stop buffering and write what is held, called when the process exits
+        """
+        with self._lock:
+            self._closed = True
+        self._wake.set()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('%s buffered likes lost at shutdown', self._size)
+
+    def stats(self):
+        return {'buffered': self._size, 'added': self.added, 'written': self.written, 'flushes': self.flushes,
+                'failures': self.failures, 'refused': self.refused}